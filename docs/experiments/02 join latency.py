@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# Time the server side of a peer join: advertising the new peer's eventfds
+# to everybody else and everybody's eventfds to the new peer, as in
+# ProtocolIVSHMSGServer.connectionMade().  Compares the old one sendmsg()
+# per fd with ivshmsg_send_msgs().  Peers are socketpairs drained by
+# threads so only the sending side is measured.
+#
+# usage: 02 join latency.py [ --shared ] [ nClients ... ]
+#   --shared: one eventfd per peer (ivshmsg_server --shared-doorbell)
+
+import array
+import os
+import socket
+import sys
+import threading
+
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..',
+                                'ivshmsg_twisted'))
+from ivshmsg_sendrecv import ivshmsg_send_one_msg, ivshmsg_send_msgs
+
+
+def drain(sock):
+    '''Swallow everything, closing the passed fds.'''
+    while True:
+        try:
+            data, anc, flags, addr = sock.recvmsg(
+                65536, socket.CMSG_SPACE(253 * 4))
+        except OSError as e:
+            return
+        if not data:
+            return
+        for level, type, fddata in anc:
+            fds = array.array('i')
+            fds.frombytes(fddata[:len(fddata) - len(fddata) % 4])
+            for fd in fds:
+                os.close(fd)
+
+
+def join(nClients, shared, batched):
+    nEvents = nClients + 2
+    nVectors = 1 if shared else nEvents
+    server_id = nClients + 1
+
+    # The fabric is full except for the joining peer, the last one.
+    peers = {}
+    for id in range(1, nClients + 1):
+        server_end, peer_end = socket.socketpair()
+        server_end.setblocking(False)   # Like the Twisted transport
+        threading.Thread(target=drain, args=(peer_end,), daemon=True).start()
+        peers[id] = (server_end, peer_end,
+                     [ os.eventfd(0) for _ in range(nVectors) ])
+    server_fds = [ os.eventfd(0) for _ in range(nVectors) ]
+    new_id = nClients
+    new_sock, _, new_fds = peers[new_id]
+    others = [ id for id in peers if id != new_id ]
+
+    started = perf_counter()
+    if batched:
+        mine = [ (new_id, fd) for fd in new_fds ]
+        for id in others:
+            ivshmsg_send_msgs(peers[id][0], mine)
+        msgs = []
+        for id in others:
+            msgs.extend((id, fd) for fd in peers[id][2])
+        msgs.extend((server_id, fd) for fd in server_fds)
+        msgs.extend(mine)
+        ivshmsg_send_msgs(new_sock, msgs)
+    else:
+        for id in others:
+            for fd in new_fds:
+                ivshmsg_send_one_msg(peers[id][0], new_id, fd)
+        for id in others:
+            for fd in peers[id][2]:
+                ivshmsg_send_one_msg(new_sock, id, fd)
+        for fd in server_fds:
+            ivshmsg_send_one_msg(new_sock, server_id, fd)
+        for fd in new_fds:
+            ivshmsg_send_one_msg(new_sock, new_id, fd)
+    elapsed = perf_counter() - started
+
+    nfds = (len(others) + 2) * nVectors + len(others) * nVectors
+    for server_end, peer_end, fds in peers.values():
+        server_end.close()
+        peer_end.close()
+        for fd in fds:
+            os.close(fd)
+    for fd in server_fds:
+        os.close(fd)
+    return nfds, elapsed
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    shared = '--shared' in args
+    sweep = [ int(a) for a in args if a != '--shared' ] or [ 2, 8, 14, 30, 62 ]
+    print('nClients  fds sent  one-by-one ms  batched ms')
+    for nClients in sweep:
+        nfds, slow = join(nClients, shared, False)
+        nfds, fast = join(nClients, shared, True)
+        print('%8d  %8d  %13.2f  %10.2f' % (
+            nClients, nfds, slow * 1000, fast * 1000))
@@ -26,10 +26,43 @@ def parse_cmdline(cmdline_args):
         epilog='Options reflect those in the QEMU "ivshmem-client".'
     )
     parser.add_argument('-?', action='help')  # -h and --help are built in
+    parser.add_argument('--busy-poll', '-b', metavar='<usecs>',
+        dest='busy_poll',
+        help='Spin this long before sleeping for doorbells; implies --epoll (default: 0)',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--credits', metavar='<integer>',
+        help='Advertise a receive window of this many tagged requests (Peer-Attribute Credits=); peers queue the rest instead of overrunning the mailslot (default: 0, none)',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--epoll', '-e',
+        help='Take doorbells on a dedicated epoll thread instead of the reactor',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--moderate-count', metavar='<integer>',
+        dest='moderate_count',
+        help='Doorbell moderation: re-arm after this many messages, 0 for no limit (default: 64)',
+        type=int,
+        default=64
+    )
+    parser.add_argument('--moderate-usecs', metavar='<usecs>',
+        dest='moderate_usecs',
+        help='Doorbell moderation: poll a ringing peer this long before re-arming; needs a ring mailbox (default: 0, off)',
+        type=int,
+        default=0
+    )
     parser.add_argument('--socketpath', '-S', metavar='/path/to/socket',
         help='Absolute path to UNIX domain socket created by the server',
         default='/tmp/ivshmsg_socket'
     )
+    parser.add_argument('--tlv',
+        help='Offer peers the binary TLV wire format (Peer-Attribute Wire=TLV); text is still used with peers that don\'t take it up',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--verbose', '-v',
         help='Specify multiple times to increase verbosity',
         default=0,
@@ -26,6 +26,17 @@ def parse_cmdline(cmdline_args):
         epilog='Options reflect those in the QEMU "ivshmem-server".'
     )
     parser.add_argument('-?', action='help')  # -h and --help are built in
+    parser.add_argument('--busy-poll', '-b', metavar='<usecs>',
+        dest='busy_poll',
+        help='Spin this long before sleeping for doorbells; implies --epoll (default: 0)',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--credits', metavar='<integer>',
+        help='Advertise a receive window of this many tagged requests (Peer-Attribute Credits=); peers queue the rest instead of overrunning the mailslot (default: 0, none)',
+        type=int,
+        default=0
+    )
     parser.add_argument('--daemon', '-D',
         help='Run in background, log to file (default: foreground/stdout)',
         # The twisted module expectes the attribute 'foreground'...
@@ -33,6 +44,28 @@ def parse_cmdline(cmdline_args):
         action='store_false',   # ...so reverse the polarity, Scotty
         default=True
     )
+    parser.add_argument('--epoll', '-e',
+        help='Take doorbells on a dedicated epoll thread instead of the reactor',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--eventfd-pool', metavar='<integer>',
+        dest='eventfd_pool',
+        help='Keep this many sets of eventfds ready for joining peers (default: 2)',
+        type=int,
+        default=2
+    )
+    parser.add_argument('--hugepages', '-H', metavar='/hugetlbfs/mount',
+        help='Back the mailbox with huge pages from this hugetlbfs mount (default: /dev/hugepages)',
+        nargs='?',
+        const='/dev/hugepages',
+        default=None
+    )
+    parser.add_argument('--isolate',
+        help='Give each writer of a mailslot its own cacheline (not understood by the guest driver)',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--logfile', '-L', metavar='<name>',
         help='Pathname of logfile for use in daemon mode',
         default='/tmp/ivshmsg_log'
@@ -41,8 +74,25 @@ def parse_cmdline(cmdline_args):
         help='Name of mailbox that exists in POSIX shared memory',
         default='ivshmsg_mailbox'
     )
+    parser.add_argument('--moderate-count', metavar='<integer>',
+        dest='moderate_count',
+        help='Doorbell moderation: re-arm after this many messages, 0 for no limit (default: 64)',
+        type=int,
+        default=64
+    )
+    parser.add_argument('--moderate-usecs', metavar='<usecs>',
+        dest='moderate_usecs',
+        help='Doorbell moderation: poll a ringing peer this long before re-arming; needs a ring mailbox (default: 0, off)',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--msgsize', '-m', metavar='<integer>',
+        help='Largest message in bytes; rounded up to fill a power-of-two mailslot (default: 384)',
+        type=int,
+        default=384
+    )
     parser.add_argument('--nClients', '-n', metavar='<integer>',
-        help='Serve up to this number of clients (max=14)',
+        help='Serve up to this number of clients (max=62)',
         type=int,
         default=14
     )
@@ -52,6 +102,35 @@ def parse_cmdline(cmdline_args):
         action='store_false',
         default=True
     )
+    parser.add_argument('--numa-node', '-N', metavar='<integer>',
+        dest='numa_node',
+        help='Place the mailbox memory on this NUMA node (default: -1, let the kernel decide)',
+        type=int,
+        default=-1
+    )
+    parser.add_argument('--redraw-ms', metavar='<msecs>',
+        dest='redraw_ms',
+        help='Redraw the switch display at most this often; changes in between are drawn together (default: 500)',
+        type=int,
+        default=500
+    )
+    parser.add_argument('--reserve-secs', metavar='<seconds>',
+        dest='reserve_secs',
+        help='Hand a departed peer\'s ID to the next peer to join for this long, so a restarting VM gets its port back; 0 to free it at once (default: 30)',
+        type=int,
+        default=30
+    )
+    parser.add_argument('--ring', '-r', metavar='<integer>',
+        help='Mailslots are rings of this many messages (default: 0, one message, as expected by the guest driver)',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--shared-doorbell',
+        dest='shared_doorbell',
+        help='One eventfd per peer instead of one per peer pair; only for Python clients (not QEMU guests)',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--silent', '-s',
         help='Do NOT participate in EventFDs/mailbox as another peer',
         action='store_true',
@@ -61,11 +140,48 @@ def parse_cmdline(cmdline_args):
         help='Absolute path to UNIX domain socket (will be created)',
         default='/tmp/ivshmsg_socket'
     )
+    parser.add_argument('--stats',
+        help='Keep per-port traffic counters in the mailbox (REST /stats); this grows the mailbox file, eg, from 8K to 16K with the default clients, so the libvirt size= must match (default: off)',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--tag-retries', metavar='<integer>',
+        dest='tag_retries',
+        help='Resend a tagged request (eg, the CTL-Write for a Link RFC) this many times if it isn\'t acknowledged (default: 2)',
+        type=int,
+        default=2
+    )
+    parser.add_argument('--tag-timeout-ms', metavar='<msecs>',
+        dest='tag_timeout_ms',
+        help='Wait this long for the acknowledgment of a tagged request, doubling on each resend (default: 1000)',
+        type=int,
+        default=1000
+    )
+    parser.add_argument('--takeover', '-T',
+        help='Take over live from the server running on --socketpath, peers and all; mailbox options come from that server',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--tlv',
+        help='Offer peers the binary TLV wire format (Peer-Attribute Wire=TLV); text is still used with peers that don\'t take it up',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--verbose', '-v',
         help='Specify multiple times to increase verbosity',
         default=0,
         action='count'
     )
+    parser.add_argument('--warm', '-w',
+        help='Reuse an existing mailbox with the same geometry, keeping the slots of VMs still attached to it',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--workers', '-W', metavar='<integer>',
+        help='Handle requests to the server in this many worker processes, split by port (default: 0, all in this process)',
+        type=int,
+        default=0
+    )
     parser.add_argument('--noPFM',
         dest='smart',
         help='Suppress rudimentary fabric management for clients',
@@ -76,10 +192,29 @@ def parse_cmdline(cmdline_args):
     # Generate the object and postprocess some of the fields.
     args = parser.parse_args(cmdline_args)
     assert 1 <= args.nClients <= 62, 'nClients is out of range 1 - 62'
+    assert 0 <= args.busy_poll <= 1000000, 'busy-poll is out of range 0 - 1000000'
+    assert 0 <= args.eventfd_pool <= 62, 'eventfd-pool is out of range 0 - 62'
+    assert args.reserve_secs >= 0, 'reserve-secs cannot be negative'
+    assert 0 <= args.redraw_ms <= 60000, 'redraw-ms is out of range 0 - 60000'
+    assert 384 <= args.msgsize <= 65536, 'msgsize is out of range 384 - 65536'
+    assert args.ring == 0 or 2 <= args.ring <= 64, \
+        'ring is out of range 2 - 64'
+    assert args.moderate_count >= 0 and args.moderate_usecs >= 0, \
+        'moderation thresholds cannot be negative'
+    assert not args.moderate_usecs or args.ring, \
+        'Doorbell moderation needs --ring'
+    assert not (args.isolate and args.ring), \
+        'Isolated and ring layouts are mutually exclusive'
     assert not (args.silent and args.smart), \
         'Silent/smart are mutually exclusive'
+    assert 0 <= args.workers <= args.nClients, \
+        'workers is out of range 0 - nClients'
+    assert not args.workers or not (args.silent or args.shared_doorbell or
+        args.moderate_usecs), \
+        'workers cannot be used with silent, shared-doorbell or moderation'
     assert not '/' in args.mailbox, 'mailbox cannot have slashes'
-    assert not os.path.exists(args.socketpath), 'Remove %s' % args.socketpath
+    assert args.takeover or not os.path.exists(args.socketpath), \
+        'Remove %s' % args.socketpath
 
     return args
 
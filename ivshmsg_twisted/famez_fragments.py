@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+# Messages bigger than a mailslot are split into sequenced fragments, each
+# of which goes through the mailslot like any other message.  A fragment is
+# binary: a fixed header starting with a magic that can't begin a text
+# request, followed by a chunk of the payload.  Fragments from one sender
+# arrive in order (fill_async() keeps a FIFO per sender slot) so the
+# receiver only ever assembles one message per peer.  Its buffer is
+# allocated on the first fragment from that peer and then reused, so
+# memory is bounded at REASSEMBLY_MAX per peer.
+
+import struct
+
+from twisted.internet.defer import gatherResults
+
+try:
+    from ivshmsg_mailbox import IVSHMSG_MailBox as MB
+except ImportError as e:
+    from .ivshmsg_mailbox import IVSHMSG_MailBox as MB
+
+###########################################################################
+# magic, kind, msg_id, index, count, total length
+
+FRAG_MAGIC = b'!EZF'
+_FRAG_HDR = struct.Struct('<4sHHHHI')
+
+KIND_REQUEST = 0        # Reassembled text goes back into handle_request()
+KIND_BULK = 1           # Reassembled bytes go to the bulk handler
+
+REASSEMBLY_MAX = 64 * 1024
+
+_next_msg_id = 1
+
+###########################################################################
+# Sender side
+
+
+def is_fragment(buf):
+    return buf[:len(FRAG_MAGIC)] == FRAG_MAGIC
+
+
+def fragment_room():
+    '''Payload bytes per fragment, leaving room for the NUL in the slot.'''
+    return MB.MS_MAX_BUFLEN - 1 - _FRAG_HDR.size
+
+
+def _fragments(payload, kind):
+    '''The fragments of payload, each ready for a mailslot.'''
+    global _next_msg_id
+
+    if isinstance(payload, str):
+        payload = payload.encode()
+    total = len(payload)
+    assert total <= REASSEMBLY_MAX, 'Payload exceeds %d bytes' % REASSEMBLY_MAX
+    room = fragment_room()
+    count = (total + room - 1) // room
+    msg_id = _next_msg_id
+    _next_msg_id = (_next_msg_id % 0xFFFF) + 1
+
+    view = memoryview(payload)
+    return [ _FRAG_HDR.pack(FRAG_MAGIC, kind, msg_id, index, count, total) +
+             view[index * room:(index + 1) * room] for index in range(count) ]
+
+
+def send_fragments(payload, from_id, to_doorbell, kind=KIND_REQUEST):
+    '''Queue all the fragments of payload.  The Deferred fires with True
+       if none of them had to stomp, after the last doorbell.'''
+
+    # famez_requests imports this module, so not at the top.
+    try:
+        from famez_requests import _ring_after_fill
+    except ImportError as e:
+        from .famez_requests import _ring_after_fill
+
+    dlist = []
+    for frag in _fragments(payload, kind):
+        d = MB.fill_async(from_id, frag, to_doorbell.owner_id)
+        d.addCallback(_ring_after_fill, from_id, to_doorbell)
+        dlist.append(d)
+    d = gatherResults(dlist)
+    d.addCallback(all)
+    return d
+
+
+def send_fragments_blocking(payload, from_id, to_doorbell, kind=KIND_REQUEST):
+    '''send_fragments() for use outside the reactor, see MB.fill().'''
+    ret = True
+    for frag in _fragments(payload, kind):
+        ret = MB.fill(from_id, frag, to_doorbell.owner_id) and ret
+        MB.ring_doorbell(from_id, to_doorbell)
+    return ret
+
+
+def send_bulk(data, from_id, to_doorbell):
+    '''Raw bytes for the bulk handler on the far side, whatever the size.'''
+    return send_fragments(data, from_id, to_doorbell, kind=KIND_BULK)
+
+###########################################################################
+# Receiver side.  The streaming listener sees every chunk as it lands:
+#   listener(peer_id, kind, msg_id, offset, chunk, total)
+# where chunk is a memoryview only valid during the call.  The bulk handler
+# gets complete KIND_BULK messages:  handler(peer_id, data)
+
+
+class _Reassembly(object):
+
+    def __init__(self):
+        self.buf = bytearray(REASSEMBLY_MAX)
+        self.msg_id = None
+        self.expected = 0
+        self.length = 0
+
+
+_reassembly = {}        # By peer id
+_listener = None
+_bulk_handler = None
+
+
+def set_fragment_listener(callback):
+    global _listener
+    _listener = callback
+
+
+def set_bulk_handler(callback):
+    global _bulk_handler
+    _bulk_handler = callback
+
+
+def forget_reassembly(peer_id):
+    '''peer_id is gone, and so is its buffer: a new peer with the same
+       id starts from scratch.'''
+    _reassembly.pop(peer_id, None)
+
+
+def reassemble(peer_id, frag, logmsg=print):
+    '''Returns (kind, complete payload as bytes) on the final fragment,
+       otherwise (None, None).'''
+    try:
+        magic, kind, msg_id, index, count, total = _FRAG_HDR.unpack_from(frag)
+    except struct.error as e:
+        logmsg('Fragment from %d is truncated' % peer_id)
+        return None, None
+    if total > REASSEMBLY_MAX:
+        logmsg('Fragmented message from %d is too big (%d)' % (peer_id, total))
+        return None, None
+
+    R = _reassembly.get(peer_id)
+    if R is None:
+        R = _reassembly[peer_id] = _Reassembly()
+    if index == 0:
+        if R.msg_id is not None:
+            logmsg('Dropping partial message %d from %d' % (R.msg_id, peer_id))
+        R.msg_id = msg_id
+        R.expected = 0
+        R.length = 0
+    if msg_id != R.msg_id or index != R.expected:
+        logmsg('Fragment %d/%d of %d from %d is out of sequence' % (
+            index, count, msg_id, peer_id))
+        R.msg_id = None
+        return None, None
+
+    chunk = memoryview(frag)[_FRAG_HDR.size:]
+    if R.length + len(chunk) > total:
+        logmsg('Fragment overruns message %d from %d' % (msg_id, peer_id))
+        R.msg_id = None
+        return None, None
+    R.buf[R.length:R.length + len(chunk)] = chunk
+    if _listener is not None:
+        _listener(peer_id, kind, msg_id, R.length, chunk, total)
+    R.length += len(chunk)
+    R.expected += 1
+    if R.expected < count:
+        return None, None
+
+    R.msg_id = None
+    if R.length != total:
+        logmsg('Message %d from %d is %d bytes, expected %d' % (
+            msg_id, peer_id, R.length, total))
+        return None, None
+    payload = bytes(R.buf[:R.length])
+    if kind == KIND_BULK:
+        if _bulk_handler is not None:
+            _bulk_handler(peer_id, payload)
+        else:
+            logmsg('No bulk handler for %d bytes from %d' % (
+                len(payload), peer_id))
+    return kind, payload
@@ -5,16 +5,28 @@
 
 import attr
 import os
-import functools
+import inspect
+import re
 import sys
 
-from collections import OrderedDict
 from pprint import pprint
 
+from twisted.internet.defer import Deferred, DeferredSemaphore
+
 try:
     from ivshmsg_mailbox import IVSHMSG_MailBox as MB
+    from famez_fragments import is_fragment, reassemble, send_fragments
+    from famez_fragments import send_fragments_blocking, forget_reassembly
+    from famez_fragments import KIND_REQUEST
+    from famez_tags import TagManager
+    import famez_tlv
 except ImportError as e:
     from .ivshmsg_mailbox import IVSHMSG_MailBox as MB
+    from .famez_fragments import is_fragment, reassemble, send_fragments
+    from .famez_fragments import send_fragments_blocking, forget_reassembly
+    from .famez_fragments import KIND_REQUEST
+    from .famez_tags import TagManager
+    from . import famez_tlv
 
 def PRINT(*args):
     print(*args, file=_stdtrace)
@@ -26,15 +38,45 @@ def PPRINT(*args):
 # Better than __slots__ although maybe this should be the precursor for
 # making this entire file a class.  It's all items that cover the gamut
 # of requests.  "this" is the object with SID0, CID0, LinkState and cclass.
+# "deliver" gets the return value of a handler that finishes later.
 
 
-ResponseObject = attr.make_class('ResponseObject',
-    ['this', 'proxy', 'from_id', 'to_doorbell',
-     'logmsg', 'stdtrace', 'verbose'])
+ResponseObject = attr.make_class('ResponseObject', dict(
+    [ (name, attr.ib()) for name in ('this', 'proxy', 'from_id',
+        'to_doorbell', 'logmsg', 'stdtrace', 'verbose') ] +
+    [ ('deliver', attr.ib(default=None)) ]))
 
 ###########################################################################
-# Create a subroutine name out of the elements passed in.  Return
-# the remainder.  Start with the least-specific construct.
+# Handlers register the words of their request with @handles().  The words
+# go into a trie, one level per word, built as this file is imported.  A
+# hyphen separates words too, so 'CTL-Write' and 'CTL Write' are the same
+# request.  Lookups walk the words of a message and stop at the first
+# (least-specific) registered prefix; the rest of the message is the
+# handler's args.  That's a walk of at most _depth dicts, not worth a
+# cache: the word after a short request is often its per-message CSV.  A
+# handler that does real work should be a coroutine ("async def"), see
+# handle_request().
+
+_trie = {}          # word: [ handler or None, { next word: ... } ]
+_depth = 0          # Most words in any registered request
+_coroutines = set() # Handlers that are coroutines, run via _run_coroutine
+
+
+def handles(request):
+    def register(func):
+        global _depth
+        words = request.replace('-', ' ').split()
+        node = _trie
+        for word in words[:-1]:
+            node = node.setdefault(word, [ None, {} ])[1]
+        entry = node.setdefault(words[-1], [ None, {} ])
+        assert entry[0] is None, 'Duplicate handler for "%s"' % request
+        entry[0] = func
+        _depth = max(_depth, len(words))
+        if inspect.iscoroutinefunction(func):
+            _coroutines.add(func)
+        return func
+    return register
 
 
 def _unprocessed(client, *args, **kwargs):
@@ -44,27 +86,35 @@ def _unprocessed(client, *args, **kwargs):
     return False
 
 
+def _lookup(prefix):
+    '''prefix is the leading message elements.  Returns the handler and
+       how many elements it used.'''
+    node = _trie
+    for i, element in enumerate(prefix):
+        for word in element.split('-'):    # Such as 'Link CTL Peer-Attribute'
+            entry = node.get(word, None)
+            if entry is None:
+                return _unprocessed, 0
+            handler, node = entry
+        if handler is not None:
+            return handler, i + 1
+    return _unprocessed, 0
+
+
 def chelsea(elements, verbose=0):
-    entry = ''          # They begin with a leading '_', wait for it...
-    G = globals()
-    for i, e in enumerate(elements):
-        e = e.replace('-', '_')         # Such as 'Link CTL Peer-Attribute'
-        entry += '_%s' % e
-        if verbose > 1:
-            print('Looking for %s()...' % entry, end='', file=_stdtrace)
-        if entry in G:
-            args = elements[i + 1:]
-            if verbose > 1:
-                PRINT('found it->%s' % str(args))
-            return G[entry], args
-        if verbose > 1:
-            PRINT('NOPE')
-    return _unprocessed, elements
+    handler, used = _lookup(elements[:_depth])
+    if verbose > 1:
+        PRINT('%s -> %s' % (' '.join(elements[:used]) or str(elements),
+                            handler.__name__))
+    return handler, elements[used:]
 
 ###########################################################################
+# TLV requests arrive with their fields already in a dict.
 
 
 def CSV2dict(oneCSVstr):
+    if isinstance(oneCSVstr, dict):
+        return oneCSVstr
     kv = {}
     elems = oneCSVstr.strip().split(',')
     for e in elems:
@@ -78,73 +128,154 @@ def CSV2dict(oneCSVstr):
 ###########################################################################
 # Here instead of ivshmsg_mailbox to manage the tag.  Can be called as a
 # "discussion initiator" usually from the REPL interpreters, or as a
-# response to a received command from the callbacks.
-
-_next_tag = 1               # Gen-Z tag field
+# response to a received command from the callbacks.  Tags are kept (and
+# retransmitted, timed out and flow controlled) by famez_tags.
 
-_tagged = OrderedDict()     # By tag, just store receiver now
+_tags = TagManager(lambda payload, from_id, to_doorbell:
+                   _send_async(payload, from_id, to_doorbell, False))
 
 _tracker = 0                # EmerGen-Z addenda to watch conversations
 
 _TRACKER_TOKEN = '!EZT='
+_TRACKER_RE = re.compile(rb'!EZT=(\d+)\s*$')
 
-def send_payload(payload, from_id, to_doorbell, reset_tracker=False,
-                 tag=None, tagCID=0, tagSID=0):
-    global _next_tag, _tracker
 
-    # PRINT('Send "%s" from %d to %s' % (payload, from_id, vars(to_doorbell)))
+def configure_tags(timeout_ms=None, retries=None, logmsg=None, credits=None):
+    '''credits is the receive window this end advertises, 0 for none.'''
+    _tags.configure(timeout=None if timeout_ms is None else timeout_ms / 1000.0,
+                    retries=retries, logmsg=logmsg, receive_window=credits)
+
+
+def flow_stats():
+    '''Per-peer credits, queue depth and stalls of tagged requests.'''
+    return _tags.flow()
+
+###########################################################################
+# What's known about each peer, from its Link CTL ACK or a predecessor
+# server.  peer_left() when it goes so a newcomer on its ID starts over.
+
+
+def peer_attributes(peer_id, peerattrs):
+    famez_tlv.learn(peer_id, peerattrs)
+    try:
+        credits = int(peerattrs.get('Credits', 0))
+    except ValueError as e:
+        credits = 0
+    _tags.window(peer_id, max(credits, 0))
 
-    if tag is not None:     # zero-length string can trigger this
-        payload += ',Tag=%d' % _next_tag
-        _tagged[str(_next_tag)] = '%d.%d!%s|%s' % (
-            tagCID, tagSID, payload, tag)
-        _next_tag += 1
+
+def peer_left(peer_id):
+    famez_tlv.forget(peer_id)
+    _tags.forget(peer_id)
+    _running.pop(peer_id, None)
+    forget_reassembly(peer_id)
+
+###########################################################################
+
+
+def _prepare_payload(payload, reset_tracker, to_id):
+    '''Returns the bytes to post: TLV if to_id speaks it, else text.'''
+    global _tracker
 
     # Put the tracker on the end where it's easier to find
     if reset_tracker:
         _tracker = 0
     _tracker += 1
-    payload += '%s%d' % (_TRACKER_TOKEN, _tracker)
+    if famez_tlv.speaks(to_id):
+        encoded = famez_tlv.encode(payload, _tracker)
+        if encoded is not None:
+            return encoded
+    return (payload + '%s%d' % (_TRACKER_TOKEN, _tracker)).encode()
+
 
-    ret = MB.fill(from_id, payload)     # True == no timeout, no stomp
-    to_doorbell.ring()
+def send_payload(payload, from_id, to_doorbell, reset_tracker=False,
+                 tag=None, tagCID=0, tagSID=0):
+
+    # PRINT('Send "%s" from %d to %s' % (payload, from_id, vars(to_doorbell)))
+
+    if tag is not None:     # zero-length string can trigger this
+        send_tagged_async(payload, from_id, to_doorbell, tag,
+                          reset_tracker, tagCID, tagSID)
+        return True         # Flow controlled, so maybe not even sent yet
+    payload = _prepare_payload(payload, reset_tracker, to_doorbell.owner_id)
+    if len(payload) >= MB.MS_MAX_BUFLEN:
+        return send_fragments_blocking(payload, from_id, to_doorbell)
+
+    # True == no timeout, no stomp.  Ring mailslots need the receiver.
+    ret = MB.fill(from_id, payload, to_doorbell.owner_id)
+    MB.ring_doorbell(from_id, to_doorbell)
     return ret
 
+###########################################################################
+# The same but never blocks the reactor waiting for the mailslot.  The
+# Deferred fires with the send_payload() return value after the doorbell
+# is rung.  Everything running under the reactor should use this one.
+# Payloads too big for a mailslot are sent as fragments.  A tagged one
+# may wait for a credit first, and its Deferred waits for the Standalone
+# Acknowledgment instead, firing with its fields or with None if it never
+# came.
+
+
+def _ring_after_fill(intime, from_id, to_doorbell):
+    MB.ring_doorbell(from_id, to_doorbell)
+    return intime
+
+
+def _send_async(payload, from_id, to_doorbell, reset_tracker):
+    payload = _prepare_payload(payload, reset_tracker, to_doorbell.owner_id)
+    if len(payload) >= MB.MS_MAX_BUFLEN:
+        return send_fragments(payload, from_id, to_doorbell)
+    d = MB.fill_async(from_id, payload, to_doorbell.owner_id)
+    d.addCallback(_ring_after_fill, from_id, to_doorbell)
+    return d
+
+
+def send_payload_async(payload, from_id, to_doorbell, reset_tracker=False,
+                       tag=None, tagCID=0, tagSID=0):
+    if tag is not None:
+        return send_tagged_async(payload, from_id, to_doorbell, tag,
+                                 reset_tracker, tagCID, tagSID)
+    return _send_async(payload, from_id, to_doorbell, reset_tracker)
+
+
+def send_tagged_async(payload, from_id, to_doorbell, tag='',
+                      reset_tracker=False, tagCID=0, tagSID=0):
+    global _tracker
+
+    if reset_tracker:
+        _tracker = 0
+    return _tags.add(payload, from_id, to_doorbell, tag,
+                     '%d.%d' % (tagCID, tagSID))
+
 ###########################################################################
 # Gen-Z 1.0 "6.8 Standalone Acknowledgment"
 # Received by server/switch
 
 
+@handles('Standalone Acknowledgment')
 def _Standalone_Acknowledgment(response_receiver, args):
-    retval = True
-    tag = False
-    try:
-        kv = CSV2dict(args[0])
-        stamp, tag = _tagged[kv['Tag']].split('|')
-        del _tagged[kv['Tag']]
-        tag = tag.strip()
-        kv = CSV2dict(tag)
-    except KeyError as e:
-        _stdtrace('UNTAGGING %d:%s FAILED' %
-            (response_receiver.from_id, response_receiver.nodename))
-        retval = False
-        kv = {}
+    kv = CSV2dict(args[0]) if args else {}
+    sender = response_receiver.to_doorbell.owner_id
+    tag = _tags.ack(kv.get('Tag', None), sender, kv)
+    if tag is None:     # Never sent, or a retransmission's second ACK
+        _logmsg('Untagging %s from %d failed' % (kv.get('Tag', '?'), sender))
+        return False
 
-    afterACK = kv.get('AfterACK', False)
+    afterACK = CSV2dict(tag).get('AfterACK', False)
     if afterACK:
-        send_payload(afterACK,
-                     response_receiver.from_id,
-                     response_receiver.to_doorbell)
+        send_payload_async(afterACK,
+                           response_receiver.from_id,
+                           response_receiver.to_doorbell)
 
-    if _tagged:
+    if _tags and response_receiver.verbose > 1:
         PRINT('Outstanding tags:')
-        PPRINT(_tagged)
+        PPRINT(_tags.outstanding())
     return 'dump'
 
 
 def _send_SA(RO, tag, reason):
     payload = 'Standalone Acknowledgment Tag=%s,Reason=%s' % (tag, reason)
-    return send_payload(payload, RO.from_id, RO.to_doorbell)
+    return send_payload_async(payload, RO.from_id, RO.to_doorbell)
 
 ###########################################################################
 # Gen-Z 1.0 "11.11 Link CTL" subfield
@@ -156,13 +287,14 @@ def send_LinkACK(RO, details, nack=False):
         payload = 'Link CTL NAK %s' % details
     else:
         payload = 'Link CTL ACK %s' % details
-    return send_payload(payload, RO.from_id, RO.to_doorbell)
+    return send_payload_async(payload, RO.from_id, RO.to_doorbell)
 
 ###########################################################################
 # Gen-Z 1.0 "6.10.1 P2P Core..."
 # Received by client, only really expecting RFC data
 
 
+@handles('CTL-Write')
 def _CTL_Write(RO, args):
     kv = CSV2dict(args[0])
     if int(kv['Space']) != 0:
@@ -176,10 +308,14 @@ def _CTL_Write(RO, args):
 
 ###########################################################################
 # Gen-Z 1.0 "11.6 Link RFC"
-# Received by switch
+# Received by switch.  The CTL-Write may wait for a credit and then for
+# its ACK through a few resends.  As a coroutine the request stays "in
+# progress" until then, so it holds one of the peer's HANDLERS_PER_PEER
+# and a peer can't have more outstanding than that.
 
 
-def _Link_RFC(RO, args):
+@handles('Link RFC')
+async def _Link_RFC(RO, args):
     if not RO.this.isPFM:
         _logmsg('I am not a manager')
         return False
@@ -194,15 +330,17 @@ def _Link_RFC(RO, args):
         return False
     payload = 'CTL-Write Space=0,PFMCID=%d,PFMSID=%d,CID=%d,SID=%d' % (
         RO.this.CID0, RO.this.SID0, RO.proxy.CID0, RO.proxy.SID0)
-    return send_payload(payload, RO.from_id, RO.to_doorbell,
-                        tag='AfterACK=Link CTL Peer-Attribute',
-                        tagCID=RO.this.CID0, tagSID=RO.this.SID0)
+    acked = await send_payload_async(payload, RO.from_id, RO.to_doorbell,
+        tag='AfterACK=Link CTL Peer-Attribute',
+        tagCID=RO.this.CID0, tagSID=RO.this.SID0)
+    return acked is not None    # TagManager logged it if not
 
 ###########################################################################
 # Gen-Z 1.0 "11.11 Link CTL"
 # Entered on both client and server responses.
 
 
+@handles('Link CTL')
 def _Link_CTL(RO, args):
     '''Subelements should be empty.'''
     arg0 = args[0] if len(args) else ''
@@ -210,20 +348,26 @@ def _Link_CTL(RO, args):
         if arg0 == 'Peer-Attribute':
             attrs = 'cclass=%s,CID0=%d,SID0=%d' % (
                 RO.this.cclass, RO.this.CID0, RO.this.SID0)
+            if famez_tlv.offered():
+                attrs += ',Wire=%s' % famez_tlv.WIRE_TLV
+            if _tags.receive_window:
+                attrs += ',Credits=%d' % _tags.receive_window
             return send_LinkACK(RO, attrs)
 
     if arg0 == 'ACK' and len(args) == 2:
         # Update the local proxy values, ASS-U-ME it's peerattrs
-        # FIXME: correlation ala _tagged?  How do I know it's peer attrs?
+        # FIXME: correlation ala _tags?  How do I know it's peer attrs?
         # FIXME: add a key to the response...
+        peerattrs = CSV2dict(args[1])
         if RO.proxy is None:
-            RO.this.peerattrs = CSV2dict(args[1])
+            RO.this.peerattrs = peerattrs
         else:
-            RO.proxy.peerattrs = CSV2dict(args[1])
+            RO.proxy.peerattrs = peerattrs
+        peer_attributes(RO.to_doorbell.owner_id, peerattrs)
         return 'dump'
 
     if arg0 == 'NAK':
-        # FIXME: do I track the sender ala _tagged and deal with it?
+        # FIXME: do I track the sender ala _tags and deal with it?
         PRINT('Got a NAK, not sure what to do with it.')
         return False
 
@@ -234,21 +378,75 @@ def _Link_CTL(RO, args):
 # Finally a home
 
 
+@handles('ping')
 def _ping(RO, args):
-    return send_payload('pong', RO.from_id, RO.to_doorbell)
+    return send_payload_async('pong', RO.from_id, RO.to_doorbell)
 
 
+@handles('dump')
 def _dump(RO, args):
     return 'dump'      # Technically "True", but with baggage
 
 
+###########################################################################
+# Split a raw request into its text and the tracker.  Works on bytes or a
+# memoryview straight out of the mailslot (MB.retrieve_view()); the only
+# copy made is the decode of the payload text.
+
+
+def parse_request(raw):
+    m = _TRACKER_RE.search(raw)
+    if m is None:
+        return str(raw, 'utf-8'), False
+    return str(raw[:m.start()], 'utf-8'), int(m.group(1))
+
 ###########################################################################
 # Chained from EventReader callback in twisted_[client|server].py.
 # Command streams are case-sensitive, read the spec.
-# Return True if successfully parsed and processed.
+# Return True if successfully parsed and processed.  The request can be
+# text, bytes, or a memoryview of the mailslot.  A binary one may be a
+# fragment; it's handled once the last one is in, or TLV (famez_tlv).
+#
+# Coroutine handlers run on the reactor after this returns True, so the
+# mailslot is released (their args are copies) and the doorbell path goes
+# on to the next request.  Each peer gets HANDLERS_PER_PEER of them at a
+# time; up to HANDLER_BACKLOG more wait and the rest are dropped.  Their
+# return value (or that of a Deferred from a plain handler) goes to the
+# response object's deliver() when they finish.
+
+HANDLERS_PER_PEER = 4
+HANDLER_BACKLOG = 64
 
 _logmsg = None
 _stdtrace = None
+_running = {}       # By peer id, DeferredSemaphore
+
+
+def _delivered(ret, RO):
+    if RO.deliver is not None:
+        RO.deliver(ret)
+    return ret
+
+
+def _failed(failure, RO, name):
+    _logmsg('%s for %d failed: %s' % (
+        name, RO.to_doorbell.owner_id, failure.getErrorMessage()))
+    return False
+
+
+def _run_coroutine(handler, RO, args):
+    peer_id = RO.to_doorbell.owner_id
+    running = _running.get(peer_id, None)
+    if running is None:
+        running = _running[peer_id] = DeferredSemaphore(HANDLERS_PER_PEER)
+    if len(running.waiting) >= HANDLER_BACKLOG:
+        _logmsg('%d has too many requests in progress, dropping %s' % (
+            peer_id, handler.__name__))
+        return False
+    d = running.run(lambda: Deferred.fromCoroutine(handler(RO, args)))
+    d.addCallbacks(_delivered, _failed,
+                   callbackArgs=(RO, ), errbackArgs=(RO, handler.__name__))
+    return True
 
 
 def handle_request(request, requester_name, response_object):
@@ -258,11 +456,29 @@ def handle_request(request, requester_name, response_object):
     if _logmsg is None:
         _logmsg = response_object.logmsg   # FIXME: logger.logger...
         _stdtrace = response_object.stdtrace
-
-    elements = request.split(_TRACKER_TOKEN)
-    payload = elements.pop(0)
-    trace = '\n%10s -> "%s"' % (requester_name, payload)
-    EZT = int(elements[0]) if elements else False
+        _tags.configure(logmsg=_logmsg)
+
+    if isinstance(request, str):
+        request = request.encode()
+    elif is_fragment(request):
+        kind, request = reassemble(
+            response_object.to_doorbell.owner_id, request, _logmsg)
+        if kind != KIND_REQUEST:
+            return kind is not None     # Partial or bulk data
+
+    fields = None
+    if famez_tlv.is_tlv(request):
+        try:
+            payload, fields, EZT = famez_tlv.decode(request)
+        except ValueError as e:
+            _logmsg('%s from %s' % (str(e), requester_name))
+            return False
+        famez_tlv.heard(response_object.to_doorbell.owner_id)
+        trace = '\n%10s -> "%s" [TLV]' % (
+            requester_name, famez_tlv.as_text(payload, fields))
+    else:
+        payload, EZT = parse_request(request)
+        trace = '\n%10s -> "%s"' % (requester_name, payload)
     if EZT:
         trace += ' (%d)' % EZT
         _tracker = EZT
@@ -271,7 +487,16 @@ def handle_request(request, requester_name, response_object):
     elements = payload.split()
     try:
         handler, args = chelsea(elements, response_object.verbose)
-        return handler(response_object, args)
+        if fields:
+            args.append(fields)
+        if handler in _coroutines:
+            return _run_coroutine(handler, response_object, args)
+        ret = handler(response_object, args)
+        if isinstance(ret, Deferred):
+            ret.addCallbacks(_delivered, _failed,
+                callbackArgs=(response_object, ),
+                errbackArgs=(response_object, handler.__name__))
+        return ret
     except KeyError as e:
         _logmsg('KeyError: %s' % str(e))
     except Exception as e:
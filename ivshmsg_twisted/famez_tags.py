@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+# Outstanding Gen-Z tags.  A tagged request (eg, the CTL-Write from a Link
+# RFC) waits for its Standalone Acknowledgment.  If that doesn't come back
+# in time the request is sent again, with the same tag, a few times with
+# the timeout doubling each time; then the tag is dropped.  Either way the
+# completion Deferred fires: with the ACK's fields, or None.  The table is
+# capped and the oldest tag is dropped to make room, so lost ACKs can't
+# grow it without bound.
+#
+# Tagged requests are also flow controlled, Gen-Z style.  A peer that
+# advertises a receive window (Peer-Attribute Credits=N) gets at most N
+# unacknowledged tagged requests; the rest wait here, in order, instead of
+# piling into its mailslot until something gets stomped.  An ACK, or the
+# tag giving up, returns the credit.  Peers that advertise nothing get
+# everything at once as before.  Per-peer queue depth and stalls are in
+# flow() for the REST API and dumps.
+#
+# Deadlines live in a hashed timer wheel: SLOTS buckets of TICK seconds,
+# a tag goes in the bucket of its deadline tick and a bucket can hold tags
+# for later turns of the wheel.  One reactor callLater per tick while
+# anything is outstanding, whatever the number of tags, and adding or
+# removing a tag is a set operation.
+
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor as TIreactor
+from twisted.internet.defer import Deferred
+
+
+class _Tag(object):
+
+    def __init__(self, tag, payload, from_id, to_doorbell, stamp, extra,
+                 timeout, retries):
+        self.tag = tag
+        self.payload = payload          # As sent, with the Tag field
+        self.from_id = from_id
+        self.to_doorbell = to_doorbell
+        self.stamp = stamp              # CID.SID of the sender
+        self.extra = extra              # Caller's "tag" string, eg, AfterACK
+        self.timeout = timeout
+        self.retries = retries
+        self.due = 0                    # Tick
+        self.queued = None              # When it had to wait for a credit
+        self.d = Deferred()
+
+
+class _Credits(object):
+
+    def __init__(self, window):
+        self.window = window
+        self.available = window
+        self.queue = deque()            # _Tags waiting for a credit
+        self.stalls = 0                 # Requests that had to wait
+        self.stalled_secs = 0.0
+        self.max_queued = 0
+
+
+class TagManager(object):
+
+    TICK = 0.05             # Seconds
+    SLOTS = 64              # So one turn of the wheel is 3.2 seconds
+
+    def __init__(self, send, timeout=1.0, retries=2, backoff=2.0, limit=256,
+                 logmsg=print, receive_window=0):
+        '''send(payload, from_id, to_doorbell) posts a request.'''
+        self.send = send
+        self.logmsg = logmsg
+        self.receive_window = 0     # What this end advertises, 0 == none
+        self.configure(timeout, retries, backoff, limit, logmsg,
+                       receive_window)
+        self._credits = {}          # By peer id, those with a window
+        self._next_tag = 1          # Gen-Z tag field
+        self._tags = OrderedDict()  # By tag, oldest first
+        self._wheel = [ set() for _ in range(self.SLOTS) ]
+        self._tick = 0              # Last one processed
+        self._timer = None
+
+    def configure(self, timeout=None, retries=None, backoff=None, limit=None,
+                  logmsg=None, receive_window=None):
+        if timeout is not None:
+            assert timeout > 0, 'Tag timeout must be positive'
+            self.timeout = timeout
+        if retries is not None:
+            assert retries >= 0, 'Tag retries cannot be negative'
+            self.retries = retries
+        if backoff is not None:
+            assert backoff >= 1.0, 'Tag backoff cannot shrink the timeout'
+            self.backoff = backoff
+        if limit is not None:
+            assert limit > 0, 'Tag limit must be positive'
+            self.limit = limit
+        if logmsg is not None:
+            self.logmsg = logmsg
+        if receive_window is not None:
+            assert receive_window >= 0, 'Receive window cannot be negative'
+            self.receive_window = receive_window
+
+    def __len__(self):
+        return len(self._tags)
+
+    def _now(self):
+        return int(TIreactor.seconds() / self.TICK)
+
+    def _schedule(self, T):
+        T.due = self._now() + max(1, int(T.timeout / self.TICK + 0.5))
+        self._wheel[T.due % self.SLOTS].add(T.tag)
+        if self._timer is None:
+            self._timer = TIreactor.callLater(self.TICK, self._turn)
+
+    def _unschedule(self, T):
+        self._wheel[T.due % self.SLOTS].discard(T.tag)
+
+    def _turn(self):
+        self._timer = None
+        now = self._now()
+        # After a stall, one turn of the wheel covers everything.
+        first = max(self._tick + 1, now - self.SLOTS + 1)
+        for tick in range(first, now + 1):
+            bucket = self._wheel[tick % self.SLOTS]
+            for tag in [ tag for tag in bucket if self._tags[tag].due <= now ]:
+                bucket.discard(tag)
+                self._expired(self._tags[tag])
+        self._tick = now
+        if self._tags and self._timer is None:
+            self._timer = TIreactor.callLater(self.TICK, self._turn)
+
+    def _expired(self, T):
+        if T.retries:
+            T.retries -= 1
+            T.timeout *= self.backoff
+            self.logmsg('Tag %d to %d timed out, resending' % (
+                T.tag, T.to_doorbell.owner_id))
+            self.send(T.payload, T.from_id, T.to_doorbell)
+            self._schedule(T)
+            return
+        self.logmsg('Tag %d to %d was never acknowledged: %s' % (
+            T.tag, T.to_doorbell.owner_id, T.payload))
+        self._close(T, None)
+
+    def _close(self, T, result):
+        del self._tags[T.tag]
+        peer_id = T.to_doorbell.owner_id
+        C = self._credits.get(peer_id, None)
+        if T.queued is not None:        # Never sent, no credit to give back
+            if C is not None:
+                C.queue.remove(T)
+        elif C is not None:
+            C.available += 1
+            self._drain(peer_id, C)
+        T.d.callback(result)
+
+    def _post(self, T):
+        if not self._tags:
+            self._tick = self._now()
+        self.send(T.payload, T.from_id, T.to_doorbell)
+        self._schedule(T)
+
+    def _drain(self, peer_id, C):
+        now = TIreactor.seconds()
+        while C.queue and C.available > 0:
+            T = C.queue.popleft()
+            C.available -= 1
+            C.stalled_secs += now - T.queued
+            T.queued = None
+            self._post(T)
+
+    def add(self, payload, from_id, to_doorbell, extra, stamp=''):
+        '''Tag payload and send it, or queue it until the peer has a
+           credit.  Returns the completion Deferred.'''
+        while len(self._tags) >= self.limit:
+            T = next(iter(self._tags.values()))
+            self.logmsg('Tag table full, dropping tag %d to %d' % (
+                T.tag, T.to_doorbell.owner_id))
+            if T.queued is None:
+                self._unschedule(T)
+            self._close(T, None)
+        tag = self._next_tag
+        self._next_tag = (self._next_tag % 0xFFFF) + 1
+        payload += ',Tag=%d' % tag
+        T = _Tag(tag, payload, from_id, to_doorbell, stamp, extra,
+                 self.timeout, self.retries)
+        C = self._credits.get(to_doorbell.owner_id, None)
+        if C is not None and (C.queue or C.available <= 0):
+            T.queued = TIreactor.seconds()
+            C.queue.append(T)
+            C.stalls += 1
+            C.max_queued = max(C.max_queued, len(C.queue))
+            self._tags[tag] = T
+            return T.d
+        if C is not None:
+            C.available -= 1
+        self._post(T)
+        self._tags[tag] = T
+        return T.d
+
+    def window(self, peer_id, credits):
+        '''peer_id advertised a receive window, 0 for none.'''
+        C = self._credits.get(peer_id, None)
+        if not credits:
+            if C is not None:
+                del self._credits[peer_id]
+                for T in list(C.queue):
+                    T.queued = None
+                    self._post(T)
+            return
+        if C is None:       # Whatever's outstanding counts against it
+            C = self._credits[peer_id] = _Credits(credits)
+            C.available -= sum(1 for T in self._tags.values()
+                               if T.to_doorbell.owner_id == peer_id)
+        else:
+            C.available += credits - C.window
+            C.window = credits
+        self._drain(peer_id, C)
+
+    def forget(self, peer_id):
+        '''peer_id is gone: so are its window and its tags.'''
+        for T in [ T for T in self._tags.values()
+                   if T.to_doorbell.owner_id == peer_id ]:
+            if T.queued is None:
+                self._unschedule(T)
+            self._close(T, None)
+        self._credits.pop(peer_id, None)
+
+    def flow(self):
+        '''Per-peer flow control state, for monitoring.'''
+        return OrderedDict((str(peer_id), OrderedDict((
+            ('window', C.window),
+            ('available', C.available),
+            ('queued', len(C.queue)),
+            ('max_queued', C.max_queued),
+            ('stalls', C.stalls),
+            ('stalled_secs', round(C.stalled_secs, 3)),
+        ))) for peer_id, C in sorted(self._credits.items()))
+
+    def ack(self, tag, from_id, fields):
+        '''A Standalone Acknowledgment for tag came from from_id.  Returns
+           the caller's extra string, or None if it wasn't outstanding.'''
+        try:
+            T = self._tags[int(tag)]
+        except (KeyError, TypeError, ValueError) as e:
+            return None
+        if T.to_doorbell.owner_id != from_id:
+            return None
+        self._unschedule(T)
+        self._close(T, fields)
+        return T.extra
+
+    def outstanding(self):
+        '''For dumps.'''
+        return OrderedDict((tag, '%s!%s|%s' % (T.stamp, T.payload, T.extra))
+                           for tag, T in self._tags.items())
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+# Binary wire format for the requests in famez_requests.  The text form,
+# eg, "CTL-Write Space=0,PFMCID=500,PFMSID=27,CID=100,SID=27!EZT=3", is an
+# opcode, a CSV of key=value fields and the tracker.  Here that's a fixed
+# header (magic, opcode number, field count, tracker) followed by typed
+# TLV fields: one byte of key, one of length, then the value.  Known keys
+# have a fixed type; ints go little-endian in the fewest of 1, 2, 4 or 8
+# bytes.  Anything else goes as key 0 with "key=value" text.  A request
+# that doesn't fit (an opcode not in the table, odd CSV) is sent as text.
+#
+# It's negotiated per peer.  With --tlv a Link CTL ACK carries Wire=TLV,
+# and the requester that receives it sends TLV from then on.  A peer that
+# sends TLV can obviously read it, so the other direction follows on the
+# first TLV request.  Peers that never say so (the QEMU guest driver) only
+# ever see text.  Decoding is always on.
+
+import struct
+
+TLV_MAGIC = b'!EZB'         # Not the start of any text request
+WIRE_TLV = 'TLV'            # Peer-Attribute value
+
+# Opcodes are the words in front of the CSV; numbers are their index + 1.
+OPCODES = (
+    'Standalone Acknowledgment',
+    'CTL-Write',
+    'Link RFC',
+    'Link CTL Peer-Attribute',
+    'Link CTL ACK',
+    'Link CTL NAK',
+    'ping',
+    'pong',
+    'dump',
+)
+
+# Key numbers are the index; 0 carries its own name.
+KEYS = (
+    (None,      str),
+    ('Tag',     int),
+    ('Reason',  str),
+    ('Space',   int),
+    ('PFMCID',  int),
+    ('PFMSID',  int),
+    ('CID',     int),
+    ('SID',     int),
+    ('TTC',     str),
+    ('cclass',  str),
+    ('CID0',    int),
+    ('SID0',    int),
+    ('Wire',    str),
+    ('Credits', int),
+)
+
+_HDR = struct.Struct('<4sBBI')      # magic, opcode, field count, tracker
+_FIELD = struct.Struct('<BB')       # key, length
+_INT_FIELDS = tuple(                # The whole field in one pack()
+    (-(1 << (8 * size - 1)), 1 << (8 * size - 1), struct.Struct('<BB' + fmt))
+    for size, fmt in ((1, 'b'), (2, 'h'), (4, 'i'), (8, 'q')))
+
+_opcodes = dict((opcode, num) for num, opcode in enumerate(OPCODES, 1))
+_keys = dict((key, (num, kind)) for num, (key, kind) in enumerate(KEYS))
+
+###########################################################################
+# Per-peer negotiation
+
+
+_offered = False    # This end speaks it
+_peers = set()      # Peer ids that speak it
+
+
+def offer(enable=True):
+    global _offered
+    _offered = enable
+
+
+def offered():
+    return _offered
+
+
+def learn(peer_id, peerattrs):
+    '''Peer attributes (a Link CTL ACK) from peer_id.'''
+    if _offered and peerattrs.get('Wire', None) == WIRE_TLV:
+        _peers.add(peer_id)
+
+
+def heard(peer_id):
+    '''peer_id sent a TLV request.'''
+    if _offered:
+        _peers.add(peer_id)
+
+
+def forget(peer_id):
+    _peers.discard(peer_id)
+
+
+def speaks(peer_id):
+    return peer_id in _peers
+
+###########################################################################
+
+
+def is_tlv(buf):
+    return buf[:len(TLV_MAGIC)] == TLV_MAGIC
+
+
+def _field(key, value):
+    key, value = key.strip(), value.strip()     # Like CSV2dict
+    num, kind = _keys.get(key, (0, str))
+    if kind is int:
+        try:
+            intval = int(value)
+        except ValueError as e:
+            intval = None
+        if intval is not None and str(intval) == value:
+            for low, high, field in _INT_FIELDS:
+                if low <= intval < high:
+                    return field.pack(num, field.size - _FIELD.size, intval)
+        num = 0             # Send it as text
+    if num:
+        value = value.encode()
+    else:
+        value = ('%s=%s' % (key, value)).encode()
+    if len(value) > 255:
+        return None
+    return _FIELD.pack(num, len(value)) + value
+
+
+def encode(payload, tracker):
+    '''Returns the TLV bytes for a text payload (without tracker), or
+       None if it has to go as text.'''
+    opcode = _opcodes.get(payload, None)
+    fields = ()
+    if opcode is None:
+        words, _, csv = payload.rpartition(' ')
+        opcode = _opcodes.get(words, None)
+        if opcode is None or '=' not in csv:
+            return None
+        fields = csv.split(',')
+        if len(fields) > 255:
+            return None
+    encoded = [ _HDR.pack(TLV_MAGIC, opcode, len(fields), tracker & 0xFFFFFFFF) ]
+    for field in fields:
+        key, equals, value = field.partition('=')
+        if not equals or '=' in value:
+            return None
+        field = _field(key, value)
+        if field is None:
+            return None
+        encoded.append(field)
+    return b''.join(encoded)
+
+
+def decode(buf):
+    '''Returns (opcode, dict of fields, tracker) from bytes or a memoryview.
+       Raises ValueError if it's mangled.'''
+    try:
+        magic, opcode, count, tracker = _HDR.unpack_from(buf)
+        if not opcode:
+            raise IndexError('opcode 0')
+        opcode = OPCODES[opcode - 1]
+        fields = {}
+        offset = _HDR.size
+        for _ in range(count):
+            num, length = _FIELD.unpack_from(buf, offset)
+            offset += _FIELD.size
+            value = buf[offset:offset + length]
+            if len(value) != length:
+                raise IndexError('field %d truncated' % num)
+            offset += length
+            key, kind = KEYS[num]
+            if kind is int:
+                fields[key] = int.from_bytes(value, 'little', signed=True)
+            elif key is None:
+                key, _, value = str(value, 'utf-8').partition('=')
+                fields[key] = value
+            else:
+                fields[key] = str(value, 'utf-8')
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError('Mangled TLV request: %s' % str(e))
+    return opcode, fields, tracker
+
+
+def as_text(opcode, fields):
+    '''For traces.'''
+    if not fields:
+        return opcode
+    return '%s %s' % (opcode, ','.join(
+        '%s=%s' % (key, value) for key, value in fields.items()))
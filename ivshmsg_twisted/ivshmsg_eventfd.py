@@ -14,8 +14,12 @@
 
 import errno
 import os
+import select
 import struct
 import sys
+import threading
+
+from time import perf_counter
 
 from twisted.internet import reactor as TIreactor   # should be same everywhere
 from twisted.internet.interfaces import IReadDescriptor
@@ -38,9 +42,12 @@ class IVSHMSG_Event_Notifier(object):  # Probably overkill
 
     _libc = cdll.LoadLibrary('libc.so.6')
 
-    def __init__(self, init_val=0, active=False, valid_eventfd = -1):
-        '''valid_eventfd is from client; server always makes a new one.'''
+    def __init__(self, init_val=0, active=False, valid_eventfd = -1,
+                 owner_id=None):
+        '''valid_eventfd is from client; server always makes a new one.
+           owner_id is the peer that is interrupted by this notifier.'''
         self.cbdata = None
+        self.owner_id = owner_id
         if valid_eventfd >= 0:
             self.rfd = self.wfd = valid_eventfd
             return
@@ -99,18 +106,72 @@ class IVSHMSG_Event_Notifier(object):  # Probably overkill
         self.rfd = self.wfd = -1
 
 
-def ivshmsg_event_notifier_list(list_or_count):
+def ivshmsg_event_notifier_list(list_or_count, owner_id=None):
     '''Polymorphic.  If list_or_count is an integer, create that many event
        objects with new fds.  If it's a list of ints, assume they are fds
-       and create a list of objects re-using those ints.'''
+       and create a list of objects re-using those ints.  owner_id is the
+       peer whose doorbells these are (needed to address ring mailslots).'''
     if isinstance(list_or_count, int):
-        return [ IVSHMSG_Event_Notifier()
+        return [ IVSHMSG_Event_Notifier(owner_id=owner_id)
             for _ in range(list_or_count) ]
     if isinstance(list_or_count, (list, tuple)):
-        return [ IVSHMSG_Event_Notifier(valid_eventfd=fd)
+        return [ IVSHMSG_Event_Notifier(valid_eventfd=fd, owner_id=owner_id)
             for fd in list_or_count ]
 
 
+###########################################################################
+# Server-side warm pool of notifier lists so admitting a peer doesn't wait
+# on nVectors eventfd() calls.  Sets are only ever handed out, never taken
+# back: a departed peer's eventfds were advertised to everybody else and
+# might still be rung.  Refills run one set per reactor turn via
+# callLater(0) so they slot in between doorbells and connections.
+
+
+class EventfdPool(object):
+
+    def __init__(self, size, count):
+        '''Keep size lists of count notifiers ready.'''
+        assert size >= 0, 'Pool size must be non-negative'
+        self.size = size
+        self.count = count
+        self._ready = []
+        self._refilling = None
+        while len(self._ready) < self.size:
+            self._ready.append(ivshmsg_event_notifier_list(self.count))
+
+    def take(self, owner_id):
+        '''A list of count notifiers for owner_id, pooled if possible.'''
+        if self._ready:
+            EN_list = self._ready.pop(0)
+            for EN in EN_list:
+                EN.owner_id = owner_id
+        else:
+            EN_list = ivshmsg_event_notifier_list(self.count, owner_id)
+        self._schedule()
+        return EN_list
+
+    def _schedule(self):
+        if self._refilling is None and len(self._ready) < self.size:
+            self._refilling = TIreactor.callLater(0, self._refill)
+
+    def _refill(self):
+        self._refilling = None
+        try:
+            self._ready.append(ivshmsg_event_notifier_list(self.count))
+        except Exception as e:      # Out of fds; take() will try again
+            return
+        self._schedule()
+
+    def cleanup(self):
+        if self._refilling is not None and self._refilling.active():
+            self._refilling.cancel()
+        self._refilling = None
+        for EN_list in self._ready:
+            for EN in EN_list:
+                EN.cleanup()
+        self._ready = []
+
+
 ###########################################################################
 # https://stackoverflow.com/questions/28449455/integrating-hid-access-with-evdev-on-linux-with-python-twisted
 
@@ -153,3 +214,200 @@ class EventfdReader(object):
         TIreactor.removeReader(self)
         self.loseConnection()
 
+
+###########################################################################
+# Alternative to one EventfdReader per doorbell: a thread with a single
+# epoll set over all of them, so doorbell latency doesn't depend on what
+# else the reactor is doing.  With busy_poll (microseconds) it first spins
+# on the doorbells, and the mailslots via pending(eventobj) if given, and
+# only then sleeps in epoll.
+# Whatever fired is handed to the reactor as one batch; callbacks always
+# run in the reactor thread.  add() and remove() come from the reactor as
+# peers come and go, so the doorbell table is under a lock.
+
+
+class EventfdDispatcher(object):
+
+    def __init__(self, busy_poll=0, pending=None):
+        assert busy_poll >= 0, 'busy_poll must be >= 0'
+        self.busy_poll = busy_poll / 1000000.0
+        self.pending = pending
+        self.epoll = select.epoll()
+        self.byfd = {}          # fd -> (eventobj, callback)
+        self.lock = threading.Lock()    # For byfd and the epoll set
+        self.inflight = set()   # Handed to the reactor, not yet called back
+        self.thread = None
+        self.stopping = False
+        self.waker = IVSHMSG_Event_Notifier()
+        self.epoll.register(self.waker.get_fd(), select.EPOLLIN)
+
+    def add(self, eventobj, callback, cbdata):
+        '''Same arguments as EventfdReader.'''
+        assert isinstance(eventobj, IVSHMSG_Event_Notifier), 'Bad object'
+        eventobj.cbdata = cbdata
+        eventobj.last_value = None
+        fd = eventobj.get_fd()
+        with self.lock:
+            if fd not in self.byfd:
+                self.epoll.register(fd, select.EPOLLIN)
+            self.byfd[fd] = (eventobj, callback)
+
+    def remove(self, eventobj):
+        '''Stop watching eventobj, eg, its peer left.  add() it again to
+           resume.  Anything already handed to the reactor is dropped.'''
+        fd = eventobj.get_fd()
+        with self.lock:
+            if self.byfd.pop(fd, None) is not None:
+                self.epoll.unregister(fd)
+
+    def start(self):
+        self.stopping = False           # Might be a restart
+        self.thread = threading.Thread(
+            target=self._run, name='EventfdDispatcher', daemon=True)
+        self.thread.start()
+        TIreactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.waker.ring()
+        self.thread.join()
+        self.thread = None
+
+    def _spin(self):
+        '''Busy-poll window.  Returns ready eventobjs and epoll events.'''
+        with self.lock:
+            waiting = list(self.byfd.values())
+        deadline = perf_counter() + self.busy_poll
+        while perf_counter() < deadline:
+            events = self.epoll.poll(0)
+            if events:
+                return [], events
+            if self.pending is None:
+                continue
+            batch = [ entry for entry in waiting
+                      if entry[0] not in self.inflight and
+                         self.pending(entry[0]) ]
+            if batch:
+                return batch, []
+        return [], self.epoll.poll()
+
+    def _run(self):
+        spin = True
+        while not self.stopping:
+            try:
+                self._once(spin)
+                spin = True
+            except Exception as e:
+                # An exception would end the thread and with it every
+                # doorbell.  Log it and carry on; the next pass skips the
+                # busy-poll window (pending() is the likely culprit) and
+                # sleeps in epoll so a persistent error can't spin.
+                print('EventfdDispatcher: %s: %s' % (
+                    type(e).__name__, str(e)), file=sys.stderr)
+                spin = False
+
+    def _once(self, spin=True):
+        if self.busy_poll and spin:
+            batch, events = self._spin()
+        else:
+            batch, events = [], self.epoll.poll()
+        for fd, mask in events:
+            if fd == self.waker.get_fd():
+                self.waker.reset()
+                continue
+            with self.lock:
+                entry = self.byfd.get(fd, None)
+            if entry is None:       # Removed since the poll
+                continue
+            eventobj, callback = entry
+            fired, value = eventobj.reset()
+            if fired:
+                eventobj.last_value = value
+                if (eventobj, callback) not in batch:
+                    batch.append((eventobj, callback))
+        if batch:
+            self.inflight.update(entry[0] for entry in batch)
+            TIreactor.callFromThread(self._deliver, batch)
+
+    def _deliver(self, batch):
+        for eventobj, callback in batch:
+            with self.lock:     # Not removed in the meantime?
+                live = self.byfd.get(eventobj.get_fd(), (None, ))[0]
+            try:
+                if live is eventobj:
+                    callback(eventobj)
+            finally:
+                self.inflight.discard(eventobj)
+
+###########################################################################
+# NIC-style interrupt moderation around a doorbell callback.  On a doorbell
+# the sender is disarmed (it stops ringing) and the callback is rerun from
+# the reactor until max_count messages were handled (0 == no limit) or
+# max_usecs have passed, then the doorbell is re-armed.  The callables:
+#   callback(eventobj) returns the number of messages it handled
+#   disarm(eventobj)
+#   rearm(eventobj) returns True if something arrived that won't ring
+
+
+class DoorbellModerator(object):
+
+    def __init__(self, callback, disarm, rearm, max_count=64, max_usecs=100):
+        assert max_usecs > 0, 'Moderation needs a time limit'
+        self.callback = callback
+        self.disarm = disarm
+        self.rearm = rearm
+        self.max_count = max_count
+        self.max_usecs = max_usecs / 1000000.0
+        self.active = {}        # eventobj -> [ started, count ]
+
+    def __call__(self, eventobj):
+        if eventobj in self.active:     # Rung before the disarm was seen
+            return
+        self.disarm(eventobj)
+        self.active[eventobj] = [ perf_counter(), 0 ]
+        self._poll(eventobj)
+
+    def _poll(self, eventobj):
+        state = self.active[eventobj]
+        state[1] += self.callback(eventobj) or 0
+        if (not self.max_count or state[1] < self.max_count) and \
+           perf_counter() - state[0] < self.max_usecs:
+            TIreactor.callLater(0, self._poll, eventobj)
+            return
+        del self.active[eventobj]
+        if self.rearm(eventobj):
+            self(eventobj)
+
+###########################################################################
+# Shared-doorbell receivers: one eventfd for all senders.  senders() says
+# who rang (and forgets it); the callback is then run once per sender with
+# a stand-in vector object carrying that sender's "num", just like a
+# per-sender doorbell would.
+
+
+class _SenderVector(object):
+
+    def __init__(self, num, cbdata):
+        self.num = num
+        self.cbdata = cbdata
+        self.last_value = None
+
+
+class SharedDoorbellDemux(object):
+
+    def __init__(self, callback, senders):
+        self.callback = callback
+        self.senders = senders
+        self.vectors = {}
+
+    def __call__(self, eventobj):
+        handled = 0
+        for num in self.senders():
+            vector = self.vectors.get(num)
+            if vector is None:
+                vector = self.vectors[num] = _SenderVector(num, eventobj.cbdata)
+            vector.last_value = eventobj.last_value
+            handled += self.callback(vector) or 0
+        return handled
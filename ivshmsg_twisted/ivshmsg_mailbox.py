@@ -7,26 +7,89 @@
 # entry "nClients + 1" is the server mailslot.  This is contiguous because it
 # it aligns with how QEMU expects delivery of peer info, including the twisted
 # server (which is an extension beyond stock QEMU IVSHMSG protocol).
-# Right now a mailslot is 512 bytes: 128 bytes of metadata (currently about
-# 96 used), then 384 of message buffer.
-# Go for the max slots in the file to hardwire libvirt domain XML file size.
-# VM guest kernel modules read global data to understand the mailbox layout.
+# By default a mailslot is 512 bytes: 128 bytes of metadata (currently about
+# 96 used), then 384 of message buffer.  The server can be told to use a
+# bigger message buffer and more clients; the slot size and slot count are
+# then rounded up to powers of two to keep QEMU happy.  There are never
+# fewer than 16 slots so the default file size is the one hardwired into
+# existing libvirt domain XML files.
+# VM guest kernel modules and clients read global data to understand the
+# mailbox layout, nothing else should be assumed.
+
+# In "ring" layout the message buffer of a slot is instead a ring of message
+# cells.  The slot owner is the only producer: it fills a cell, tags it with
+# the destination peer id, and advances "head".  Each cell is consumed by
+# exactly one receiver (its "dest"), which marks it done.  Only the producer
+# advances "tail", reclaiming done cells in order.  A sender can then have
+# several messages in flight and a receiver drains all of its pending cells
+# on one doorbell.  The slot grows to hold the ring so it's a bigger file.
+
+# Each slot has a sequence lock for lockless readers of its metadata and
+# message.  The slot owner (or the server on its behalf) makes it odd before
+# a change and even again after; a reader that sees it odd, or changed
+# across its reads, tries again.  Clearing buflen by the receiver is the
+# handshake back to the owner and doesn't take part.
+
+# In "isolated" layout every cacheline of the slot has one writer.  The
+# owner's hot fields (buflen, seqlock, the "posted" count) keep the second
+# line of the 128-byte metadata; the receiver gets the next 64-byte line
+# to itself and acknowledges by copying "posted" into "acked" instead of
+# clearing buflen.  The message buffer then starts at 192.  The guest
+# driver only speaks legacy so it's for client/server setups.
+
+# The mailbox can be backed by hugetlbfs instead of /dev/shm and bound to a
+# NUMA node so the server, clients and VM vCPUs on that socket stay local.
+
+# Traffic counters (server --stats) live in a stats region after the last
+# slot, one 64-byte entry per id at stats_offset (0 == no counters).  Only
+# the process owning an id writes its entry: send side counts from fill(),
+# receive side from retrieve() and release().  The region uses spare slots
+# when there are enough, else the file doubles to stay a power of two; with
+# the default 14 clients that's 16K instead of 8K, so the size= in the
+# libvirt XML has to follow.  That's why it's off by default.
+
+# Doorbell moderation (ring layout only, where every message says who it's
+# for): a receiver sets the sender's bit in its own slot's "draining" map
+# while it polls that sender's ring, and senders skip the eventfd write
+# for a receiver whose bit is set.  Clearing the bit re-arms the doorbell;
+# the receiver then looks once more for anything that slipped in.  The
+# guest driver never sets it so it always gets its interrupts.
+
+# Shared-doorbell mode (pending_offset != 0) gives each peer one eventfd
+# instead of nEvents of them.  A sender sets its byte in the receiver's row
+# of the pending map and rings the receiver's only doorbell; the receiver
+# clears the bytes it finds set and handles those senders.  Bytes, not
+# bits, so every writer owns what it writes.  Rows are cacheline-sized
+# multiples.  Stock QEMU guests need the per-sender vectors so it's for
+# our own peers.
+
+# The server is the only writer of the globals.  Unless it's silent it
+# keeps active_map (which slots have a nodename) current and bumps
+# generation whenever it sees a name or cclass change.  It only looks when
+# a peer talks to it, and a guest driver rewrites its own names at probe,
+# so name lookups are cached against the generation and every slot's
+# seqlock: a slot whose seqlock moved is re-read.
 
 # All numbers are unsigned of an appropriate size.  All strings are multiples
 # of 32 (including the C terminating NULL) on 32-byte boundaries.  Then it
 # all looks good in "od -Ad -c" and even better in "od -Ax -c -tu8 -tx8".
 
 import ctypes
+import fcntl
 import mmap
 import os
 import struct
 import sys
 
+from collections import deque, OrderedDict
 from os.path import stat as STAT    # for constants
 from pdb import set_trace
 from time import sleep
 from time import time as NOW
 
+from twisted.internet import reactor as TIreactor
+from twisted.internet.defer import Deferred, succeed
+
 
 class IVSHMSG_MailGlobals(ctypes.Structure):
     _fields_ = [        # A magic ctypes class attribute.
@@ -35,14 +98,23 @@ class IVSHMSG_MailGlobals(ctypes.Structure):
         ('nClients',    ctypes.c_ulonglong),
         ('nEvents',     ctypes.c_ulonglong),
         ('server_id',   ctypes.c_ulonglong),
+        ('layout',      ctypes.c_ulonglong),    # IVSHMSG_MailBox.LAYOUT_xxx
+        ('ring_cells',  ctypes.c_ulonglong),    # 0 unless LAYOUT_RING
+        ('ring_cellsize', ctypes.c_ulonglong),
+        ('nSlots',      ctypes.c_ulonglong),    # Power of two >= nEvents
+        ('active_map',  ctypes.c_ulonglong),    # Bit per id with a nodename
+        ('generation',  ctypes.c_ulonglong),    # 0 == map not maintained
+        ('stats_offset', ctypes.c_ulonglong),   # IVSHMSG_SlotStats[nEvents]
+        ('pending_offset', ctypes.c_ulonglong), # 0 == a doorbell per sender
     ]
 
 
 class IVSHMSG_MailSlot(ctypes.Structure):
-    # c_char_p is variable length so force fixed size fields.
+    # c_char_p is variable length so force fixed size fields.  The message
+    # buffer follows at buf_offset; its size depends on the geometry so it
+    # gets a separate overlay.
 
     _strsize = 32
-    _bufsize = 384
 
     _fields_ = [            # A magic ctypes class attribute.
         ('_nodename',       ctypes.c_char * _strsize),
@@ -52,17 +124,50 @@ class IVSHMSG_MailSlot(ctypes.Structure):
         ('last_responder',  ctypes.c_ulonglong),
         ('peer_SID',        ctypes.c_ulonglong),
         ('peer_CID',        ctypes.c_ulonglong),
-        ('pad',             ctypes.c_ulonglong * 3),
-        ('buf',             ctypes.c_char * _bufsize)
+        ('seqlock',         ctypes.c_ulonglong),    # Odd == being written
+        ('posted',          ctypes.c_ulonglong),    # Isolated layout only
+        ('draining',        ctypes.c_ulonglong),    # Bit per sender, see below
     ]
 
+    # A writer killed between the two leaves it odd; the next write_begin()
+    # (eg, clear_mailslot() from the server) keeps it odd, then evens it up.
+
+    def write_begin(self):
+        self.seqlock |= 1
+
+    def write_end(self):
+        self.seqlock += 1
+
+    _read_tries = 1000      # Then take what's there; the writer is gone
+
+    def read_consistent(self, reader):
+        '''Return reader(self) from a pass with no concurrent write.'''
+        for _ in range(self._read_tries):
+            seq = self.seqlock
+            if seq & 1:
+                continue
+            value = reader(self)
+            if self.seqlock == seq:
+                return value
+        return reader(self)
+
+    def snapshot(self):
+        '''Consistent nodename, cclass and buflen as a dict.'''
+        return self.read_consistent(lambda s: {
+            'nodename': ctypes.string_at(s._nodename).decode(),
+            'cclass': ctypes.string_at(s._cclass).decode(),
+            'buflen': s.buflen,
+        })
+
     @property
     def nodename(self):
-        return ctypes.string_at(self._nodename).decode()
+        return self.read_consistent(
+            lambda s: ctypes.string_at(s._nodename).decode())
 
     @property
     def cclass(self):
-        return ctypes.string_at(self._cclass).decode()
+        return self.read_consistent(
+            lambda s: ctypes.string_at(s._cclass).decode())
 
     # This does not blank pad to the end, properly detects overrun, and
     # lays down a NUL properly UNLESS the entire space is filled.  Help
@@ -72,24 +177,175 @@ class IVSHMSG_MailSlot(ctypes.Structure):
     def nodename(self, instr):
         inbytes = instr.encode()
         assert self._strsize > len(inbytes), '"%s" too big' % instr
+        self.write_begin()
         self._nodename = inbytes
+        self.write_end()
 
     @cclass.setter
     def cclass(self, instr):
         inbytes = instr.encode()
         assert self._strsize > len(inbytes), '"%s" too big' % instr
+        self.write_begin()
         self._cclass = inbytes
+        self.write_end()
+
+
+# Isolated layout: the receiver's line, right after the slot metadata.
+
+
+class IVSHMSG_SlotAck(ctypes.Structure):
+    _fields_ = [            # A magic ctypes class attribute.
+        ('acked',           ctypes.c_ulonglong),    # Last "posted" consumed
+        ('pad',             ctypes.c_ulonglong * 7),
+    ]
+
+
+# Stats region entry, one cacheline each.
+
+
+class IVSHMSG_SlotStats(ctypes.Structure):
+    _fields_ = [            # A magic ctypes class attribute.
+        ('msgs_sent',       ctypes.c_ulonglong),
+        ('bytes_sent',      ctypes.c_ulonglong),
+        ('stomps',          ctypes.c_ulonglong),    # fill() timeouts
+        ('waits',           ctypes.c_ulonglong),    # fill()s that found it busy
+        ('wait_usecs',      ctypes.c_ulonglong),    # Total time spent busy
+        ('msgs_rcvd',       ctypes.c_ulonglong),
+        ('bytes_rcvd',      ctypes.c_ulonglong),
+        ('pad',             ctypes.c_ulonglong),
+    ]
+
+    def asdict(self):
+        return dict((f[0], getattr(self, f[0])) for f in self._fields_
+                    if f[0] != 'pad')
+
+
+# Ring layout: the header sits at the start of the slot message buffer
+# (buf_offset) and is followed by ring_cells cells.  Sequence numbers are
+# one-based so a zeroed cell never looks consumed.
+
+
+class IVSHMSG_RingHeader(ctypes.Structure):
+    _fields_ = [            # A magic ctypes class attribute.
+        ('head',            ctypes.c_ulonglong),    # Next cell to post
+        ('tail',            ctypes.c_ulonglong),    # Oldest unreclaimed cell
+        ('pad',             ctypes.c_ulonglong * 2),
+    ]
+
+
+# Cells carry a whole message so their size follows the geometry too.
+
+_ring_cell_types = {}
+
+def IVSHMSG_RingCell(bufsize):
+    '''Return the cell structure for a message buffer of bufsize bytes.'''
+    try:
+        return _ring_cell_types[bufsize]
+    except KeyError as e:
+        pass
+
+    class _RingCell(ctypes.Structure):
+        _fields_ = [        # A magic ctypes class attribute.
+            ('seq',             ctypes.c_ulonglong),    # Written by producer
+            ('done',            ctypes.c_ulonglong),    # Set to seq by consumer
+            ('dest',            ctypes.c_ulonglong),
+            ('buflen',          ctypes.c_ulonglong),
+            ('buf',             ctypes.c_char * bufsize)
+        ]
+
+    _ring_cell_types[bufsize] = _RingCell
+    return _RingCell
+
+
+def _pow2(n):
+    '''Round n up to a power of two.'''
+    return 1 << (int(n) - 1).bit_length()
+
+class _SharedDoorbell(object):
+    '''Quacks like IVSHMSG_Event_Notifier for a sender.'''
+
+    def __init__(self, EN, sender_id):
+        self.EN = EN
+        self.sender_id = sender_id
+        self.owner_id = EN.owner_id
+
+    def ring(self):
+        IVSHMSG_MailBox.set_pending(self.owner_id, self.sender_id)
+        return self.EN.ring()
+
+###########################################################################
+# Backing store placement.  mbind() isn't in glibc (it's in libnuma which
+# may not be installed) so go straight to the syscall.
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+_NR_mbind = {
+    'x86_64':   237,
+    'aarch64':  235,
+}.get(os.uname().machine)
+
+_MPOL_BIND = 2
+_MPOL_MF_MOVE = 2       # Pages already faulted in follow the policy
+
+
+def _hugetlbfs_pagesize(path):
+    '''Huge page size of the hugetlbfs holding directory path.'''
+    path = os.path.realpath(path)
+    with open('/proc/mounts') as f:
+        mounts = [ line.split()[1] for line in f
+                   if line.split()[2] == 'hugetlbfs' ]
+    assert path in mounts, '%s is not a hugetlbfs mount' % path
+    return os.statvfs(path).f_bsize
+
+
+def _numa_cpus(node):
+    '''Set of CPUs on a NUMA node from its sysfs cpulist ("0-3,8-11").'''
+    try:
+        with open('/sys/devices/system/node/node%d/cpulist' % node) as f:
+            cpulist = f.read().strip()
+    except OSError as e:
+        raise RuntimeError('No NUMA node %d' % node)
+    cpus = set()
+    for chunk in cpulist.split(','):
+        lo, _, hi = chunk.partition('-')
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def _mbind(addr, length, node):
+    '''Bind [addr, addr + length) to node.  Returns False if unsupported.'''
+    if _NR_mbind is None:
+        return False
+    nodemask = (ctypes.c_ulong * (node // 64 + 1))()
+    nodemask[node // 64] = 1 << (node % 64)
+    ret = _libc.syscall(_NR_mbind, ctypes.c_void_p(addr),
+        ctypes.c_ulong(length), _MPOL_BIND, nodemask,
+        ctypes.c_ulong(len(nodemask) * 64 + 1), _MPOL_MF_MOVE)
+    if ret:
+        errno = ctypes.get_errno()
+        if errno == 38:     # ENOSYS, eg, no CONFIG_NUMA
+            return False
+        raise OSError(errno, 'mbind: %s' % os.strerror(errno))
+    return True
 
 
 class IVSHMSG_MailBox(object):
 
     # QEMU rules: file size (product of first two) must be a power of two.
+    # These are the defaults; the server recalculates them in _set_geometry()
+    # and clients pick them up from the globals in _init_mailslot().
+    MAILBOX_MIN_SLOTS = 16
     MAILBOX_MAX_SLOTS = 16    # Dummy + server leaves 14 actual clients
     MAILBOX_SLOTSIZE = 512
     FILESIZE = MAILBOX_MAX_SLOTS * MAILBOX_SLOTSIZE
-    MS_BUF_off = 128
+    MS_BUF_off = ctypes.sizeof(IVSHMSG_MailSlot)
     MS_MAX_BUFLEN = 384
     assert MAILBOX_SLOTSIZE == MS_BUF_off + MS_MAX_BUFLEN, 'Big oops. Huge!'
+    MS_MSGSIZE_MAX = 64 * 1024
+
+    LAYOUT_LEGACY = 0
+    LAYOUT_RING = 1
+    LAYOUT_ISOLATED = 2
 
     fd = None       # There can be only one
     mm = None       # Then I can access fill() from the class
@@ -97,6 +353,147 @@ class IVSHMSG_MailBox(object):
     nEvents = None
     server_id = None
     slots = None      # 0 == MailGlobal, 1 - server_id == MailSlot
+    bufs = None       # Message buffer of each MailSlot
+    acks = None       # Receiver line of each MailSlot in isolated layout
+    stats = None      # IVSHMSG_SlotStats by id, slot 0 unused, or None
+    stats_offset = 0
+    pending_offset = 0
+    pendmap = None    # Shared-doorbell rows by receiver id
+    nVectors = None   # eventfds per peer: nEvents, or 1 with shared doorbells
+    layout = LAYOUT_LEGACY
+    ring_cells = 0
+    RingCell = None
+    rings = None      # Per slot (header, [cells]) in ring layout
+
+    # fill_async() polling: first retry interval, doubling up to the max.
+    SEND_POLL_MIN = 0.002
+    SEND_POLL_MAX = 0.1
+    _sendq = {}       # By sender_id, FIFO of messages waiting for the slot
+    _sendq_armed = set()    # sender_ids with a _drain_sendq() scheduled
+
+    _published = {}   # Server: id -> (nodename, cclass) behind active_map
+    _shared_ids = frozenset()   # Written by several processes, see share_id()
+    _index = None     # Everybody: see _name_index()
+
+    #-----------------------------------------------------------------------
+    # The file size depends on the client count, message size and layout so
+    # it's figured out before the backing file is created or validated.
+    # args.msgsize is the largest message wanted; the result may be bigger.
+
+    @classmethod
+    def _set_geometry(cls, args):
+        msgsize = getattr(args, 'msgsize', 0) or cls.MS_MAX_BUFLEN
+        assert cls.MS_MAX_BUFLEN <= msgsize <= cls.MS_MSGSIZE_MAX, \
+            'msgsize is out of range %d - %d' % (
+                cls.MS_MAX_BUFLEN, cls.MS_MSGSIZE_MAX)
+        cls.MAILBOX_MAX_SLOTS = max(cls.MAILBOX_MIN_SLOTS, _pow2(args.nEvents))
+        cls.MS_BUF_off = ctypes.sizeof(IVSHMSG_MailSlot)
+
+        cls.ring_cells = getattr(args, 'ring', 0) or 0
+        if getattr(args, 'isolate', False):
+            assert not cls.ring_cells, 'Ring and isolated layouts conflict'
+            cls.layout = cls.LAYOUT_ISOLATED
+            cls.MS_BUF_off += ctypes.sizeof(IVSHMSG_SlotAck)
+            cls.MAILBOX_SLOTSIZE = _pow2(cls.MS_BUF_off + msgsize)
+            cls.MS_MAX_BUFLEN = cls.MAILBOX_SLOTSIZE - cls.MS_BUF_off
+        elif not cls.ring_cells:
+            cls.layout = cls.LAYOUT_LEGACY
+            cls.MAILBOX_SLOTSIZE = _pow2(cls.MS_BUF_off + msgsize)
+            cls.MS_MAX_BUFLEN = cls.MAILBOX_SLOTSIZE - cls.MS_BUF_off
+        else:
+            assert 2 <= cls.ring_cells <= 64, \
+                'ring depth is out of range 2 - 64'
+            cls.layout = cls.LAYOUT_RING
+            cls.MS_MAX_BUFLEN = (msgsize + 7) & ~7      # Keep cells aligned
+            cls.RingCell = IVSHMSG_RingCell(cls.MS_MAX_BUFLEN)
+            cls.MAILBOX_SLOTSIZE = _pow2(cls.MS_BUF_off +
+                ctypes.sizeof(IVSHMSG_RingHeader) +
+                cls.ring_cells * ctypes.sizeof(cls.RingCell))
+        cls.FILESIZE = cls.MAILBOX_MAX_SLOTS * cls.MAILBOX_SLOTSIZE
+
+        end = args.nEvents * cls.MAILBOX_SLOTSIZE
+        cls.stats_offset = 0
+        if getattr(args, 'stats', False):
+            cls.stats_offset = end
+            end += cls._stats_size(args.nEvents)
+        cls.pending_offset = 0
+        cls.nVectors = args.nEvents
+        if getattr(args, 'shared_doorbell', False):
+            cls.pending_offset = end
+            cls.nVectors = 1
+            end += cls._pendmap_size(args.nEvents)
+        while end > cls.FILESIZE:
+            cls.FILESIZE *= 2
+
+    @staticmethod
+    def _stats_size(nEvents):
+        return nEvents * ctypes.sizeof(IVSHMSG_SlotStats)
+
+    @staticmethod
+    def _pendmap_rowsize(nEvents):
+        return (nEvents + 63) & ~63
+
+    @classmethod
+    def _pendmap_size(cls, nEvents):
+        return nEvents * cls._pendmap_rowsize(nEvents)
+
+    #-----------------------------------------------------------------------
+    # Overlay each slot with its metadata, and its message buffer or ring
+    # header and cells.  Common to server and client once the globals are
+    # trustworthy.
+
+    @classmethod
+    def _overlay_slots(cls, view, mbg):
+        cls.view = view
+        cls._view_addr = ctypes.addressof(ctypes.c_char.from_buffer(view))
+        slotsize = mbg.slotsize
+        buf_offset = mbg.buf_offset
+        cls.slots = [ None, ] * cls.nEvents
+        cls.slots[0] = mbg
+        cls.bufs = [ None, ] * cls.nEvents
+        cls.acks = [ None, ] * cls.nEvents
+        cls.rings = [ None, ] * cls.nEvents
+        acksize = ctypes.sizeof(IVSHMSG_SlotAck)
+        hdrsize = ctypes.sizeof(IVSHMSG_RingHeader)
+        if cls.layout == cls.LAYOUT_RING:
+            cellsize = ctypes.sizeof(cls.RingCell)
+        BufType = ctypes.c_char * cls.MS_MAX_BUFLEN
+        for slot in range(1, cls.nEvents):
+            off = slotsize * slot
+            cls.slots[slot] = IVSHMSG_MailSlot.from_buffer(
+                view[off:off + buf_offset])
+            if cls.layout == cls.LAYOUT_ISOLATED:
+                ackoff = off + buf_offset - acksize
+                cls.acks[slot] = IVSHMSG_SlotAck.from_buffer(
+                    view[ackoff:ackoff + acksize])
+            off += buf_offset
+            if cls.layout != cls.LAYOUT_RING:
+                cls.bufs[slot] = BufType.from_buffer(
+                    view[off:off + cls.MS_MAX_BUFLEN])
+                continue
+            header = IVSHMSG_RingHeader.from_buffer(view[off:off + hdrsize])
+            off += hdrsize
+            cells = [ cls.RingCell.from_buffer(
+                view[off + i * cellsize:off + (i + 1) * cellsize])
+                for i in range(cls.ring_cells) ]
+            cls.rings[slot] = (header, cells)
+
+        cls.stats = None
+        if mbg.stats_offset:
+            statsize = ctypes.sizeof(IVSHMSG_SlotStats)
+            off = mbg.stats_offset
+            cls.stats = [ IVSHMSG_SlotStats.from_buffer(
+                view[off + i * statsize:off + (i + 1) * statsize])
+                for i in range(cls.nEvents) ]
+
+        cls.pendmap = None
+        if mbg.pending_offset:
+            rowsize = cls._pendmap_rowsize(cls.nEvents)
+            RowType = ctypes.c_ubyte * rowsize
+            off = mbg.pending_offset
+            cls.pendmap = [ RowType.from_buffer(
+                view[off + i * rowsize:off + (i + 1) * rowsize])
+                for i in range(cls.nEvents) ]
 
     #-----------------------------------------------------------------------
     # Slots[] array: Globals at offset 0 (slot 0; each slot (1 through
@@ -112,12 +509,32 @@ class IVSHMSG_MailBox(object):
         # view is an overlay, especially when combined with ctype structures.
         cls.mm = mmap.mmap(cls.fd, 0)
         cls.view = memoryview(cls.mm)
-        cls.slots = [ None, ] * cls.nEvents
+        addr = ctypes.addressof(ctypes.c_char.from_buffer(cls.view))
 
-        # Empty it.  Simple code that's never too demanding on size,
-        # default of 16 slots == now 32k.
-        data = b'\0' * cls.FILESIZE
-        cls.mm[0:len(data)] = data
+        # With a NUMA node, bind the pages there (moving any that are
+        # already in) and do the first touch from one of its CPUs, which
+        # also works where mbind() doesn't.
+        node = getattr(args, 'numa_node', -1)
+        if node is not None and node >= 0:
+            cpus = _numa_cpus(node)
+            if not _mbind(addr, len(cls.mm), node):
+                print('mbind() unavailable, first-touch only on node', node)
+
+        if getattr(args, 'warm', False) and cls._attach_mailbox(args):
+            return
+        assert not getattr(args, 'takeover', False), \
+            'Takeover needs the mailbox exactly as the running server has it'
+
+        # Empty it in place, which is also the first touch of every page.
+        if node is None or node < 0:
+            ctypes.memset(addr, 0, len(cls.mm))
+        else:
+            oldcpus = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cpus)
+            try:
+                ctypes.memset(addr, 0, len(cls.mm))
+            finally:
+                os.sched_setaffinity(0, oldcpus)
 
         # Fill in the globals; used by ivshmsg.ko and the C struct globals.
         # It's at the start of the memory area so no indexing is needed.
@@ -127,14 +544,19 @@ class IVSHMSG_MailBox(object):
         mbg.nClients = cls.nClients
         mbg.nEvents = cls.nEvents
         mbg.server_id = cls.server_id
-        cls.slots[0] = mbg
+        mbg.layout = cls.layout
+        mbg.ring_cells = cls.ring_cells
+        mbg.ring_cellsize = ctypes.sizeof(cls.RingCell) \
+            if cls.ring_cells else 0
+        mbg.nSlots = cls.MAILBOX_MAX_SLOTS
+        mbg.stats_offset = cls.stats_offset
+        mbg.pending_offset = cls.pending_offset
 
         # Get a data structure overlay for each slot, then set the peer_id
         # as a sentinel for other code.  Don't forget the server.
 
+        cls._overlay_slots(cls.view, mbg)
         for slot in range(1, cls.nEvents):
-            cls.slots[slot] = IVSHMSG_MailSlot.from_buffer(
-                cls.view[mbg.slotsize * slot : mbg.slotsize * (slot + 1)])
             cls.slots[slot].peer_id = slot
 
         # Server's "hostname" and Base Component Class.  Zero-padding occurs
@@ -142,6 +564,81 @@ class IVSHMSG_MailBox(object):
         name = 'Z-switch' if args.smart else 'Z-server'
         cls.slots[cls.server_id].nodename = name
         cls.slots[cls.server_id].cclass = 'FabricSwitch'
+        if not getattr(args, 'silent', False):
+            mbg.generation = 1
+            cls.refresh_active(cls.server_id)
+
+    #----------------------------------------------------------------------
+    # Warm restart: VMs that were attached to the previous server still map
+    # this file and keep using it, so adopt it instead of zeroing it.  The
+    # globals must describe exactly the geometry asked for, otherwise it's
+    # a cold start.  Returns True if the mailbox was adopted.
+
+    warm_ids = frozenset()  # Live peers found at a warm restart
+
+    @classmethod
+    def _attach_mailbox(cls, args):
+        if len(cls.mm) < cls.FILESIZE:
+            print('Warm restart: mailbox is too small, starting cold')
+            return False
+        mbg = IVSHMSG_MailGlobals.from_buffer(cls.view)
+        expected = (
+            ('slotsize',        cls.MAILBOX_SLOTSIZE),
+            ('buf_offset',      cls.MS_BUF_off),
+            ('nClients',        cls.nClients),
+            ('nEvents',         cls.nEvents),
+            ('server_id',       cls.server_id),
+            ('layout',          cls.layout),
+            ('ring_cells',      cls.ring_cells),
+            ('ring_cellsize',   ctypes.sizeof(cls.RingCell)
+                                if cls.ring_cells else 0),
+            ('nSlots',          cls.MAILBOX_MAX_SLOTS),
+            ('stats_offset',    cls.stats_offset),
+            ('pending_offset',  cls.pending_offset),
+        )
+        for field, value in expected:
+            if getattr(mbg, field) != value:
+                print('Warm restart: %s is %d, want %d, starting cold' % (
+                    field, getattr(mbg, field), value))
+                return False
+
+        cls._overlay_slots(cls.view, mbg)
+        for slot in range(1, cls.nEvents):
+            ms = cls.slots[slot]
+            if ms.peer_id != slot:
+                print('Warm restart: slot %d is corrupt, starting cold' % slot)
+                return False
+            if ms.seqlock & 1:      # Writer died mid-update
+                ms.write_end()
+
+        # Nobody answers for the old server so drop what it had sent and,
+        # where the destination is known (ring layout), what was sent to
+        # it.  Peer to peer traffic is left alone.  Then republish the
+        # live peers.  A successor taking over a running server (see
+        # twisted_handoff.py) does answer for it, so nothing is dropped.
+        takeover = getattr(args, 'takeover', False)
+        if cls.layout == cls.LAYOUT_RING and not takeover:
+            for id in range(1, cls.server_id):
+                for cell in cls._ring_pending(id, cls.server_id):
+                    cell.done = cell.seq
+        if not takeover:
+            cls.clear_mailslot(cls.server_id)
+        name = 'Z-switch' if args.smart else 'Z-server'
+        cls.slots[cls.server_id].nodename = name
+        cls.slots[cls.server_id].cclass = 'FabricSwitch'
+
+        cls.warm_ids = frozenset(id for id in range(1, cls.server_id)
+                                 if cls.slots[id].nodename)
+        cls._published = {}
+        mbg.active_map = 0
+        if getattr(args, 'silent', False):
+            mbg.generation = 0
+        else:
+            mbg.generation = max(mbg.generation, 1)
+            for id in sorted(cls.warm_ids) + [ cls.server_id, ]:
+                cls.refresh_active(id)
+            mbg.generation += 1     # Even if nothing changed
+        return True
 
     #----------------------------------------------------------------------
     # Polymorphic.  Someday I'll learn about metaclasses.  While initialized
@@ -150,9 +647,11 @@ class IVSHMSG_MailBox(object):
 
     _beentheredonethat = False
 
-    def __init__(self, args=None, fd=-1, client_id=-1):
+    def __init__(self, args=None, fd=-1, client_id=-1, shared=False):
         '''Server: args with command line stuff from command line.
-           Client: starts with an fd and id read from AF_UNIX socket.'''
+           Client: starts with an fd and id read from AF_UNIX socket.
+           shared: another process owns client_id and this one helps it
+           out (sharded server workers), so leave the slot alone.'''
         cls = self.__class__
         if cls._beentheredonethat:
             return
@@ -161,9 +660,12 @@ class IVSHMSG_MailBox(object):
         if args is None:
             assert fd >= 0 and client_id > 0, 'Bad call, ump!'
             cls.fd = fd
-            cls._init_mailslot(client_id)
+            cls._init_mailslot(client_id, fresh=not shared)
+            if shared:
+                cls.share_id(client_id)
             return
         assert fd == -1 and client_id == -1, 'Cannot assign fd/id to server'
+        cls._set_geometry(args)
 
         path = args.mailbox     # Match previously written code
         gr_gid = -1     # Makes no change.  Try Debian, CentOS, other
@@ -174,20 +676,26 @@ class IVSHMSG_MailBox(object):
             except Exception as e:
                 pass
 
+        # hugetlbfs files must be whole huge pages.  The slot geometry
+        # doesn't change, the file just has a tail nobody uses.
+        filesize = cls.FILESIZE
+        hugepages = getattr(args, 'hugepages', None)
+        if hugepages:
+            hugesize = _hugetlbfs_pagesize(hugepages)
+            filesize = (filesize + hugesize - 1) // hugesize * hugesize
+            if '/' not in path:
+                path = os.path.join(hugepages, path)
         if '/' not in path:
             path = '/dev/shm/' + path
         oldumask = os.umask(0)
         try:
             if not os.path.isfile(path):
                 fd = os.open(path, os.O_RDWR | os.O_CREAT, mode=0o666)
-                os.posix_fallocate(fd, 0, cls.FILESIZE)
+                os.posix_fallocate(fd, 0, filesize)
                 os.fchown(fd, -1, gr_gid)
             else:   # Re-condition and re-use
                 lstat = os.lstat(path)
                 assert STAT.S_ISREG(lstat.st_mode), 'not a regular file'
-                assert lstat.st_size >= cls.FILESIZE, \
-                    'existing size (%d) is < required (%d)' % (
-                        lstat.st_size, cls.FILESIZE)
                 if lstat.st_gid != gr_gid and gr_gid > 0:
                     print('Changing %s to group %s' % (path, gr_name))
                     os.chown(path, -1, gr_gid)
@@ -195,6 +703,10 @@ class IVSHMSG_MailBox(object):
                     print('Changing %s to permissions 666' % path)
                     os.chmod(path, 0o666)
                 fd = os.open(path, os.O_RDWR)
+                if lstat.st_size < filesize:    # Geometry grew
+                    print('Growing %s from %d to %d bytes' % (
+                        path, lstat.st_size, filesize))
+                    os.posix_fallocate(fd, 0, filesize)
         except Exception as e:
             raise RuntimeError('Problem with %s: %s' % (path, str(e)))
 
@@ -209,51 +721,423 @@ class IVSHMSG_MailBox(object):
     # It's not so much (passively) receivng mail as it is actively getting.
 
     @classmethod
-    def retrieve(cls, peer_id, asbytes=False, clear=True):
-        '''Return the message.'''
+    def retrieve(cls, peer_id, asbytes=False, clear=True, receiver_id=None):
+        '''Return the message.  In ring layout, the oldest one from peer_id
+           destined for receiver_id, or an empty message if none.'''
         ms = cls.slots[peer_id]
         # This next test seems paranoid, but also validates that id != 0
         # (which would have grabbed the MailGlobals).  Oh and it is self-
         # limiting past server_id.
         assert ms.peer_id == peer_id, '%d != %d: this is SO wrong' % (
             ms.peer_id, peer_id)
-        buf = ms.buf[:ms.buflen]
+        if cls.layout == cls.LAYOUT_RING:
+            assert receiver_id is not None, 'Ring layout needs a receiver'
+            for cell in cls._ring_pending(peer_id, receiver_id):
+                buf = cls._cell_bytes(cell)
+                if clear:
+                    cell.done = cell.seq
+                    cls._count_rcvd(receiver_id, len(buf))
+                break
+            else:
+                buf = b''
+            return buf if asbytes else buf.decode()
+
+        if cls.layout == cls.LAYOUT_ISOLATED:
+            ack = cls.acks[peer_id]
+            posted, buf = ms.read_consistent(
+                lambda s: (s.posted, cls.bufs[peer_id][:s.buflen]))
+            if posted == ack.acked:
+                buf = b''
+            if clear:
+                ack.acked = posted
+                if buf:
+                    cls._count_rcvd(receiver_id, len(buf))
+            return buf if asbytes else buf.decode()
+
+        buf = ms.read_consistent(lambda s: cls.bufs[peer_id][:s.buflen])
 
         # The message is copied so mark the mailslot length zero as handshake
         # to the requester that its mailbox has been emptied.
 
         if clear:
             ms.buflen = 0
+            if buf:
+                cls._count_rcvd(receiver_id, len(buf))
 
         return buf if asbytes else buf.decode()
 
+    @classmethod
+    def retrieve_all(cls, peer_id, receiver_id, asbytes=False):
+        '''Return a list of every message from peer_id for receiver_id.
+           Legacy layout has room for only one.'''
+        if cls.layout != cls.LAYOUT_RING:
+            return [ cls.retrieve(peer_id, asbytes=asbytes,
+                                  receiver_id=receiver_id), ]
+        msgs = []
+        for cell in cls._ring_pending(peer_id, receiver_id):
+            buf = cls._cell_bytes(cell)
+            cell.done = cell.seq
+            cls._count_rcvd(receiver_id, len(buf))
+            msgs.append(buf if asbytes else buf.decode())
+        return msgs
+
+    #----------------------------------------------------------------------
+    # Zero-copy receive: a read-only view straight into the mapping.  The
+    # sender can't reuse the buffer until release() so handle it promptly
+    # and don't keep the view (or slices of it) past that.  Returns None
+    # when nothing is pending.  buflen (and posted) come from a seqlock
+    # read, so the buffer behind them was completely written; only a
+    # sender that times out and stomps can change it under the view.
+
+    @classmethod
+    def retrieve_view(cls, peer_id, receiver_id=None):
+        if cls.layout == cls.LAYOUT_RING:
+            assert receiver_id is not None, 'Ring layout needs a receiver'
+            for cell in cls._ring_pending(peer_id, receiver_id):
+                off = ctypes.addressof(cell) - cls._view_addr + \
+                    cls.RingCell.buf.offset
+                return cls.view[off:off + cell.buflen].toreadonly()
+            return None
+        ms = cls.slots[peer_id]
+        posted, buflen = ms.read_consistent(lambda s: (s.posted, s.buflen))
+        if cls.layout == cls.LAYOUT_ISOLATED and \
+           posted == cls.acks[peer_id].acked:
+            return None
+        if not buflen:
+            return None
+        off = cls.MAILBOX_SLOTSIZE * peer_id + cls.MS_BUF_off
+        return cls.view[off:off + buflen].toreadonly()
+
+    @classmethod
+    def release(cls, peer_id, receiver_id=None):
+        '''Hand the buffer from the last retrieve_view() back to the sender.'''
+        if cls.layout == cls.LAYOUT_RING:
+            for cell in cls._ring_pending(peer_id, receiver_id):
+                cell.done = cell.seq
+                cls._count_rcvd(receiver_id, cell.buflen)
+                break
+            return
+        ms = cls.slots[peer_id]
+        if cls.layout == cls.LAYOUT_ISOLATED:
+            ack = cls.acks[peer_id]
+            if ack.acked != ms.posted:
+                cls._count_rcvd(receiver_id, ms.buflen)
+            ack.acked = ms.posted
+            return
+        if ms.buflen:
+            cls._count_rcvd(receiver_id, ms.buflen)
+        ms.buflen = 0
+
+    #----------------------------------------------------------------------
+    # Stats, each entry written only by the owner of that id.  Receivers
+    # that don't say who they are (receiver_id None) aren't counted.
+
+    @classmethod
+    def _count_rcvd(cls, receiver_id, nbytes):
+        if receiver_id is None or cls.stats is None:
+            return
+        if receiver_id in cls._shared_ids:
+            cls._lock(receiver_id, 1)
+        st = cls.stats[receiver_id]
+        st.msgs_rcvd += 1
+        st.bytes_rcvd += nbytes
+        if receiver_id in cls._shared_ids:
+            cls._unlock(receiver_id, 1)
+
+    @classmethod
+    def _count_sent(cls, sender_id, nbytes, stomped):
+        if cls.stats is None:
+            return
+        st = cls.stats[sender_id]     # Under the fill lock if shared
+        st.msgs_sent += 1
+        st.bytes_sent += nbytes
+        if stomped:
+            st.stomps += 1
+
+    @classmethod
+    def _count_wait(cls, sender_id, started):
+        if cls.stats is None:
+            return
+        if sender_id in cls._shared_ids:
+            cls._lock(sender_id, 1)
+        st = cls.stats[sender_id]
+        st.waits += 1
+        st.wait_usecs += int((NOW() - started) * 1000000)
+        if sender_id in cls._shared_ids:
+            cls._unlock(sender_id, 1)
+
+    #----------------------------------------------------------------------
+    # Normally one process writes as a given id.  A sharded server has
+    # several (the supervisor and its workers all send and receive as the
+    # server) so their posts and counters are serialized with POSIX record
+    # locks on bytes of that id's mailslot in the mailbox file.  Locks are
+    # advisory; the mmap itself is untouched.  Byte 0 covers posting (and
+    # its counters), byte 1 the other counters.
+
+    @classmethod
+    def share_id(cls, id):
+        cls._shared_ids = cls._shared_ids | frozenset((id, ))
+
+    @classmethod
+    def _lock(cls, id, which=0):
+        fcntl.lockf(cls.fd, fcntl.LOCK_EX, 1,
+                    id * cls.MAILBOX_SLOTSIZE + which)
+
+    @classmethod
+    def _unlock(cls, id, which=0):
+        fcntl.lockf(cls.fd, fcntl.LOCK_UN, 1,
+                    id * cls.MAILBOX_SLOTSIZE + which)
+
+    @classmethod
+    def slot_stats(cls, id):
+        '''Counters for id as a dict, empty without --stats.'''
+        if cls.stats is None:
+            return {}
+        return cls.stats[id].asdict()
+
+    #----------------------------------------------------------------------
+    # Doorbell moderation.  ring_doorbell() is for senders; the receiver
+    # brackets its polling with disarm() and rearm().
+
+    @classmethod
+    def ring_doorbell(cls, sender_id, to_doorbell):
+        '''Ring unless the receiver is already draining sender_id.'''
+        receiver_id = to_doorbell.owner_id
+        if cls.layout == cls.LAYOUT_RING and receiver_id is not None and \
+           cls.slots[receiver_id].draining & (1 << sender_id):
+            return False
+        to_doorbell.ring()
+        return True
+
+    @classmethod
+    def disarm(cls, receiver_id, sender_id):
+        assert cls.layout == cls.LAYOUT_RING, 'Moderation needs ring layout'
+        cls.slots[receiver_id].draining |= 1 << sender_id
+
+    @classmethod
+    def rearm(cls, receiver_id, sender_id):
+        '''Returns True if something arrived that won't ring the doorbell.'''
+        cls.slots[receiver_id].draining &= ~(1 << sender_id)
+        return cls.pending(sender_id, receiver_id)
+
+    #----------------------------------------------------------------------
+    # Shared doorbells.  doorbell() turns a peer's eventfd list into the
+    # object a sender rings, whichever the mode.  take_pending() is for the
+    # receiver when its one doorbell goes off.
+
+    @classmethod
+    def doorbell(cls, EN_list, sender_id):
+        if cls.pendmap is None:
+            return EN_list[sender_id]
+        return _SharedDoorbell(EN_list[0], sender_id)
+
+    @classmethod
+    def set_pending(cls, receiver_id, sender_id):
+        cls.pendmap[receiver_id][sender_id] = 1
+
+    @classmethod
+    def any_pending(cls, receiver_id):
+        return any(cls.pendmap[receiver_id])
+
+    @classmethod
+    def take_pending(cls, receiver_id):
+        '''Senders that rang receiver_id, each cleared before it's handled
+           so a later message rings again.'''
+        row = cls.pendmap[receiver_id]
+        raw = bytes(row)
+        senders = []
+        sender_id = raw.find(1, 1)
+        while 0 < sender_id < cls.nEvents:
+            row[sender_id] = 0
+            senders.append(sender_id)
+            sender_id = raw.find(1, sender_id + 1)
+        return senders
+
+    #----------------------------------------------------------------------
+    # Spinning receivers peek instead of waiting for a doorbell.
+
+    @classmethod
+    def pending(cls, peer_id, receiver_id=None):
+        '''True if a message from peer_id is waiting.  Cheap enough to spin
+           on; it reads the slot without any side effects.  Only the ring
+           layout says who it's for, otherwise it may be somebody else's.'''
+        if cls.layout == cls.LAYOUT_RING:
+            for cell in cls._ring_pending(peer_id, receiver_id):
+                return True
+            return False
+        ms = cls.slots[peer_id]
+        if cls.layout == cls.LAYOUT_ISOLATED:
+            return ms.posted != cls.acks[peer_id].acked
+        return ms.buflen != 0
+
+    #----------------------------------------------------------------------
+    # Ring internals.  Cells between tail and head are in flight; a cell
+    # is pending for its dest until that receiver sets done = seq.
+
+    @classmethod
+    def _ring_pending(cls, peer_id, receiver_id):
+        header, cells = cls.rings[peer_id]
+        head = header.head
+        for n in range(header.tail, head):
+            cell = cells[n % cls.ring_cells]
+            if cell.dest == receiver_id and cell.done != cell.seq:
+                yield cell
+
+    @classmethod
+    def _cell_bytes(cls, cell):
+        # Reading the buf field would stop at the first NUL too.
+        return ctypes.string_at(
+            ctypes.addressof(cell) + cls.RingCell.buf.offset, cell.buflen)
+
+    @classmethod
+    def _ring_reclaim(cls, sender_id):
+        '''Producer only: advance tail past consumed cells.  Returns the
+           number of free cells.'''
+        header, cells = cls.rings[sender_id]
+        tail, head = header.tail, header.head
+        while tail < head:
+            cell = cells[tail % cls.ring_cells]
+            if cell.done != cell.seq:
+                break
+            tail += 1
+        header.tail = tail
+        return cls.ring_cells - (head - tail)
+
+    @classmethod
+    def _ring_post(cls, sender_id, dest_id, buf):
+        header, cells = cls.rings[sender_id]
+        head = header.head
+        cell = cells[head % cls.ring_cells]
+        cell.dest = dest_id
+        cell.buflen = len(buf)
+        ctypes.memmove(ctypes.addressof(cell) + cls.RingCell.buf.offset,
+                       buf + b'\0', len(buf) + 1)   # Field setter stops at NUL
+        cell.seq = head + 1     # Never matches a stale "done"
+        header.head = head + 1  # Publish it last
+
     #----------------------------------------------------------------------
     # Post a message to the indicated mailbox slot but don't kick the
     # EventFD.  First, this routine doesn't know about them and second,
     # keeping it a separate operation facilitates sender spoofing.
+    # In ring layout the destination must be given so the right receiver
+    # picks it up.  Spoofing makes this process a second producer on
+    # someone else's ring; it's a debug feature so live with it.
 
     @classmethod
-    def fill(cls, sender_id, buf):
+    def _check_buf(cls, buf):
         if isinstance(buf, str):
             buf = buf.encode()
         assert isinstance(buf, bytes), 'buf must be string or bytes'
-        buflen = len(buf)
-        assert buflen < cls.MS_MAX_BUFLEN, 'Message too long'
+        assert len(buf) < cls.MS_MAX_BUFLEN, 'Message too long'
+        return buf
+
+    @classmethod
+    def try_fill(cls, sender_id, buf, dest_id=None, stomp=False):
+        '''Post buf if the slot can take it now, or regardless if stomp.
+           Returns False without waiting if the slot is still busy.'''
+        buf = cls._check_buf(buf)
+        if sender_id not in cls._shared_ids:
+            return cls._try_fill(sender_id, buf, dest_id, stomp)
+        cls._lock(sender_id)
+        try:
+            return cls._try_fill(sender_id, buf, dest_id, stomp)
+        finally:
+            cls._unlock(sender_id)
 
-        # The previous responder needs to clear the msglen to indicate it
-        # has pulled the message out of the sender's mailbox.
+    @classmethod
+    def _try_fill(cls, sender_id, buf, dest_id, stomp):
+        if cls.layout == cls.LAYOUT_RING:
+            assert dest_id is not None, 'Ring layout needs a destination'
+            if not cls._ring_reclaim(sender_id):
+                if not stomp:
+                    return False
+                header, _ = cls.rings[sender_id]
+                header.tail += 1        # Drop the oldest
+                cls._count_sent(sender_id, len(buf), True)
+            else:
+                cls._count_sent(sender_id, len(buf), False)
+            cls._ring_post(sender_id, dest_id, buf)
+            return True
+
+        # The previous responder needs to clear the msglen (or in isolated
+        # layout, ack the posted count) to indicate it has pulled the
+        # message out of the sender's mailbox.
         ms = cls.slots[sender_id]
-        stop = NOW() + 1.05
-        intime = True
-        while NOW() < stop and ms.buflen:
+        if cls.layout == cls.LAYOUT_ISOLATED:
+            busy = ms.posted != cls.acks[sender_id].acked
+        else:
+            busy = ms.buflen
+        if busy and not stomp:
+            return False
+        ms.write_begin()
+        cls.bufs[sender_id].value = buf     # NUL terminated if room
+        ms.buflen = len(buf)                # Publishes it (legacy)...
+        ms.posted += 1                      # ...or this does (isolated)
+        ms.write_end()
+        cls._count_sent(sender_id, len(buf), bool(busy))
+        return True
+
+    @classmethod
+    def fill(cls, sender_id, buf, dest_id=None):
+        '''Blocking post, for use outside the reactor.  Returns False if
+           it had to stomp a message the receiver never picked up.'''
+        buf = cls._check_buf(buf)
+        started = NOW()
+        if cls.try_fill(sender_id, buf, dest_id):
+            return True
+        stop = started + 1.05
+        while not cls.try_fill(sender_id, buf, dest_id):
+            if NOW() >= stop:
+                print('pseudo-HW not ready to receive timeout: now stomping')
+                cls.try_fill(sender_id, buf, dest_id, stomp=True)
+                cls._count_wait(sender_id, started)
+                return False
             sleep(0.1)
-        if NOW() >= stop:
-            intime = False
-            print('pseudo-HW not ready to receive timeout: now stomping')
+        cls._count_wait(sender_id, started)
+        return True
+
+    #----------------------------------------------------------------------
+    # Reactor-friendly version of fill().  Messages from one sender are
+    # queued and posted in order as the slot frees up, polled with reactor
+    # timers instead of sleep().  The Deferred fires with the same value
+    # fill() would return.
 
-        ms.buflen = buflen
-        ms.buf = buf
-        return intime
+    @classmethod
+    def fill_async(cls, sender_id, buf, dest_id=None, timeout=1.05):
+        buf = cls._check_buf(buf)
+        q = cls._sendq.setdefault(sender_id, deque())
+        if not q and cls.try_fill(sender_id, buf, dest_id):
+            return succeed(True)
+        d = Deferred()
+        started = NOW()
+        q.append((buf, dest_id, d, started, started + timeout))
+        cls._arm_sendq(sender_id, cls.SEND_POLL_MIN)
+        return d
+
+    @classmethod
+    def _arm_sendq(cls, sender_id, delay):
+        if sender_id in cls._sendq_armed:
+            return
+        cls._sendq_armed.add(sender_id)
+        TIreactor.callLater(delay, cls._drain_sendq, sender_id, delay)
+
+    @classmethod
+    def _drain_sendq(cls, sender_id, delay):
+        cls._sendq_armed.discard(sender_id)
+        q = cls._sendq[sender_id]
+        while q:
+            buf, dest_id, d, started, stop = q[0]
+            intime = cls.try_fill(sender_id, buf, dest_id)
+            if not intime:
+                if NOW() < stop:
+                    cls._arm_sendq(sender_id, min(delay * 2, cls.SEND_POLL_MAX))
+                    return
+                print('pseudo-HW not ready to receive timeout: now stomping')
+                cls.try_fill(sender_id, buf, dest_id, stomp=True)
+            cls._count_wait(sender_id, started)
+            q.popleft()
+            d.callback(intime)      # Might queue more for this sender
+            delay = cls.SEND_POLL_MIN
 
     #----------------------------------------------------------------------
     # Called by Python client on graceful shutdowns, and always by server
@@ -262,21 +1146,100 @@ class IVSHMSG_MailBox(object):
 
     @classmethod
     def clear_mailslot(cls, id):
-        cls.slots[id].nodename = ''
-        cls.slots[id].cclass = ''
-        cls.slots[id].peer_id = id
+        ms = cls.slots[id]
+        ms.write_begin()
+        ms._nodename = b''
+        ms._cclass = b''
+        ms.peer_id = id
+        ms.write_end()
+        if cls.layout == cls.LAYOUT_RING:   # Drop anything in flight
+            header, _ = cls.rings[id]
+            header.tail = header.head
+        elif cls.layout == cls.LAYOUT_ISOLATED:
+            cls.acks[id].acked = ms.posted
+
+    #----------------------------------------------------------------------
+    # Server only: re-read the slot and publish any change in active_map.
+    # Called for each incoming request and after a peer leaves.
+
+    @classmethod
+    def refresh_active(cls, id):
+        mbg = cls.slots[0]
+        if not mbg.generation:
+            return
+        snap = cls.slots[id].snapshot()
+        now = (snap['nodename'], snap['cclass'])
+        if cls._published.get(id, ('', '')) == now:
+            return
+        cls._published[id] = now
+        if now[0]:
+            mbg.active_map |= 1 << id
+        else:
+            mbg.active_map &= ~(1 << id)
+        mbg.generation += 1     # Last, after the map
+
+    #----------------------------------------------------------------------
+    # Name lookups, cached until the generation or a slot's seqlock moves.
+    # Seqlocks move with every legacy message too, so a moved one means
+    # re-reading that slot, and only a real name or cclass change rebuilds.
+    # The index is (generation, seqlocks, sorted ids, name -> id,
+    # id -> (nodename, cclass)) and is replaced, never modified.
+
+    @classmethod
+    def _name_index(cls):
+        generation = cls.slots[0].generation
+        slots = cls.slots[1:cls.server_id + 1]
+        seqs = [ slot.seqlock for slot in slots ]   # Before the reads
+        index = cls._index
+        if index is not None and index[0] == generation:
+            if index[1] == seqs:
+                return index
+            byid = index[4]
+            for id, (was, now) in enumerate(zip(index[1], seqs), 1):
+                if was == now:
+                    continue
+                snap = cls.slots[id].snapshot()
+                names = (snap['nodename'], snap['cclass'])
+                if byid.get(id, None) != (names if names[0] else None):
+                    break
+            else:       # Just traffic
+                cls._index = (generation, seqs) + index[2:]
+                return cls._index
+        byid = OrderedDict()
+        for id, slot in enumerate(slots, 1):
+            snap = slot.snapshot()
+            if snap['nodename']:
+                byid[id] = (snap['nodename'], snap['cclass'])
+        names = dict((nodename, id) for id, (nodename, _) in byid.items())
+        cls._index = (generation, seqs, list(byid), names, byid)
+        return cls._index
 
     @classmethod
     def active_ids(cls):
-        return sorted([
-            slot.peer_id for slot in cls.slots[1:cls.server_id + 1] if
-                slot.nodename])
+        '''Sorted list of ids with a nodename.  Don't modify it.'''
+        return cls._name_index()[2]
+
+    @classmethod
+    def lookup_name(cls, nodename):
+        '''The peer id currently using nodename, or None.'''
+        return cls._name_index()[3].get(nodename)
+
+    @classmethod
+    def active_names(cls):
+        '''id -> (nodename, cclass) for active_ids().  The same object
+           until something changes, so it can key a cache.  Don't
+           modify it.'''
+        return cls._name_index()[4]
+
+    @classmethod
+    def generation(cls):
+        return cls.slots[0].generation
 
     #----------------------------------------------------------------------
     # Called only by client.  mmap() the file and retrieve globals.
 
     @classmethod
-    def _init_mailslot(cls, id):
+    def _init_mailslot(cls, id, fresh=True):
         if cls.mm is None:
             # First time has some extra setup, not all vars need to be kept.
             buf = os.fstat(cls.fd)
@@ -288,20 +1251,49 @@ class IVSHMSG_MailBox(object):
             cls.nClients = mbg.nClients
             cls.nEvents = mbg.nEvents
             cls.server_id = mbg.server_id
+            cls.layout = mbg.layout
+            cls.ring_cells = mbg.ring_cells
+            cls.MAILBOX_MAX_SLOTS = mbg.nSlots or cls.MAILBOX_MIN_SLOTS
+            cls.MAILBOX_SLOTSIZE = mbg.slotsize
+            cls.FILESIZE = cls.MAILBOX_MAX_SLOTS * cls.MAILBOX_SLOTSIZE
+            cls.stats_offset = mbg.stats_offset
+            assert not cls.stats_offset or \
+                cls.stats_offset >= cls.nEvents * cls.MAILBOX_SLOTSIZE, \
+                'Stats region overlaps the mailslots'
+            assert not cls.stats_offset or buf.st_size >= \
+                cls.stats_offset + cls._stats_size(cls.nEvents), \
+                'Mailbox file is too small for stats'
+            cls.pending_offset = mbg.pending_offset
+            cls.nVectors = 1 if cls.pending_offset else cls.nEvents
+            assert not cls.pending_offset or buf.st_size >= \
+                cls.pending_offset + cls._pendmap_size(cls.nEvents), \
+                'Mailbox file is too small for the pending map'
+            cls.MS_BUF_off = mbg.buf_offset
+            assert cls.MS_BUF_off >= ctypes.sizeof(IVSHMSG_MailSlot), \
+                'Mailslot metadata does not fit before buf_offset'
+            assert buf.st_size >= cls.FILESIZE, 'Mailbox file is too small'
+            if cls.layout == cls.LAYOUT_RING:
+                hdrsize = ctypes.sizeof(IVSHMSG_RingCell(0))
+                cls.MS_MAX_BUFLEN = mbg.ring_cellsize - hdrsize
+                cls.RingCell = IVSHMSG_RingCell(cls.MS_MAX_BUFLEN)
+            else:
+                cls.MS_MAX_BUFLEN = cls.MAILBOX_SLOTSIZE - cls.MS_BUF_off
 
             # Create all the peer data structures now as it simplifies
             # connection logic removes interplay from twisted_client.py.
-            cls.slots = [ None, ] * cls.nEvents
-            cls.slots[0] = mbg
+            cls._overlay_slots(view, mbg)
             for slot in range(1, cls.nEvents):
-                cls.slots[slot] = IVSHMSG_MailSlot.from_buffer(
-                    view[mbg.slotsize * slot : mbg.slotsize * (slot + 1)])
                 assert cls.slots[slot].peer_id == slot, 'What happened?'
 
         if id > cls.server_id:  # Probably a test run of twisted_restapi
             return
         assert cls.slots[id].peer_id == id, 'What happened?'
+        if not fresh:
+            return
         cls.clear_mailslot(id)
+        if cls.stats is not None:
+            ctypes.memset(ctypes.addressof(cls.stats[id]), 0,  # New owner
+                ctypes.sizeof(IVSHMSG_SlotStats))
 
     #----------------------------------------------------------------------
     # Typing conveniences.  No setters, use the full expression.
@@ -313,3 +1305,7 @@ class IVSHMSG_MailBox(object):
     @classmethod
     def cclass(cls, index):
         return cls.slots[index].cclass
+
+    @classmethod
+    def snapshot(cls, index):
+        return cls.slots[index].snapshot()
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# (at your option) any later version.  See the LICENSE file in the
+# top-level directory.
+
+# Peer ID ("port") allocation for twisted_server.  Free IDs are bits in an
+# integer so finding one is a couple of bit operations, not a set build
+# and sort per connection.  Two policies: lowest-first (the QEMU server
+# behavior) or randomized (smart mode, so a rebooted fabric doesn't line
+# up the same way every time).
+#
+# IVSHMSG gives the server no way to recognize a returning VM: the ID goes
+# out before the peer says anything.  So a vacated ID is "reserved": it
+# sits in a FIFO that is handed out ahead of the free bitmap for hold_secs.
+# When VMs bounce (singly, or a host's worth in order) each one comes back
+# to its old port, and with --recycle to its old eventfds too.  After the
+# hold expires the ID is just free.
+
+import random
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class PeerIDAllocator(object):
+
+    def __init__(self, lowest, highest, randomize=False, hold_secs=0):
+        '''IDs lowest through highest inclusive.'''
+        assert 0 < lowest <= highest, 'Bad peer ID range'
+        self.lowest = lowest
+        self.highest = highest
+        self.randomize = randomize
+        self.hold_secs = hold_secs
+        self._free = ((1 << (highest + 1)) - 1) & ~((1 << lowest) - 1)
+        self._busy = 0
+        self._reserved = OrderedDict()      # id: expiry, oldest first
+
+    def _expire(self):
+        now = monotonic()
+        while self._reserved:
+            id, expiry = next(iter(self._reserved.items()))
+            if expiry > now:
+                return
+            del self._reserved[id]
+            self._free |= 1 << id
+
+    def _pick_free(self):
+        free = self._free
+        if self.randomize:      # First free at or after a random start
+            start = random.randint(self.lowest, self.highest)
+            above = free >> start
+            if above:
+                return (above & -above).bit_length() - 1 + start
+        return (free & -free).bit_length() - 1
+
+    def allocate(self):
+        '''Returns a peer ID, or -1 if they're all in use.'''
+        self._expire()
+        if self._reserved:
+            id, _ = self._reserved.popitem(last=False)
+        elif self._free:
+            id = self._pick_free()
+            self._free &= ~(1 << id)
+        else:
+            return -1
+        self._busy |= 1 << id
+        return id
+
+    def take(self, id):
+        '''Claim a specific ID, eg, one kept by a warm restart.'''
+        assert self.lowest <= id <= self.highest, 'Peer ID out of range'
+        assert not self._busy & (1 << id), 'Peer ID %d is in use' % id
+        self._reserved.pop(id, None)
+        self._free &= ~(1 << id)
+        self._busy |= 1 << id
+
+    def release(self, id, reserve=True):
+        '''Give back an ID; reserve it for its owner's return if asked.'''
+        if not self._busy & (1 << id):
+            return
+        self._busy &= ~(1 << id)
+        if reserve and self.hold_secs > 0:
+            self._reserved[id] = monotonic() + self.hold_secs
+        else:
+            self._free |= 1 << id
+
+    def _ids(self, bits):
+        return [ id for id in range(self.lowest, self.highest + 1)
+                 if bits & (1 << id) ]
+
+    def occupancy(self):
+        '''For status displays and the REST API.'''
+        self._expire()
+        return OrderedDict((
+            ('busy', self._ids(self._busy)),
+            ('reserved', list(self._reserved)),
+            ('free', self._ids(self._free)),
+            ('policy', 'random' if self.randomize else 'lowest'),
+            ('hold_secs', self.hold_secs),
+        ))
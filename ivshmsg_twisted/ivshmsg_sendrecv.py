@@ -12,30 +12,216 @@
 # transport.sendFileDescriptor gets the packing sizes wrong for IVSHMSG
 # so do it right.
 
+import array
+import ctypes
+import errno
+import os
 import socket
 import struct
 import sys
 
+from twisted.internet import reactor as TIreactor
+
 ###########################################################################
 
 
 def ivshmsg_send_one_msg(thesocket, data, fd=None):
     # On the far side, if no fd is received from here, a helper routine
-    # returns fd == -1 which is checked in various places.
-    data = int(data)
-    bdata_iovec = [ struct.pack('q', data) ]    # One item in the vector
-    if fd is None:
-        cmsg = []   # Message array of none, defaults to fd == -1 on far side.
-    else:
-        fd = int(fd)
-        cmsg = [    # Message array of one.
-            (socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('i', fd))
-        ]
+    # returns fd == -1 which is checked in various places.  It goes
+    # through the backlog (below) so it can't overtake a batch.
+    return _send_or_queue(thesocket, _frame([ (data, fd), ]))
+
+
+###########################################################################
+# Batches, eg, advertising all the eventfds of a peer.  msgs is a sequence
+# of (data, fd or None).  The receiving end (QEMU) reads 8 bytes at a time
+# and a passed fd arrives with the first read of the sendmsg that carried
+# it, so every fd must start its own sendmsg.  A stream reader taking
+# bigger bites (twisted_client) gets the fd with the chunk that ends in
+# the fd's sendmsg, so an fd's quadword travels alone.  Runs of fd-less
+# messages share one sendmsg.  All of those sendmsgs then go in one
+# sendmmsg() syscall, or as few as the socket buffer allows.
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_sendmmsg = getattr(_libc, 'sendmmsg', None)
+if _sendmmsg is not None:
+    _sendmmsg.argtypes = [ ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                           ctypes.c_int ]
+
+# The kernel structures are built as arrays of quadwords with slice
+# assignments; setting ctypes fields (or struct packing) one message at a
+# time costs more than the syscalls saved.  LP64 layouts, all quadwords:
+#   struct mmsghdr  name, namelen, iov, iovlen, control, controllen,
+#                   flags, msg_len
+#   struct iovec    base, len
+#   SCM_RIGHTS      cmsg_len, level | type << 32, fd   (CMSG_SPACE(int))
+
+_MMSGHDR_QW = 8
+_IOVEC_QW = 2
+_CMSG_QW = 3
+_CMSG_LEN_FD = 20                               # CMSG_LEN(sizeof(int))
+
+if array.array('Q').itemsize != 8 or ctypes.sizeof(ctypes.c_void_p) != 8 \
+   or sys.byteorder != 'little':
+    _sendmmsg = None
+
+
+def _frame(msgs):
+    '''Group msgs into sendmsg-sized (bytes, fd) chunks.'''
+    chunks = []
+    for data, fd in msgs:
+        bdata = struct.pack('q', int(data))
+        if fd is None and chunks and chunks[-1][1] is None:
+            chunks[-1][0].append(bdata)
+        else:
+            chunks.append(([ bdata, ], None if fd is None else int(fd)))
+    return [ (b''.join(bdatas), fd) for bdatas, fd in chunks ]
+
+
+def _send_chunks_mmsg(thesocket, chunks):
+    n = len(chunks)
+    data = array.array('B', b''.join(c[0] for c in chunks))
+    lens = [ len(c[0]) for c in chunks ]
+    fds = [ c[1] for c in chunks ]
+
+    data_addr = data.buffer_info()[0]
+    offsets = [ 0, ] * n
+    for i in range(1, n):
+        offsets[i] = offsets[i - 1] + lens[i - 1]
+    iovs = array.array('Q', bytes(8 * _IOVEC_QW * n))
+    iovs[0::_IOVEC_QW] = array.array('Q', [ data_addr + o for o in offsets ])
+    iovs[1::_IOVEC_QW] = array.array('Q', lens)
+
+    cmsgs = array.array('Q', bytes(8 * _CMSG_QW * n))
+    cmsgs[0::_CMSG_QW] = array.array('Q', [ _CMSG_LEN_FD ]) * n
+    cmsgs[1::_CMSG_QW] = array.array('Q',
+        [ socket.SOL_SOCKET | socket.SCM_RIGHTS << 32 ]) * n
+    cmsgs[2::_CMSG_QW] = array.array('Q',
+        [ 0 if fd is None else fd for fd in fds ])
+
+    iov_addr = iovs.buffer_info()[0]
+    cmsg_addr = cmsgs.buffer_info()[0]
+    hdrs = array.array('Q', bytes(8 * _MMSGHDR_QW * n))
+    hdrs[2::_MMSGHDR_QW] = array.array('Q',
+        range(iov_addr, iov_addr + 8 * _IOVEC_QW * n, 8 * _IOVEC_QW))
+    hdrs[3::_MMSGHDR_QW] = array.array('Q', [ 1 ]) * n
+    hdrs[4::_MMSGHDR_QW] = array.array('Q', [
+        0 if fd is None else cmsg_addr + 8 * _CMSG_QW * i
+        for i, fd in enumerate(fds) ])
+    hdrs[5::_MMSGHDR_QW] = array.array('Q', [
+        0 if fd is None else 8 * _CMSG_QW for fd in fds ])
+
+    sockfd = thesocket.fileno()
+    hdrs_addr = hdrs.buffer_info()[0]
+    done = 0
+    while done < n:
+        ret = _sendmmsg(sockfd, hdrs_addr + done * 8 * _MMSGHDR_QW,
+                        n - done, 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err == errno.EAGAIN:
+                return chunks[done:]
+            return None
+        # A stream socket can take part of the last one (its fd went with
+        # the first byte); the rest goes later without the fd.
+        last = done + ret - 1
+        done += ret
+        if ret:
+            sent = hdrs[last * _MMSGHDR_QW + 7] & 0xFFFFFFFF
+            if sent < lens[last]:
+                return [ (chunks[last][0][sent:], None) ] + chunks[done:]
+    return []
+
+
+def _send_chunks_one_by_one(thesocket, chunks):
+    for i, (bdata, fd) in enumerate(chunks):
+        cmsg = [] if fd is None else [
+            (socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('i', fd)) ]
+        try:
+            sent = thesocket.sendmsg([ bdata ], cmsg)
+        except BlockingIOError as e:
+            return chunks[i:]
+        except Exception as e:
+            return None
+        if sent < len(bdata):       # As above
+            return [ (bdata[sent:], None) ] + chunks[i + 1:]
+    return []
+
+
+def _send_chunks(thesocket, chunks):
+    '''Returns the chunks that didn't go, or None if the socket failed.'''
+    if _sendmmsg is not None and len(chunks) > 1:
+        return _send_chunks_mmsg(thesocket, chunks)
+    return _send_chunks_one_by_one(thesocket, chunks)
+
+###########################################################################
+# The transports are non-blocking and a big batch can fill the socket
+# buffer.  Waiting for room would stall the reactor, and with it every
+# doorbell, so what didn't go is queued per socket and retried from the
+# reactor.  Anything else for that socket queues behind it to keep the
+# quadword/fd stream in order.  If a send fails, or nothing moves for
+# BACKLOG_SECS, the stream can't be trusted: the socket is shut down and
+# the protocol's connectionLost() takes it from there.
+
+BACKLOG_SECS = 1.0
+_RETRY_SECS = 0.01
+
+_backlogs = {}      # By socket, [ give up time, chunks ]
+
+
+def _abandon(thesocket):
+    _backlogs.pop(thesocket, None)
     try:
-        ret = thesocket.sendmsg(bdata_iovec, cmsg)
-    except Exception as e:
-        ret = -1
-    return ret == 8
+        thesocket.shutdown(socket.SHUT_RDWR)
+    except OSError as e:
+        pass
+
+
+def _retry(thesocket):
+    backlog = _backlogs[thesocket]
+    rest = _send_chunks(thesocket, backlog[1])
+    if rest is None:
+        _abandon(thesocket)
+        return
+    if not rest:
+        del _backlogs[thesocket]
+        return
+    now = TIreactor.seconds()
+    if rest != backlog[1]:              # Progress
+        backlog[0] = now + BACKLOG_SECS
+    elif now >= backlog[0]:
+        _abandon(thesocket)
+        return
+    backlog[1] = rest
+    TIreactor.callLater(_RETRY_SECS, _retry, thesocket)
+
+
+def _send_or_queue(thesocket, chunks):
+    '''False if the socket failed (and was shut down).'''
+    backlog = _backlogs.get(thesocket, None)
+    if backlog is not None:
+        backlog[1].extend(chunks)
+        return True
+    rest = _send_chunks(thesocket, chunks)
+    if rest is None:
+        _abandon(thesocket)
+        return False
+    if rest:
+        _backlogs[thesocket] = [ TIreactor.seconds() + BACKLOG_SECS, rest ]
+        TIreactor.callLater(_RETRY_SECS, _retry, thesocket)
+    return True
+
+
+def ivshmsg_send_msgs(thesocket, msgs):
+    '''Send a sequence of (data, fd or None) in as few syscalls as the
+       IVSHMSG framing allows.  True unless the socket failed; some of
+       it may go later from the reactor.'''
+    chunks = _frame(msgs)
+    if not chunks:
+        return True
+    return _send_or_queue(thesocket, chunks)
 
 
 def ivshmsg_recv_one_msg(thesocket):
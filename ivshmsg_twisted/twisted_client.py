@@ -12,7 +12,7 @@ import mmap
 import struct
 import sys
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 
 from twisted.internet import stdio
 from twisted.internet import error as TIError
@@ -30,13 +30,23 @@ from zope.interface import implementer
 try:
     from commander import Commander
     from ivshmsg_mailbox import IVSHMSG_MailBox as MB
-    from famez_requests import handle_request, send_payload, ResponseObject
+    from famez_requests import handle_request, send_payload_async, ResponseObject
+    from famez_requests import configure_tags, peer_left
+    from famez_fragments import send_bulk, set_bulk_handler
+    import famez_tlv
     from ivshmsg_eventfd import ivshmsg_event_notifier_list, EventfdReader
+    from ivshmsg_eventfd import EventfdDispatcher, DoorbellModerator
+    from ivshmsg_eventfd import SharedDoorbellDemux
 except ImportError as e:
     from .commander import Commander
     from .ivshmsg_mailbox import IVSHMSG_MailBox as MB
-    from .famez_requests import handle_request, send_payload, ResponseObject
+    from .famez_requests import handle_request, send_payload_async, ResponseObject
+    from .famez_requests import configure_tags, peer_left
+    from .famez_fragments import send_bulk, set_bulk_handler
+    from . import famez_tlv
     from .ivshmsg_eventfd import ivshmsg_event_notifier_list, EventfdReader
+    from .ivshmsg_eventfd import EventfdDispatcher, DoorbellModerator
+    from .ivshmsg_eventfd import SharedDoorbellDemux
 
 ###########################################################################
 # See qemu/docs/specs/ivshmem-spec.txt::Client-Server protocol and
@@ -51,10 +61,16 @@ except ImportError as e:
 # is recognized as implementing IFileDescriptorReceiver, it will FIRST
 # call fileDescriptorReceived before dataReceived.  So for the initial
 # info exchange, version and my (new) id are put out without an fd,
-# then a -1 is put out with the mailbox fd.   What triggers here is
-# one fileDescriptorReceived, THEN a dataReceived of thre quad words.
-# Then it pingpongs evenly between an fd and a single quadword for
-# each grouping.
+# then a -1 is put out with the mailbox fd.  Then come the <peer id>
+# quadwords each with its eventfd, and later lone <peer id> quadwords
+# (no fd) announcing disconnects.
+#
+# Nothing promises one dataReceived per sendmsg.  The kernel coalesces
+# fd-less writes and ends a read right after a write that carried fds;
+# a short read can also split a quadword.  So the stream is framed here:
+# bytes are buffered and cut into quadwords, and fds are queued tagged
+# with the quadword holding the last byte of the chunk they came with.
+# The server (ivshmsg_send_msgs) sends each fd's quadword by itself.
 
 
 @implementer(IFileDescriptorReceiver)   # Energizes fileDescriptorReceived
@@ -63,6 +79,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
     CLIENT_IVSHMEM_PROTOCOL_VERSION = 0
 
     args = None
+    dispatcher = None              # EventfdDispatcher, if any
     id2fd_list = OrderedDict()     # Sent to me for each peer
     id2EN_list = OrderedDict()     # Generated from fd_list
 
@@ -75,13 +92,23 @@ class ProtocolIVSHMSGClient(TIPProtocol):
                 cls.logerr = print
                 cls.stdtrace = sys.stdout
                 cls.verbose = cls.args.verbose
+                set_bulk_handler(cls.bulk_received)
+                famez_tlv.offer(cls.args.tlv)
+                configure_tags(credits=cls.args.credits)
 
             # The state machine major decisions about the semantics of blocks
             # of data have one predicate.  initial_pass is an extra guard.
             self.id = None       # Until initial info; state machine key
-            self._latest_fd = None
             self.initial_pass = True
 
+            # Stream framer: partial quadword, count of quadwords seen,
+            # and (quadword index, fd) waiting for that quadword.
+            self._rxbuf = b''
+            self._rxquads = 0
+            self._rxfds = deque()
+            self._newfds = []           # Until the data they came with
+            self._initial = []          # The first three (value, fd)
+
             # Other stuff
             self.quitting = False
             self.isPFM = False
@@ -113,14 +140,13 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         except ValueError as e:
             if instr.lower()[-6:] in ('server', 'switch'):
                 return (MB.server_id,)
-            active_ids = MB.active_ids()
-            for id in active_ids:
-                if MB.slots[id].nodename == instr:
-                    return (id, )
+            id = MB.lookup_name(instr)
+            if id is not None:
+                return (id, )
             if instr.lower() == 'all':      # Includes caller_id
-                return active_ids
+                return tuple(MB.active_ids())
             if instr.lower() == 'others':
-                return active_ids.remove(caller_id)
+                return tuple(id for id in MB.active_ids() if id != caller_id)
         return None
 
     def place_and_go(self, dest, msg, src=None, reset_tracker=True):
@@ -142,11 +168,13 @@ class ProtocolIVSHMSGClient(TIPProtocol):
                 try:
                     # First get the list for dest, then the src ("from me")
                     # doorbell EN.
-                    doorbell = self.id2EN_list[D][S]
+                    doorbell = MB.doorbell(self.id2EN_list[D], S)
 
                     # This repeat-loads the source mailslot D times per S
-                    # but I don't care.
-                    send_payload(msg, S, doorbell, reset_tracker=reset_tracker)
+                    # but I don't care.  Queued in order if S is busy.
+                    d = send_payload_async(msg, S, doorbell,
+                                           reset_tracker=reset_tracker)
+                    d.addErrback(self._place_and_go_failed, D, msg, S)
                 except KeyError as e:
                     print('No such peer id', str(e))
                     continue
@@ -155,9 +183,17 @@ class ProtocolIVSHMSGClient(TIPProtocol):
                         (D, msg, S, str(e)))
                     return
 
+    @staticmethod
+    def bulk_received(peer_id, data):
+        print('%d bytes of bulk data from %s' % (len(data), MB.nodename(peer_id)))
+
+    @staticmethod
+    def _place_and_go_failed(failure, D, msg, S):
+        print('place_and_go(%s, "%s", %s) failed: %s' %
+            (D, msg, S, failure.getErrorMessage()))
+
     def fileDescriptorReceived(self, latest_fd):
-        assert self._latest_fd is None, 'Latest fd has not been consumed'
-        self._latest_fd = latest_fd     # See the next property
+        self._newfds.append(latest_fd)  # Claimed by the next dataReceived
 
     @property
     def nodename(self):
@@ -179,27 +215,20 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         if name:
             MB.slots[self.id].cclass = name
 
-    @property
-    def latest_fd(self):
-        '''This is NOT idempotent!'''
-        tmp = self._latest_fd
-        self._latest_fd = None
-        return tmp
-
-    def retrieve_initial_info(self, data):
+    def retrieve_initial_info(self, initial):
         # 3 longwords: protocol version w/o FD, my (new) ID w/o FD,
-        # and then a -1 with the FD of the IVSHMEM file which is
-        # delivered before this.
+        # and then a -1 with the FD of the IVSHMEM file.
         assert self.initial_pass, 'Internal state error (1)'
-        assert len(data) == 24, 'Initial data needs three quadwords'
+        assert len(initial) == 3, 'Initial data needs three quadwords'
 
         # Enough idiot checks.
-        mailbox_fd = self.latest_fd
-        version, tmpid, minusone = struct.unpack('qqq', data)
+        (version, fd0), (tmpid, fd1), (minusone, mailbox_fd) = initial
         assert version == self.CLIENT_IVSHMEM_PROTOCOL_VERSION, \
             'Unxpected protocol version %d' % version
+        assert fd0 is None and fd1 is None, 'Unexpected fd in initial info'
         assert minusone == -1, \
             'Expected -1 with mailbox fd, got %d' % minusone
+        assert mailbox_fd is not None, 'Mailbox fd is missing'
 
         # Initialize my mailbox slot.  Get other parameters from the
         # globals because the IVSHMSG protocol doesn't allow values
@@ -216,17 +245,41 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         self.cclass = 'Debugger'
         print('This ID = %2d (%s)' % (self.id, self.nodename))
 
-    # Called multiple times so keep state info about previous calls.
+    # Called with whatever the transport read; see the framing comment
+    # at the top.  Complete quadwords go to quadwordReceived() in order.
     def dataReceived(self, data):
+        if not data:
+            return
+        if self._newfds:
+            owner = self._rxquads + (len(self._rxbuf) + len(data) - 1) // 8
+            self._rxfds.extend((owner, fd) for fd in self._newfds)
+            self._newfds = []
+        self._rxbuf += data
+        nquads = len(self._rxbuf) // 8
+        if not nquads:
+            return
+        values = struct.unpack('%dq' % nquads, self._rxbuf[:nquads * 8])
+        self._rxbuf = self._rxbuf[nquads * 8:]
+        for value in values:
+            index = self._rxquads
+            self._rxquads += 1
+            fd = None
+            if self._rxfds and self._rxfds[0][0] == index:
+                fd = self._rxfds.popleft()[1]
+                assert not self._rxfds or self._rxfds[0][0] != index, \
+                    'More than one fd for quadword %d' % index
+            self.quadwordReceived(value, fd)
+
+    def quadwordReceived(self, thisbatch, latest_fd):
         if self.id is None:
-            self.retrieve_initial_info(data)
+            self._initial.append((thisbatch, latest_fd))
+            if len(self._initial) == 3:
+                self.retrieve_initial_info(self._initial)
+                self._initial = None
             return      # But I'll be right back :-)
 
         # Now into the stream of <peer id><eventfd> pairs.  Unless it's
         # a single <peer id> which is a disconnect notification.
-        latest_fd = self.latest_fd
-        assert len(data) == 8, 'Expecting a signed long long'
-        thisbatch = struct.unpack('q', data)[0]
         if self.verbose > 1:
             print('Just got index %s, fd %s' % (thisbatch, latest_fd))
         assert thisbatch >= 0, 'Latest data is negative number'
@@ -234,6 +287,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         if latest_fd is None:   # "thisbatch" is a disconnect notification
             print('%s (%d) has left the building' %
                 (MB.slots[thisbatch].nodename, thisbatch))
+            peer_left(thisbatch)
             for collection in (self.id2EN_list, self.id2fd_list):
                 try:
                     del collection[thisbatch]
@@ -268,7 +322,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         try:
             tmp = len(self.id2fd_list[thisbatch])
             assert tmp <= MB.server_id, 'fd list is too long'
-            if tmp == MB.nEvents:   # Beginning of client reconnect
+            if tmp == MB.nVectors:  # Beginning of client reconnect
                 assert thisbatch != self.id, \
                     'Updating MY eventfds??? off-by-one'
                 raise KeyError('Forced update')
@@ -282,7 +336,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
                 print(id, eventfds)
 
         # Assumes all vector lists are the same length.
-        batchneeds = MB.nEvents - len(self.id2fd_list[thisbatch])
+        batchneeds = MB.nVectors - len(self.id2fd_list[thisbatch])
         if batchneeds > 0:
             if self.verbose > 1:
                 print('Batch for peer id %d expecting %d more fds...\n' %
@@ -307,17 +361,46 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         for id in self.id2fd_list:          # Triggers message pickup
             if id not in self.id2EN_list:   # already processed?
                 self.id2EN_list[id] = ivshmsg_event_notifier_list(
-                    self.id2fd_list[id])
+                    self.id2fd_list[id], id)
 
         if not self.initial_pass:           # It was just one additional peer
             return
 
         # Finally arm my incoming events and announce readiness.
         assert thisbatch == self.id, 'Cuz it\'s not paranoid if you catch it'
+        dispatcher = None
+        shared = MB.pendmap is not None
+        if self.args.epoll or self.args.busy_poll:
+            pending = None
+            if shared:
+                pending = lambda N: MB.any_pending(self.id)
+            elif MB.layout == MB.LAYOUT_RING:   # Only it knows the dest
+                pending = lambda N: MB.pending(N.num, self.id)
+            dispatcher = EventfdDispatcher(self.args.busy_poll, pending)
+        callback = self.ClientCallback
+        if self.args.moderate_usecs:
+            if MB.layout == MB.LAYOUT_RING:
+                callback = DoorbellModerator(callback,
+                    lambda N: MB.disarm(self.id, N.num),
+                    lambda N: MB.rearm(self.id, N.num),
+                    self.args.moderate_count, self.args.moderate_usecs)
+            else:
+                print('Doorbell moderation needs a ring mailbox, ignored')
+        if shared:      # One doorbell, the pending map says who rang
+            callback = SharedDoorbellDemux(callback,
+                lambda: MB.take_pending(self.id))
         for i, N in enumerate(self.id2EN_list[self.id]):
             N.num = i
-            tmp = EventfdReader(N, self.ClientCallback, self)
+            if not i and not shared:    # Mailslot 0, the globals "slot"
+                continue
+            if dispatcher is not None:
+                dispatcher.add(N, callback, self)
+                continue
+            tmp = EventfdReader(N, callback, self)
             tmp.start()
+        if dispatcher is not None:
+            dispatcher.start()
+        self.dispatcher = dispatcher
         print('Ready player %s' % self.nodename)
         self.place_and_go('server', 'Link CTL Peer-Attribute')
         self.initial_pass = False
@@ -336,6 +419,9 @@ class ProtocolIVSHMSGClient(TIPProtocol):
             else:
                 print('The server was probably shut down.')
         MB.clear_mailslot(self.id)  # In particular, nodename
+        if self.dispatcher is not None:     # No more doorbells from anyone
+            for N in self.id2EN_list[self.id]:
+                self.dispatcher.remove(N)
         if TIreactor.running:       # Stopped elsewhere on SIGINT
             TIreactor.stop()
 
@@ -345,7 +431,6 @@ class ProtocolIVSHMSGClient(TIPProtocol):
     def ClientCallback(vectorobj):
         requester_id = vectorobj.num
         requester_name = MB.nodename(requester_id)
-        request = MB.retrieve(requester_id)
         requester_obj = vectorobj.cbdata
         # print('Raw Req ID = %d\n%s' % (requester_id, vars(requester_obj)))
 
@@ -354,12 +439,28 @@ class ProtocolIVSHMSGClient(TIPProtocol):
             this=requester_obj,         # has CID0, SID0, and cclass
             proxy=None,                 # I don't manage ever (for now)
             from_id=requester_obj.id,
-            to_doorbell=requester_obj.id2EN_list[requester_id][requester_obj.id],
+            to_doorbell=MB.doorbell(requester_obj.id2EN_list[requester_id],
+                                    requester_obj.id),
             logmsg=requester_obj.logmsg,
             stdtrace=requester_obj.stdtrace,
             verbose=requester_obj.verbose,
         )
-        ret = handle_request(request, requester_name, ro)
+        # Zero-copy views of the mailslot.  Only a ring is drained, see
+        # ServerCallback().
+        handled = 0
+        while True:
+            request = MB.retrieve_view(requester_id, requester_obj.id)
+            if request is None:
+                break
+            handled += 1
+            try:
+                ret = handle_request(request, requester_name, ro)
+            finally:
+                request.release()
+                MB.release(requester_id, requester_obj.id)
+            if MB.layout != MB.LAYOUT_RING:
+                break
+        return handled      # For DoorbellModerator
 
     #----------------------------------------------------------------------
     # Command line parsing.
@@ -379,6 +480,17 @@ class ProtocolIVSHMSGClient(TIPProtocol):
             self.place_and_go(dest, msg)
             return True
 
+        if cmd in ('b', 'bulk'):     # Test data bigger than a mailslot
+            assert len(args) == 2, 'Need dest and byte count'
+            dest = self.parse_target(self.id, args[0])
+            assert dest, 'unknown destination'
+            data = bytes(i & 0xFF for i in range(int(args[1])))
+            for D in dest:
+                d = send_bulk(data, self.id,
+                              MB.doorbell(self.id2EN_list[D], self.id))
+                d.addErrback(self._place_and_go_failed, D, 'bulk', self.id)
+            return True
+
         if cmd in ('sp', 'spoof'):     # Like send but specify a src
             assert len(args) >= 2, 'Missing src and/or dest'
             src = args.pop(0)
@@ -409,6 +521,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
 
         if cmd in ('h', 'help') or '?' in cmd:
             print('dest/src can be integer, hostname, or "server"\n')
+            print('b[ulk] dest nbytes\n\tSend nbytes of test data as fragments')
             print('h[elp]\n\tThis message')
             print('l[ink]\n\tLink commands (CTL and RFC)')
             print('p[ing] dest\n\tShorthand for "send dest ping"')
@@ -455,13 +568,20 @@ class ProtocolIVSHMSGClient(TIPProtocol):
 class FactoryIVSHMSGClient(TIPClientFactory):
 
     _required_arg_defaults = {
+        'busy_poll':    0,          # usecs to spin before sleeping in epoll
+        'credits':      0,          # Receive window for tagged requests
+        'epoll':        False,      # Doorbells on a dispatcher thread
+        'moderate_count': 64,       # Doorbell moderation, messages...
+        'moderate_usecs': 0,        # ...and time; 0 == off
         'socketpath':   '/tmp/ivshmsg_socket',
+        'tlv':          False,      # Offer the binary wire format
         'verbose':      0,
     }
 
     def __init__(self, args=None):
         '''Args must be an object with the following attributes:
-           socketpath, verbose
+           busy_poll, credits, epoll, moderate_count, moderate_usecs,
+           socketpath, tlv, verbose
            Suitable defaults will be supplied.'''
 
         # Pass command line args to ProtocolIVSHMSG, then open logging.
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# (at your option) any later version.  See the LICENSE file in the
+# top-level directory.
+
+# Live handoff: a new server process takes over from a running one without
+# any peer noticing, eg, to deploy a new build under running VMs.  Every
+# server listens on <socketpath>.handoff (mode 0600, it gives away all its
+# fds).  A successor started with --takeover connects there and the old
+# server, blocking its reactor from then on, sends over SOCK_SEQPACKET:
+#
+#   state   geometry args, warm ids     listening sockets, server eventfds
+#   peer    id, peerattrs, CID0/SID0    its socket (unless recycled), eventfds
+#   done
+#
+# The successor adopts the mailbox as is (a warm attach that drops
+# nothing), the IVSHMSG and REST listening sockets and each peer
+# connection, then answers
+# "ready".  The old server os._exit()s right there: a normal reactor
+# shutdown would shutdown() the sockets it shares with the successor and
+# disconnect everybody.  If anything goes wrong first the old server picks
+# up where it left off.
+#
+# Lost in the handoff: messages the old server had queued in fill_async(),
+# outstanding Link RFC tags (and tagged requests waiting for credits), and
+# peer ID reservations.  Peer windows come back with the peer attributes.
+
+import json
+import os
+import socket
+
+from twisted.internet import reactor as TIreactor
+from twisted.internet.interfaces import IReadDescriptor
+
+from zope.interface import implementer
+
+try:
+    from twisted_restapi import MailBoxReSTAPI
+except ImportError as e:
+    from .twisted_restapi import MailBoxReSTAPI
+
+HANDOFF_SUFFIX = '.handoff'
+HANDOFF_TIMEOUT = 10.0      # Seconds for the whole exchange
+
+# Args that shape the mailbox and the fabric; the successor must use the
+# running server's values whatever its own command line says.
+_INHERITED = ('hugepages', 'isolate', 'mailbox', 'msgsize', 'nClients',
+              'numa_node', 'recycle', 'reserve_secs', 'ring',
+              'shared_doorbell', 'silent', 'smart', 'socketpath', 'stats')
+
+_MAXFDS = 253               # SCM_MAX_FD
+_MAXMSG = 64 * 1024
+
+
+def _send(sock, msg, fds=()):
+    assert len(fds) <= _MAXFDS, 'Too many fds for one message'
+    socket.send_fds(sock, [ json.dumps(msg).encode() ], list(fds))
+
+
+def _recv(sock):
+    data, fds, flags, addr = socket.recv_fds(sock, _MAXMSG, _MAXFDS)
+    for fd in fds:
+        os.set_inheritable(fd, False)
+    if not data:
+        raise EOFError('Handoff peer went away')
+    return json.loads(data), fds
+
+###########################################################################
+# Running (old) server side.
+
+
+@implementer(IReadDescriptor)
+class HandoffListener(object):
+
+    def __init__(self, SI, port, args):
+        self.SI = SI
+        self.port = port            # The IVSHMSG IListeningPort
+        self.args = args
+        self.path = args.socketpath + HANDOFF_SUFFIX
+        try:
+            os.unlink(self.path)    # Stale, or the predecessor's
+        except FileNotFoundError as e:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        oldumask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(oldumask)
+        self.sock.listen(1)
+        self.sock.setblocking(False)
+        TIreactor.addReader(self)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def logPrefix(self):
+        return 'Handoff@%s' % self.path
+
+    def connectionLost(self, reason):
+        TIreactor.removeReader(self)
+
+    def doRead(self):
+        try:
+            conn, addr = self.sock.accept()
+        except (BlockingIOError, InterruptedError) as e:
+            return
+        conn.settimeout(HANDOFF_TIMEOUT)
+        try:
+            self.handoff(conn)
+        finally:
+            conn.close()
+
+    def handoff(self, conn):
+        SI = self.SI
+        if SI.shards is not None:
+            SI.logmsg('Live handoff is not supported with --workers')
+            return
+        SI.logmsg('Handing off to a successor...')
+
+        # Stop everything that reads a socket or doorbell; the reactor
+        # is blocked in here anyway until exit or resume.
+        readers = TIreactor.getReaders()
+        writers = TIreactor.getWriters()
+        TIreactor.removeAll()
+        if SI.dispatcher is not None:
+            SI.dispatcher.stop()
+        try:
+            args = dict((key, getattr(self.args, key, None))
+                        for key in _INHERITED)
+            rest = MailBoxReSTAPI.listener
+            _send(conn, {
+                'op':       'state',
+                'args':     args,
+                'warm_ids': sorted(SI.warm_ids),
+                'rest_family': rest.socket.family,
+            }, [ self.port.fileno(), rest.fileno() ] +
+               [ EN.get_fd() for EN in SI.EN_list ])
+
+            peers = [ (proxy, True) for proxy in SI.clients.values() ]
+            if SI.recycled:
+                peers.extend((proxy, False)
+                             for proxy in SI.recycled.values())
+            for proxy, connected in peers:
+                fds = [ proxy.transport.fileno() ] if connected else []
+                fds.extend(EN.get_fd() for EN in proxy.EN_list)
+                _send(conn, {
+                    'op':           'peer',
+                    'id':           proxy.id,
+                    'connected':    connected,
+                    'peerattrs':    proxy.peerattrs,
+                    'CID0':         proxy.CID0,
+                    'SID0':         proxy.SID0,
+                }, fds)
+            _send(conn, { 'op': 'done' })
+
+            msg, fds = _recv(conn)
+            assert msg['op'] == 'ready', 'Successor said "%s"' % msg['op']
+        except Exception as e:
+            SI.logmsg('Handoff failed, carrying on: %s' % str(e))
+            for reader in readers:
+                TIreactor.addReader(reader)
+            for writer in writers:
+                TIreactor.addWriter(writer)
+            if SI.dispatcher is not None:
+                SI.dispatcher.start()
+            return
+
+        SI.logmsg('Handed off %d peers, exiting' % len(SI.clients))
+        os._exit(0)
+
+###########################################################################
+# Successor side.  takeover() runs before the mailbox is opened; the
+# factory adopts what it got and then calls ready().
+
+
+class RecycledPeer(object):
+    '''Stands in for a disconnected proxy in SI.recycled.'''
+
+    def __init__(self, peer, EN_list):
+        self.id = peer['id']
+        self.EN_list = EN_list
+        self.peerattrs = peer['peerattrs']
+        self.CID0 = peer['CID0']
+        self.SID0 = peer['SID0']
+
+
+class Handoff(object):
+
+    def __init__(self, socketpath):
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.conn.settimeout(HANDOFF_TIMEOUT)
+        self.conn.connect(socketpath + HANDOFF_SUFFIX)
+
+        msg, fds = _recv(self.conn)
+        assert msg['op'] == 'state', 'Expected server state first'
+        self.args = msg['args']
+        self.warm_ids = frozenset(msg['warm_ids'])
+        self.listen_fd = fds[0]
+        self.rest = (fds[1], msg['rest_family'])
+        self.server_fds = fds[2:]
+        self.peers = []
+        while True:
+            msg, fds = _recv(self.conn)
+            if msg['op'] == 'done':
+                break
+            assert msg['op'] == 'peer', 'Unexpected "%s"' % msg['op']
+            if msg['connected']:
+                msg['sock_fd'], msg['fds'] = fds[0], fds[1:]
+            else:
+                msg['sock_fd'], msg['fds'] = None, fds
+            self.peers.append(msg)
+
+    def ready(self):
+        _send(self.conn, { 'op': 'ready' })
+        self.conn.close()
+        self.conn = None
+
+
+def takeover(args):
+    '''Connect to the server running on args.socketpath and take its
+       state.  args is updated with the inherited values.'''
+    handoff = Handoff(args.socketpath)
+    for key, value in handoff.args.items():
+        setattr(args, key, value)
+    args.warm = True            # Attach the mailbox as is...
+    args.takeover = True        # ...dropping nothing
+    return handoff
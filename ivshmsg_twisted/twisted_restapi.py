@@ -32,20 +32,36 @@ class MailBoxReSTAPI(object):
     nEvents = None
     server_id = None
     nodes = None
+    peerids = None      # The server's PeerIDAllocator, if any
+    flow = None         # famez_requests.flow_stats, credits by peer
+    listener = None     # The IListeningPort, for a live handoff
+
+    # Rebuilt only when a peer came, went or changed its names, which the
+    # mailbox tracks per slot (see IVSHMSG_MailBox.active_names()).
+    _topology = (None, None)
 
     @classmethod
     def mb2dict(cls):
+        active = cls.mb.active_names()
+        if cls._topology[0] is active:
+            return cls._topology[1]
+
+        mbg = cls.mb.slots[0]
         thedict = OrderedDict((
             ('nClients', cls.nClients),
             ('server_ivshmsg_id', cls.server_ivshmsg_id),
+            ('nSlots', mbg.nSlots),
+            ('slotsize', mbg.slotsize),
+            ('buf_offset', mbg.buf_offset),
         ))
 
         # The D3 Javascript framework refers to a node's name as its "id".
-        for ivshmsg_id in range(1, cls.nEvents):
+        nodes = []
+        for ivshmsg_id, (nodename, cclass) in active.items():
             this = cls.nodes[ivshmsg_id]
             this.ivshmsg_id = ivshmsg_id
-            this.id = cls.mb.slots[ivshmsg_id].nodename
-            this.cclass = cls.mb.slots[ivshmsg_id].cclass
+            this.id = nodename
+            this.cclass = cclass
             this.hardware = cls.cclass_to_hardware_type(this.cclass)
 
             # Since they all connect to the one switch (no P2P)
@@ -56,15 +72,18 @@ class MailBoxReSTAPI(object):
             # this.TXpackets = 0
             # this.RXpackets = 0
             # this.port = 0
-        thedict['nodes'] = [ vars(n) for n in cls.nodes[1:] if n.id ]
+            if this.id:
+                nodes.append(vars(this))
+        thedict['nodes'] = nodes
 
         links = []
-        server_id = cls.nodes[cls.server_ivshmsg_id].id    # a string
+        server_id = cls.mb.nodename(cls.server_ivshmsg_id)  # a string
         for node in thedict['nodes']:
             id = node['id']             # also a string
             if id and id != server_id:
                 links.append({'source': id, 'target': server_id})
         thedict['links'] = links
+        cls._topology = (active, thedict)
         return thedict
 
     def cclass_to_hardware_type(cclass_name):
@@ -87,23 +106,57 @@ class MailBoxReSTAPI(object):
             return json.dumps(thedict)
         return('<PRE>%s</PRE>' % pformat(dict(thedict)))
 
+    @app.route('/stats')
+    def get_stats(self, request):
+        '''Traffic counters for every port, active or not.'''
+        thedict = OrderedDict()
+        if self.mb.stats is None:       # Server wasn't run with --stats
+            request.setHeader('Access-Control-Allow-Origin', '*')
+            return json.dumps(thedict)
+        for ivshmsg_id in range(1, self.server_ivshmsg_id + 1):
+            counters = self.mb.slot_stats(ivshmsg_id)
+            counters['nodename'] = self.mb.nodename(ivshmsg_id)
+            thedict[str(ivshmsg_id)] = counters
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        return json.dumps(thedict)
+
+    @app.route('/ports')
+    def get_ports(self, request):
+        '''Peer ID occupancy as the server's allocator sees it.'''
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        if self.peerids is None:
+            return json.dumps({})
+        return json.dumps(self.peerids.occupancy())
+
+    @app.route('/credits')
+    def get_credits(self, request):
+        '''Flow control of tagged requests from the server, by peer.'''
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        if self.flow is None:
+            return json.dumps({})
+        return json.dumps(self.flow())
+
     @app.route('/')
     def home(self, request):
         # print('Received "%s"' % request.uri.decode(), file=sys.stderr)
         reqhdrs = dict(request.requestHeaders.getAllRawHeaders())
 
-        return '<PRE>\n%s\nUse /system\n</PRE>' % '\n'.join(
+        return '<PRE>\n%s\nUse /system, /stats, /ports or /credits\n</PRE>' % '\n'.join(
             sorted([k.decode() for k in reqhdrs.keys()]))
 
     # Must come after all Klein dependencies and @decorators
-    def __init__(self, already_initialized_IVSHMSG_mailbox, port=1991):
+    def __init__(self, already_initialized_IVSHMSG_mailbox, port=1991,
+                 adopt=None):
+        '''adopt: (fd, family) of a listening socket from the server this
+           one took over from, instead of the port.'''
         cls = self.__class__
         if cls.mb is not None:
             return
         cls.mb = already_initialized_IVSHMSG_mailbox
-        cls.nClients = cls.mb.nClients
-        cls.nEvents = cls.mb.nEvents
-        cls.server_ivshmsg_id = cls.mb.server_id      # see mb2dict
+        mbg = cls.mb.slots[0]           # The layout is published here
+        cls.nClients = mbg.nClients
+        cls.nEvents = mbg.nEvents
+        cls.server_ivshmsg_id = mbg.server_id         # see mb2dict
         # Clients/ports are enumerated 1-nClients inclusive
         cls.nodes = [ cls.N() for _ in range(cls.nEvents) ]
 
@@ -113,7 +166,11 @@ class MailBoxReSTAPI(object):
         # durng the class-level scan/eval of this source file.  See also
         # /usr/lib/python3/dist-packages/klein/app.py::run()
         s = TWserver.Site(self.app.resource())
-        TIreactor.listenTCP(port, s)
+        if adopt is None:
+            cls.listener = TIreactor.listenTCP(port, s)
+        else:
+            cls.listener = TIreactor.adoptStreamPort(adopt[0], adopt[1], s)
+            os.close(adopt[0])
 
 
 if __name__ == '__main__':
@@ -12,10 +12,9 @@ import functools
 import grp
 import mmap
 import os
-import random
+import socket
 import struct
 import sys
-import time
 
 from collections import OrderedDict
 from pprint import pprint
@@ -36,16 +35,32 @@ from twisted.internet.protocol import Protocol as TIPProtocol
 try:
     from commander import Commander
     from ivshmsg_mailbox import IVSHMSG_MailBox as MB
-    from famez_requests import handle_request, send_payload, ResponseObject
+    from famez_requests import handle_request, send_payload_async, ResponseObject
+    from famez_requests import configure_tags, flow_stats
+    from famez_requests import peer_attributes, peer_left
+    import famez_tlv
     from ivshmsg_eventfd import ivshmsg_event_notifier_list, EventfdReader
-    from ivshmsg_sendrecv import ivshmsg_send_one_msg
+    from ivshmsg_eventfd import EventfdDispatcher, DoorbellModerator
+    from ivshmsg_eventfd import SharedDoorbellDemux, EventfdPool
+    from ivshmsg_peerids import PeerIDAllocator
+    from twisted_worker import ShardSupervisor
+    from twisted_handoff import HandoffListener, RecycledPeer, takeover
+    from ivshmsg_sendrecv import ivshmsg_send_one_msg, ivshmsg_send_msgs
     from twisted_restapi import MailBoxReSTAPI
 except ImportError as e:
     from .commander import Commander
     from .ivshmsg_mailbox import IVSHMSG_MailBox as MB
-    from .famez_requests import handle_request, send_payload, ResponseObject
+    from .famez_requests import handle_request, send_payload_async, ResponseObject
+    from .famez_requests import configure_tags, flow_stats
+    from .famez_requests import peer_attributes, peer_left
+    from . import famez_tlv
     from .ivshmsg_eventfd import ivshmsg_event_notifier_list, EventfdReader
-    from .ivshmsg_sendrecv import ivshmsg_send_one_msg
+    from .ivshmsg_eventfd import EventfdDispatcher, DoorbellModerator
+    from .ivshmsg_eventfd import SharedDoorbellDemux, EventfdPool
+    from .ivshmsg_peerids import PeerIDAllocator
+    from .twisted_worker import ShardSupervisor
+    from .twisted_handoff import HandoffListener, RecycledPeer, takeover
+    from .ivshmsg_sendrecv import ivshmsg_send_one_msg, ivshmsg_send_msgs
     from .twisted_restapi import MailBoxReSTAPI
 
 # Don't use peer ID 0, certain docs imply it's reserved.  Use its mailslot
@@ -83,6 +98,9 @@ class ProtocolIVSHMSGServer(TIPProtocol):
 
     SI = None           # Server Instance, contrived to be "me" not a peer
 
+    _redraw = None      # Pending switch display, see printswitch()
+    _redrawn = 0.0      # reactor.seconds() of the last one
+
     def __init__(self, factory, args=None):
         '''"self" is a new client connection, not "me" the server.  As such
             it is a proxy object for the other end of each switch "port".
@@ -91,7 +109,12 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         shutdown_http_logging()
         self.isPFM = False
 
-        # Am I one of many peer proxies?
+        # Am I one of many peer proxies?  Maybe one handed over by the
+        # previous server, already connected and advertised.
+        self.adopted = False
+        if self.SI is not None and args is None and factory.adopting:
+            self.adopt(factory.adopting)
+            return
         if self.SI is not None and args is None:
             self.create_new_peer_id()
             # Python client will quickly fix this.  QEMU VM will eventually
@@ -101,7 +124,8 @@ class ProtocolIVSHMSGServer(TIPProtocol):
                 'SID0': '0',
                 'cclass': 'Driverless QEMU'
             }
-            MB.slots[self.id].cclass = self.peerattrs['cclass']
+            if self.id > 0:     # -1 == no room
+                MB.slots[self.id].cclass = self.peerattrs['cclass']
             return
 
         # This instance is voodoo from the first manual kick.  Originally
@@ -112,6 +136,7 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         cls = self.__class__
         cls.SI = self                       # Reserve it and flesh it out.
         cls.verbose = args.verbose
+        cls.redraw_interval = args.redraw_ms / 1000.0
 
         self.id = args.server_id
         assert self.id == MB.server_id, 'Server ID mismatch'
@@ -123,6 +148,10 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         self.smart = args.smart
         self.clients = OrderedDict()        # Order probably not necessary
         self.recycled = {} if args.recycle else None
+        famez_tlv.offer(args.tlv)
+        configure_tags(args.tag_timeout_ms, args.tag_retries, self.logmsg,
+                       args.credits)
+        MailBoxReSTAPI.flow = staticmethod(flow_stats)
 
         # For the ResponseObject/request().
         if self.smart:
@@ -142,16 +171,77 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         # set up a callback.  This arming is not a race condition as any
         # peer for which this is destined has not yet been "listened/heard".
 
+        # The epoll dispatcher takes the doorbells off the reactor; a
+        # busy_poll window spins before sleeping.  Only ring mailslots and
+        # the shared-doorbell pending map say who a message is for, so only
+        # they can be spun on.  With shared doorbells there's just one
+        # eventfd (vector 0) and the pending map says who rang it.
+        # After a handoff the peers already hold the server's eventfds.
+        vectors = MB.nVectors
+        if args.handoff is not None:
+            vectors = args.handoff.server_fds
         self.EN_list = []
-        if not args.silent:
-            self.EN_list = ivshmsg_event_notifier_list(MB.nEvents)
+        self.dispatcher = None
+        self.shards = None
+        if not args.silent and args.workers:    # Doorbells go to workers
+            self.EN_list = ivshmsg_event_notifier_list(vectors, self.id)
+        elif not args.silent:
+            shared = MB.pendmap is not None
+            self.EN_list = ivshmsg_event_notifier_list(vectors, self.id)
+            if args.epoll or args.busy_poll:
+                pending = None
+                if shared:
+                    pending = lambda EN: MB.any_pending(self.id)
+                elif MB.layout == MB.LAYOUT_RING:
+                    pending = lambda EN: MB.pending(EN.num, self.id)
+                self.dispatcher = EventfdDispatcher(args.busy_poll, pending)
+            callback = self.ServerCallback
+            if args.moderate_usecs:
+                callback = DoorbellModerator(callback,
+                    lambda EN: MB.disarm(self.id, EN.num),
+                    lambda EN: MB.rearm(self.id, EN.num),
+                    args.moderate_count, args.moderate_usecs)
+            if shared:
+                callback = SharedDoorbellDemux(callback,
+                    lambda: MB.take_pending(self.id))
+            self.doorbell_callback = callback   # See watch_doorbell()
             # The actual client doing the sending needs to be fished out
             # via its "num" vector.
             for i, EN in enumerate(self.EN_list):
                 EN.num = i
-                tmp = EventfdReader(EN, self.ServerCallback, cls.SI)
-                if i:   # Skip mailslot 0, the globals "slot"
-                    tmp.start()
+                if not i and not shared:    # Mailslot 0, the globals "slot"
+                    continue
+                if self.dispatcher is not None:
+                    self.dispatcher.add(EN, callback, cls.SI)
+                    continue
+                tmp = EventfdReader(EN, callback, cls.SI)
+                tmp.start()
+            if self.dispatcher is not None:
+                self.dispatcher.start()
+
+        # Joining peers get their eventfds from here (see connectionMade).
+        self.eventfd_pool = EventfdPool(args.eventfd_pool, MB.nVectors)
+
+        # Peer IDs.  Smart mode hands them out randomly.  Departed peers'
+        # IDs are held for their return (see ivshmsg_peerids.py).
+        self.peerids = PeerIDAllocator(IVSHMSG_LOWEST_ID, MB.nClients,
+            randomize=self.smart, hold_secs=args.reserve_secs)
+        MailBoxReSTAPI.peerids = self.peerids
+
+        if args.workers:
+            self.shards = ShardSupervisor(self, args.workers, args)
+
+        # Peers that survived a warm restart keep their slots.  They have
+        # no connection (so no proxy) but they're still on the fabric.
+        # After a handoff the live ones come back as proxies instead.
+        self.warm_ids = set(MB.warm_ids)
+        if args.handoff is not None:
+            self.warm_ids = set(args.handoff.warm_ids)
+        for id in self.warm_ids:
+            self.peerids.take(id)
+        if self.warm_ids:
+            self.logmsg('Warm restart kept %s' % ', '.join(
+                '%d:%s' % (id, MB.nodename(id)) for id in sorted(self.warm_ids)))
 
     @property
     def promptname(self):
@@ -169,6 +259,14 @@ class ProtocolIVSHMSGServer(TIPProtocol):
     # If errors occur early enough, send a bad revision to the client so it
     # terminates the connection.  Remember, "self" is a proxy for a peer.
     def connectionMade(self):
+        if self.adopted:
+            self.SI.logmsg('adopted socket %d == peer id %d' % (
+                self.transport.fileno(), self.id))
+            self.SI.clients[self.id] = self
+            if self.SI.shards is not None:
+                self.SI.shards.join(self)
+            return
+
         recycled = self.SI.recycled                         # Does it exist?
         if recycled:
             recycled = self.SI.recycled.get(self.id, None)  # Am I there?
@@ -191,12 +289,13 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         # Server line 175: create specified number of eventfds.  These are
         # shared with all other clients who use them to signal each other.
         # Recycling keeps QEMU sessions from dying when other clients drop,
-        # a perk not found in original code.
+        # a perk not found in original code.  New ones usually come ready
+        # made from the pool, which then refills between other events.
         if recycled:
             self.EN_list = recycled.EN_list
         else:
             try:
-                self.EN_list = ivshmsg_event_notifier_list(MB.nEvents)
+                self.EN_list = self.SI.eventfd_pool.take(self.id)
             except Exception as e:
                 self.SI.logmsg('Event notifiers failed: %s' % str(e))
                 self.send_initial_info(False)
@@ -209,40 +308,36 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             self.SI.logmsg('Send initial info failed')
             return
 
+        # Each advertisement is built whole and handed to the socket in
+        # one go (see ivshmsg_send_msgs) rather than a syscall per fd.
+
         # Server line 189: advertise the new peer to others.  Note that
         # this new peer has not yet been added to the list; this loop is
         # NOT traversed for the first peer to connect.
         if not recycled:
             if self.verbose:
                 PRINT('NOT recycled: advertising other peers...')
+            mine = [ (self.id, peer_EN.wfd) for peer_EN in self.EN_list ]
             for other_peer in server_peer_list:
-                for peer_EN in self.EN_list:
-                    ivshmsg_send_one_msg(
-                        other_peer.transport.socket,
-                        self.id,
-                        peer_EN.wfd)
+                ivshmsg_send_msgs(other_peer.transport.socket, mine)
 
         # Server line 197: advertise the other peers to the new one.
         # Remember "this" new peer proxy has not been added to the list yet.
         if self.verbose:
             PRINT('Advertising other peers to the new peer...')
+        msgs = []
         for other_peer in server_peer_list:
-            for other_peer_EN in other_peer.EN_list:
-                ivshmsg_send_one_msg(
-                    self.transport.socket,
-                    other_peer.id,
-                    other_peer_EN.wfd)
+            msgs.extend((other_peer.id, other_peer_EN.wfd)
+                        for other_peer_EN in other_peer.EN_list)
 
         # Non-standard voodoo extension to previous advertisment: advertise
         # this server to the new peer.  To QEMU it just looks like one more
         # grouping in the previous batch.  Exists only in non-silent mode.
         if self.verbose:
             PRINT('Advertising this server to the new peer...')
-        for server_EN in self.SI.EN_list:
-            ivshmsg_send_one_msg(
-                self.transport.socket,
-                self.SI.id,
-                server_EN.wfd)
+        self.watch_doorbell(True)       # Before it can ring it
+        msgs.extend((self.SI.id, server_EN.wfd)
+                    for server_EN in self.SI.EN_list)
 
         # Server line 205: advertise the new peer to itself, ie, send the
         # eventfds it needs for receiving messages.  This final batch
@@ -250,23 +345,24 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         # sentinel that communications are finished.
         if self.verbose:
             PRINT('Advertising the new peer to itself...')
-        for peer_EN in self.EN_list:
-            ivshmsg_send_one_msg(
-                self.transport.socket,
-                self.id,
-                peer_EN.get_fd())   # Must be a good story here...
+        msgs.extend((self.id, peer_EN.get_fd())     # Must be a good story...
+                    for peer_EN in self.EN_list)
+        if not ivshmsg_send_msgs(self.transport.socket, msgs):
+            self.SI.logmsg('Advertising to peer %d failed' % self.id)
 
         # And now that it's finished:
         self.SI.clients[self.id] = self
+        if self.SI.shards is not None:
+            self.SI.shards.join(self)
 
         # QEMU did the connect but its VM is probably not yet running well
         # enough to respond.  Since there's no (easy) way to tell, this is
         # a blind shot...
-        self.printswitch(self.SI.clients)   # default settling time
+        self.printswitch(self.SI.clients)   # Drawn after things settle
         if not self.SI.isPFM:
-            send_payload('Link CTL Peer-Attribute',
-                         self.SI.id,
-                         self.EN_list[self.id])
+            send_payload_async('Link CTL Peer-Attribute',
+                               self.SI.id,
+                               MB.doorbell(self.EN_list, self.SI.id))
 
     def connectionLost(self, reason):
         '''Tell the other peers that this one has died.'''
@@ -276,9 +372,17 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         self.SI.logmsg('%s %s of peer id %d' % (status, verb, self.id))
         # For QEMU crashes and shutdowns (not the OS guest but QEMU itself).
         MB.clear_mailslot(self.id)
+        MB.refresh_active(self.id)
+        peer_left(self.id)
+        if self.id > 0:
+            self.watch_doorbell(False)
 
         if self.id in self.SI.clients:     # Only if everything was completed
             del self.SI.clients[self.id]
+            if self.SI.shards is not None:
+                self.SI.shards.leave(self.id)
+        if self.id > 0:
+            self.SI.peerids.release(self.id, reserve=not self.SI.quitting)
         if self.SI.recycled and not self.SI.quitting:
             self.SI.recycled[self.id] = self
         else:
@@ -294,27 +398,54 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             self.SI.logmsg('Final client disconnected after "quit"')
             TIreactor.stop()                            # turn out the lights
 
+    # The dispatcher doesn't need to watch, or spin on, the doorbell of a
+    # departed peer until its id comes back.  A shared doorbell is everyone's.
+
+    def watch_doorbell(self, watch):
+        dispatcher = self.SI.dispatcher
+        if dispatcher is None or MB.pendmap is not None:
+            return
+        EN = self.SI.EN_list[self.id]
+        if watch:
+            dispatcher.add(EN, self.SI.doorbell_callback, self.SI)
+        else:
+            dispatcher.remove(EN)
+
+    def adopt(self, peer):
+        '''Pick up a peer from the previous server, see twisted_handoff.'''
+        self.adopted = True
+        self.id = peer['id']
+        self.SI.peerids.take(self.id)
+        self.EN_list = ivshmsg_event_notifier_list(peer['fds'], self.id)
+        self.peerattrs = peer['peerattrs']
+        self.CID0 = peer['CID0']
+        self.SID0 = peer['SID0']
+        peer_attributes(self.id, self.peerattrs)
+
     def create_new_peer_id(self):
-        '''Determine the lowest unused client ID and set self.id.'''
+        '''Get an unused client ID from the allocator and set self.id.'''
 
         self.SID0 = 0   # When queried, the answer is in the context...
         self.CID0 = 0   # ...of the server/switch, NOT the proxy item.
-        if len(self.SI.clients) >= MB.nClients:
-            self.id = -1    # sentinel
-            return  # Until a Link RFC is executed
-
-        # Generate ID sets used by each.  The range includes the highest
-        # client ID.  Two modes: dumb == monotonic from 1; smart == random.
-        all_ids = frozenset((range(IVSHMSG_LOWEST_ID, self.SI.id)))
-        active_ids = frozenset(self.SI.clients.keys())
-        available_ids = all_ids - active_ids
-        if self.SI.smart:
-            self.id = random.choice(tuple(available_ids))
-        else:
-            if not self.SI.clients:   # empty
-                self.id = 1
-            else:
-                self.id = (sorted(available_ids))[0]
+
+        # Slots held over from a warm restart go last, and only after
+        # their previous owner is forgotten.  A VM that unloaded its
+        # driver since then has already given its slot back.
+        for id in [ id for id in self.SI.warm_ids if not MB.nodename(id) ]:
+            self.SI.warm_ids.discard(id)
+            self.SI.peerids.release(id, reserve=False)
+            MB.refresh_active(id)
+        self.id = self.SI.peerids.allocate()
+        if self.id == -1 and self.SI.warm_ids:
+            self.SI.logmsg('Reclaiming warm restart slots')
+            for id in self.SI.warm_ids:
+                MB.clear_mailslot(id)
+                MB.refresh_active(id)
+                self.SI.peerids.release(id, reserve=False)
+            self.SI.warm_ids.clear()
+            self.id = self.SI.peerids.allocate()
+        if self.id == -1:   # sentinel
+            return          # Until a Link RFC is executed
 
         if self.SI.smart:
             self.SID0 = self.SI.default_SID
@@ -354,7 +485,6 @@ class ProtocolIVSHMSGServer(TIPProtocol):
     def ServerCallback(vectorobj):
         requester_id = vectorobj.num
         requester_name = MB.nodename(requester_id)
-        request = MB.retrieve(requester_id)
         SI = vectorobj.cbdata
 
         # Recover the appropriate requester proxy object which can die between
@@ -368,10 +498,12 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             # drivers hadn't come up before).  Just get it fresh each time.
             requester_proxy.nodename = requester_name
             requester_proxy.cclass = MB.cclass(requester_id)
+            SI.refresh_active(requester_id)     # For everybody's lookups
             requester_proxy.peerattrs['cclass'] = requester_proxy.cclass
         except KeyError as e:
             SI.logmsg('Disappeering act by %d' % requester_id)
-            return
+            MB.release(requester_id, SI.id)
+            return 0
 
         # The object passed has two sets of data:
         # 1. Id/target information on where to send the response
@@ -388,30 +520,81 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             this=SI,                # has "my" (server) CID0, SID0, and cclass
             proxy=requester_proxy,  # for certain server-only admin
             from_id=SI.id,
-            to_doorbell=requester_proxy.EN_list[SI.id],
+            to_doorbell=MB.doorbell(requester_proxy.EN_list, SI.id),
             logmsg=SI.logmsg,
             stdtrace=SI.stdtrace,
-            verbose=SI.verbose
+            verbose=SI.verbose,
+            deliver=SI.delivered,   # For handlers that finish later
         )
-        ret = handle_request(request, requester_name, ro)
+        # Zero-copy: each request is a view of the mailslot, released as
+        # soon as it's been handled.  Only a ring is drained: a legacy or
+        # isolated slot has no dest, and once it's released the sender may
+        # refill it for somebody else.  One doorbell, one request.
+        dump = False
+        handled = 0
+        while True:
+            request = MB.retrieve_view(requester_id, SI.id)
+            if request is None:
+                break
+            handled += 1
+            try:
+                ret = handle_request(request, requester_name, ro)
+            finally:
+                request.release()
+                MB.release(requester_id, SI.id)
 
-        # ret is either True, False, or...
+            # ret is either True, False, or...
 
-        if ret == 'dump':
+            if ret == 'dump':
+                dump = True
+            if MB.layout != MB.LAYOUT_RING:
+                break
+
+        if dump:
             # Might be some other stuff, but finally
-            ProtocolIVSHMSGServer.printswitch(SI.clients)
+            SI.printswitch(SI.clients)
+        return handled      # For DoorbellModerator
+
+    # ServerCallback() pokes the SI through these so a sharded worker, whose
+    # SI is a stand-in, can hand it to the supervisor.
+
+    def refresh_active(self, id):
+        MB.refresh_active(id)
+
+    def delivered(self, ret):
+        '''ret from a handler that finished after ServerCallback().'''
+        if ret == 'dump':
+            self.printswitch(self.clients)
 
     #----------------------------------------------------------------------
     # ASCII art switch:  Left side and right sider are each half of the ports.
-
-    @staticmethod
-    def printswitch(clients, delay=0.5):
-        if int(delay) < 0 or int(delay) > 2:
-            delay = 1.0
-        time.sleep(delay)
+    # It used to sleep in the reactor to let things settle, stalling every
+    # peer for each join, leave, and dump.  Now a redraw is scheduled no
+    # sooner than redraw_interval after the previous one; requests in the
+    # meantime ride on that one, which draws the state as of when it runs.
+
+    @classmethod
+    def printswitch(cls, clients, now=False):
+        '''now=True for interactive commands: draw immediately.'''
+        pending = cls._redraw is not None and cls._redraw.active()
+        if now:
+            if pending:
+                cls._redraw.cancel()
+            cls._drawswitch(clients)
+            return
+        if pending:
+            return
+        wait = cls._redrawn + cls.redraw_interval - TIreactor.seconds()
+        cls._redraw = TIreactor.callLater(max(wait, 0), cls._drawswitch,
+                                          clients)
+
+    @classmethod
+    def _drawswitch(cls, clients):
+        cls._redraw = None
+        cls._redrawn = TIreactor.seconds()
         lfmt = '%s %s [%s,%s]'
         rfmt = '[%s,%s] %s %s'
-        half = (MB.MAILBOX_MAX_SLOTS - 1) // 2
+        half = (MB.nClients + 1) // 2
         NSP = 32
         lspaces = ' ' * NSP
         PRINT('\n%s  ____ ____' % lspaces)
@@ -423,21 +606,26 @@ class ProtocolIVSHMSGServer(TIPProtocol):
                 ldesc = lspaces
                 c = clients[left]
                 pa = c.peerattrs
-                pa['cclass'] = MB.cclass(left)
-                ldesc += lfmt % (pa['cclass'], MB.nodename(left),
+                snap = MB.snapshot(left)
+                pa['cclass'] = snap['cclass']
+                ldesc += lfmt % (pa['cclass'], snap['nodename'],
                     pa['CID0'], pa['SID0'])
             except KeyError as e:
                 pass
+            rlabel = '%2d' % right if right > half else '  '  # Odd count
             try:
+                if right <= half:
+                    raise KeyError(right)
                 c = clients[right]
                 pa = c.peerattrs
-                pa['cclass'] = MB.cclass(right)
+                snap = MB.snapshot(right)
+                pa['cclass'] = snap['cclass']
                 rdesc = rfmt % (pa['CID0'], pa['SID0'],
-                    pa['cclass'], MB.nodename(right))
+                    pa['cclass'], snap['nodename'])
             except KeyError as e:
                 rdesc = ''
-            PRINT('%-s -|%1d  %c %2d|- %s' % (
-                ldesc[-NSP:], left, notch, right, rdesc))
+            PRINT('%-s -|%-2d %c %s|- %s' % (
+                ldesc[-NSP:], left, notch, rlabel, rdesc))
             notch = ' '
         PRINT('%s  =========' % lspaces)
 
@@ -460,7 +648,12 @@ class ProtocolIVSHMSGServer(TIPProtocol):
                     PRINT('%10s: %s' % (MB.nodename(id), peer.peerattrs))
                     if self.verbose > 2:
                         PPRINT(vars(peer), stream=sys.stdout)
-            self.printswitch(self.SI.clients, 0)
+                PRINT('Peer IDs: %s' % dict(self.peerids.occupancy()))
+                flow = flow_stats()
+                if flow:
+                    PRINT('Credits:')
+                    PPRINT(flow, stream=sys.stdout)
+            self.printswitch(self.SI.clients, now=True)
             return True
 
         if cmd in ('q', 'quit'):
@@ -484,21 +677,50 @@ class ProtocolIVSHMSGServer(TIPProtocol):
 
 class FactoryIVSHMSGServer(TIPServerFactory):
 
+    adopting = None     # Peer being handed over, see ProtocolIVSHMSGServer
+    port = None         # The IVSHMSG listening port
+
     _required_arg_defaults = {
         'title':        'IVSHMSG',
+        'busy_poll':    0,          # usecs to spin before sleeping in epoll
+        'credits':      0,          # Receive window for tagged requests
+        'epoll':        False,      # Doorbells on a dispatcher thread
+        'eventfd_pool': 2,          # Ready eventfd sets for joining peers
         'foreground':   True,       # Only affects logging choice in here
+        'hugepages':    None,       # hugetlbfs mount instead of /dev/shm
+        'isolate':      False,      # One writer per mailslot cacheline
         'logfile':      '/tmp/ivshmsg_log',
         'mailbox':      'ivshmsg_mailbox',  # Will end up in /dev/shm
+        'moderate_count': 64,       # Doorbell moderation, messages...
+        'moderate_usecs': 0,        # ...and time; 0 == off
+        'msgsize':      384,        # Mailslot geometry follows from this
         'nClients':     2,
+        'numa_node':    -1,         # Mailbox memory placement
         'recycle':      False,      # Try to preserve other QEMUs
+        'redraw_ms':    500,        # Switch display rate limit
+        'reserve_secs': 30,         # Hold a departed peer's ID this long
+        'ring':         0,          # Mailslot ring depth, 0 == legacy
+        'shared_doorbell': False,   # One eventfd per peer, not nEvents
         'silent':       False,      # Does participate in eventfds/mailbox
         'socketpath':   '/tmp/ivshmsg_socket',
+        'stats':        False,      # Traffic counters, grows the mailbox
+        'tag_retries':  2,          # Resends of an unacknowledged request
+        'tag_timeout_ms': 1000,     # First wait for an ACK, then doubled
+        'takeover':     False,      # Live handoff from a running server
+        'tlv':          False,      # Offer the binary wire format
         'verbose':      0,
+        'warm':         False,      # Adopt an existing mailbox as is
+        'workers':      0,          # Request handling processes, 0 == none
     }
 
     def __init__(self, args=None):
         '''Args must be an object with the following attributes:
-           foreground, logfile, mailbox, nClients, silent, socketpath, verbose
+           busy_poll, credits, epoll, eventfd_pool, foreground, hugepages, isolate,
+           logfile, mailbox, moderate_count, moderate_usecs, msgsize,
+           nClients, numa_node, redraw_ms, reserve_secs, ring,
+           shared_doorbell, silent, socketpath, stats, tag_retries,
+           tag_timeout_ms,
+           takeover, tlv, verbose, warm, workers
            Suitable defaults will be supplied.'''
 
         # Pass command line args to ProtocolIVSHMSG, then open logging.
@@ -507,6 +729,9 @@ class FactoryIVSHMSGServer(TIPServerFactory):
         for arg, default in self._required_arg_defaults.items():
             setattr(args, arg, getattr(args, arg, default))
 
+        # Taking over from a running server overrides the geometry.
+        args.handoff = takeover(args) if args.takeover else None
+
         # Mailbox may be sized above the requested number of clients to
         # satisfy QEMU IVSHMEM restrictions.
         args.server_id = args.nClients + 1
@@ -515,7 +740,8 @@ class FactoryIVSHMSGServer(TIPServerFactory):
         # It's a singleton so no reason to keep the instance, however it's
         # the way I wrote the Klein API server so...
         mb = MB(args=args)
-        MailBoxReSTAPI(mb)
+        MailBoxReSTAPI(mb,
+            adopt=None if args.handoff is None else args.handoff.rest)
         shutdown_http_logging()
 
         if args.foreground:
@@ -533,13 +759,19 @@ class FactoryIVSHMSGServer(TIPServerFactory):
 
         # By Twisted version 18, "mode=" is deprecated and you should just
         # inherit the tacky bit from the parent directory.  wantPID creates
-        # <path>.lock as a symlink to "PID".
-        E = UNIXServerEndpoint(
-            TIreactor,
-            args.socketpath,
-            mode=0o666,         # Deprecated at Twisted 18
-            wantPID=True)
-        E.listen(self)
+        # <path>.lock as a symlink to "PID".  A successor just carries on
+        # with the socket of the server it took over from.
+        if args.handoff is None:
+            E = UNIXServerEndpoint(
+                TIreactor,
+                args.socketpath,
+                mode=0o666,         # Deprecated at Twisted 18
+                wantPID=True)
+            E.listen(self).addCallback(self._listening)
+        else:
+            self.port = TIreactor.adoptStreamPort(
+                args.handoff.listen_fd, socket.AF_UNIX, self)
+            os.close(args.handoff.listen_fd)
         args.logmsg('%s server @%d ready for %d clients on %s' %
             (args.title, args.server_id, args.nClients, args.socketpath))
 
@@ -552,6 +784,33 @@ class FactoryIVSHMSGServer(TIPServerFactory):
 
         protobj = ProtocolIVSHMSGServer(self, args)     # With "args"
         Commander(protobj)
+        if args.handoff is not None:
+            self.adopt_peers(protobj.SI, args.handoff)
+        if self.port is not None:
+            HandoffListener(protobj.SI, self.port, args)
+
+    def _listening(self, port):
+        self.port = port
+
+    def adopt_peers(self, SI, handoff):
+        '''Connected peers get proxies much like new connections but
+           without the IVSHMSG exchange.  Recycled ones just go back.'''
+        for peer in handoff.peers:
+            if peer['sock_fd'] is None:
+                if SI.recycled is not None:
+                    SI.recycled[peer['id']] = RecycledPeer(peer,
+                        ivshmsg_event_notifier_list(peer['fds'], peer['id']))
+                continue
+            self.adopting = peer
+            try:
+                TIreactor.adoptStreamConnection(
+                    peer['sock_fd'], socket.AF_UNIX, self)
+            finally:
+                self.adopting = None
+                os.close(peer['sock_fd'])
+        handoff.ready()
+        SI.logmsg('Took over %d peers' % len(SI.clients))
+        SI.printswitch(SI.clients)
 
     def buildProtocol(self, useless_addr):
         # Unfortunately this doesn't work.  Search for /dev/null above.
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# (at your option) any later version.  See the LICENSE file in the
+# top-level directory.
+
+# Sharded switch.  With --workers N the server process becomes a supervisor:
+# it still owns the UNIX socket, the mailbox, peer IDs, advertisements, the
+# REST API and Commander, but the doorbells for requests sent to the server
+# are split across N worker processes by port (peer id % N).  Each worker
+# runs the usual ServerCallback loop for its ports.  IVSHMSG sockets stay
+# in the supervisor (it does all the fd advertising); a worker only needs
+# eventfds:
+#
+#   - at startup, the mailbox fd and the server doorbells of its ports
+#   - when a peer joins, that peer's doorbell for the server (to respond)
+#
+# The control channel is a SOCK_SEQPACKET socketpair carrying one JSON
+# message per packet, with SCM_RIGHTS for the fds.  Workers post as the
+# server id under a record lock (IVSHMSG_MailBox.share_id()), and hand the
+# things only the supervisor writes (active_map, the switch display) back
+# to it.  Moderation and shared doorbells keep server-wide state in the
+# server's mailslot so they aren't available sharded.
+
+import json
+import os
+import socket
+import sys
+
+from twisted.internet import reactor as TIreactor
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.protocol import ProcessProtocol
+
+from zope.interface import implementer
+
+try:
+    from ivshmsg_mailbox import IVSHMSG_MailBox as MB
+    from ivshmsg_eventfd import ivshmsg_event_notifier_list, EventfdReader
+    from ivshmsg_eventfd import EventfdDispatcher
+    from famez_requests import configure_tags, peer_attributes, peer_left
+    import famez_tlv
+except ImportError as e:
+    from .ivshmsg_mailbox import IVSHMSG_MailBox as MB
+    from .ivshmsg_eventfd import ivshmsg_event_notifier_list, EventfdReader
+    from .ivshmsg_eventfd import EventfdDispatcher
+    from .famez_requests import configure_tags, peer_attributes, peer_left
+    from . import famez_tlv
+
+_MAXFDS = 64                # More than any one message carries
+_MAXMSG = 64 * 1024
+
+
+def _send(sock, msg, fds=()):
+    socket.send_fds(sock, [ json.dumps(msg).encode() ], list(fds))
+
+
+###########################################################################
+# Both ends read the control socket from the reactor.
+
+
+@implementer(IReadDescriptor)
+class _ControlReader(object):
+
+    def __init__(self, sock, callback, lost):
+        self.sock = sock
+        self.callback = callback    # callback(msg, fds)
+        self.lost = lost
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def logPrefix(self):
+        return 'ShardControl@%d' % self.fileno()
+
+    def doRead(self):
+        try:
+            data, fds, flags, addr = socket.recv_fds(
+                self.sock, _MAXMSG, _MAXFDS)
+        except (BlockingIOError, InterruptedError) as e:
+            return
+        except OSError as e:
+            data = b''
+        if not data:
+            TIreactor.removeReader(self)
+            self.lost()
+            return
+        self.callback(json.loads(data), fds)
+
+    def connectionLost(self, reason):
+        TIreactor.removeReader(self)
+
+    def start(self):
+        TIreactor.addReader(self)
+
+
+###########################################################################
+# Supervisor side, hung off the server instance (SI).
+
+
+class _WorkerProcess(ProcessProtocol):
+
+    def __init__(self, index, logmsg):
+        self.index = index
+        self.logmsg = logmsg
+
+    def processEnded(self, reason):
+        self.logmsg('Shard worker %d exited: %s' % (
+            self.index, reason.getErrorMessage()))
+
+
+class ShardSupervisor(object):
+
+    def __init__(self, SI, nworkers, args):
+        assert 1 <= nworkers <= MB.nClients, 'Bad worker count'
+        self.SI = SI
+        self.nworkers = nworkers
+        self.socks = []
+        MB.share_id(SI.id)          # The supervisor sends as SI.id too
+        script = os.path.abspath(__file__)
+        if script.endswith('.pyc'):
+            script = script[:-1]
+        for index in range(nworkers):
+            mine, theirs = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            TIreactor.spawnProcess(_WorkerProcess(index, SI.logmsg),
+                sys.executable,
+                args=[ sys.executable, script, str(index), '3' ],
+                env=os.environ,
+                childFDs={ 0: 'w', 1: 1, 2: 2, 3: theirs.fileno() })
+            theirs.close()
+            mine.setblocking(False)
+            self.socks.append(mine)
+            _ControlReader(mine,
+                lambda msg, fds, index=index: self.received(index, msg, fds),
+                lambda index=index: SI.logmsg(
+                    'Lost shard worker %d' % index)).start()
+
+            ports = [ id for id in range(1, MB.nClients + 1)
+                      if self.owner(id) == index ]
+            _send(mine, {
+                'op':           'init',
+                'index':        index,
+                'server_id':    SI.id,
+                'ports':        ports,
+                'verbose':      SI.verbose,
+                'cclass':       SI.cclass,
+                'CID0':         SI.CID0,
+                'SID0':         SI.SID0,
+                'isPFM':        SI.isPFM,
+                'smart':        SI.smart,
+                'epoll':        args.epoll,
+                'busy_poll':    args.busy_poll,
+                'tlv':          args.tlv,
+                'tag_timeout_ms': args.tag_timeout_ms,
+                'tag_retries':  args.tag_retries,
+                'credits':      args.credits,
+            }, [ MB.fd ] + [ SI.EN_list[id].get_fd() for id in ports ])
+        SI.logmsg('Request handling sharded over %d workers' % nworkers)
+
+    def owner(self, id):
+        return id % self.nworkers
+
+    def join(self, proxy):
+        '''proxy has connected and been advertised.'''
+        doorbell = MB.doorbell(proxy.EN_list, self.SI.id)
+        _send(self.socks[self.owner(proxy.id)], {
+            'op':           'join',
+            'id':           proxy.id,
+            'CID0':         proxy.CID0,
+            'SID0':         proxy.SID0,
+            'peerattrs':    proxy.peerattrs,
+        }, [ doorbell.get_fd() ])
+
+    def leave(self, id):
+        _send(self.socks[self.owner(id)], { 'op': 'leave', 'id': id })
+
+    def received(self, index, msg, fds):
+        for fd in fds:              # Nothing comes this way
+            os.close(fd)
+        if msg['op'] == 'refresh':
+            MB.refresh_active(msg['id'])
+        elif msg['op'] == 'peerattrs':
+            for id, peerattrs in msg['peerattrs'].items():
+                proxy = self.SI.clients.get(int(id), None)
+                if proxy is not None:
+                    proxy.peerattrs = peerattrs
+                    peer_attributes(proxy.id, peerattrs)
+            if msg['dump']:
+                self.SI.printswitch(self.SI.clients)
+        else:
+            self.SI.logmsg('Shard worker %d sent "%s"' % (index, msg['op']))
+
+
+###########################################################################
+# Worker side.  _WorkerSI stands in for the server instance and _PortProxy
+# for a peer proxy as far as ProtocolIVSHMSGServer.ServerCallback and
+# handle_request() are concerned.
+
+
+class _PortProxy(object):
+
+    def __init__(self, SI, msg, doorbell):
+        self.SI = SI
+        self.id = msg['id']
+        self.CID0 = msg['CID0']
+        self.SID0 = msg['SID0']
+        self.peerattrs = msg['peerattrs']
+        self.EN_list = { SI.id: doorbell }      # Only MB.doorbell() looks
+        self.nodename = None
+        self.cclass = None
+
+
+class _WorkerSI(object):
+
+    def __init__(self, sock, msg):
+        self.sock = sock
+        self.index = msg['index']
+        self.id = msg['server_id']
+        self.verbose = msg['verbose']
+        self.cclass = msg['cclass']
+        self.CID0 = msg['CID0']
+        self.SID0 = msg['SID0']
+        self.isPFM = msg['isPFM']
+        self.smart = msg['smart']
+        self.clients = {}
+        self.readers = {}           # By port, to catch up on join
+        self.seen = {}              # By port, last (nodename, cclass) sent
+        self.stdtrace = sys.stderr
+
+    def logmsg(self, msg):
+        print('worker %d: %s' % (self.index, msg), file=sys.stderr)
+
+    logerr = logmsg
+
+    # ServerCallback hooks: the supervisor owns these.
+
+    def refresh_active(self, id):
+        snap = (MB.nodename(id), MB.cclass(id))
+        if self.seen.get(id, None) != snap:
+            self.seen[id] = snap
+            _send(self.sock, { 'op': 'refresh', 'id': id })
+
+    def printswitch(self, clients):
+        _send(self.sock, {
+            'op':           'peerattrs',
+            'peerattrs':    dict((str(id), proxy.peerattrs)
+                                 for id, proxy in clients.items()),
+            'dump':         True,
+        })
+
+    def delivered(self, ret):
+        if ret == 'dump':
+            self.printswitch(self.clients)
+
+
+class ShardWorker(object):
+
+    def __init__(self, index, ctlfd):
+        self.index = index
+        self.sock = socket.socket(fileno=ctlfd)
+        self.sock.setblocking(False)
+        self.SI = None
+        self.callback = None
+        self.dispatcher = None      # Watches only ports with a peer
+        _ControlReader(self.sock, self.received, self.lost).start()
+
+    def lost(self):
+        if TIreactor.running:       # Supervisor is gone, so am I
+            TIreactor.stop()
+
+    def received(self, msg, fds):
+        getattr(self, '_op_' + msg['op'])(msg, fds)
+
+    def _op_init(self, msg, fds):
+        try:
+            from twisted_server import ProtocolIVSHMSGServer
+        except ImportError as e:
+            from .twisted_server import ProtocolIVSHMSGServer
+
+        SI = self.SI = _WorkerSI(self.sock, msg)
+        famez_tlv.offer(msg['tlv'])
+        configure_tags(msg['tag_timeout_ms'], msg['tag_retries'], SI.logmsg,
+                       msg['credits'])
+        MB(fd=fds[0], client_id=SI.id, shared=True)
+        ports = msg['ports']
+        EN_list = ivshmsg_event_notifier_list(fds[1:], SI.id)
+
+        def callback(EN):
+            if EN.num not in SI.clients:    # Join hasn't been read yet
+                return 0
+            return ProtocolIVSHMSGServer.ServerCallback(EN)
+        self.callback = callback
+
+        dispatcher = None
+        if msg['epoll'] or msg['busy_poll']:
+            pending = None
+            if MB.layout == MB.LAYOUT_RING:
+                pending = lambda EN: MB.pending(EN.num, SI.id)
+            dispatcher = EventfdDispatcher(msg['busy_poll'], pending)
+        for id, EN in zip(ports, EN_list):
+            EN.num = id
+            SI.readers[id] = EN
+            if dispatcher is not None:
+                dispatcher.add(EN, callback, SI)
+                continue
+            EventfdReader(EN, callback, SI).start()
+        if dispatcher is not None:
+            dispatcher.start()
+        self.dispatcher = dispatcher
+        SI.logmsg('serving ports %s' % ', '.join(str(p) for p in ports))
+
+    def _op_join(self, msg, fds):
+        doorbell = ivshmsg_event_notifier_list(fds, msg['id'])[0]
+        proxy = _PortProxy(self.SI, msg, doorbell)
+        self.SI.clients[proxy.id] = proxy
+        self.SI.seen.pop(proxy.id, None)
+        peer_attributes(proxy.id, proxy.peerattrs)
+        EN = self.SI.readers[proxy.id]
+        EN.cbdata = self.SI
+        if self.dispatcher is not None:
+            self.dispatcher.add(EN, self.callback, self.SI)
+        self.callback(EN)           # In case it rang before the join
+
+    def _op_leave(self, msg, fds):
+        proxy = self.SI.clients.pop(msg['id'], None)
+        peer_left(msg['id'])
+        if self.dispatcher is not None:
+            self.dispatcher.remove(self.SI.readers[msg['id']])
+        if proxy is not None:
+            proxy.EN_list[self.SI.id].cleanup()
+
+
+if __name__ == '__main__':
+    index, ctlfd = int(sys.argv[1]), int(sys.argv[2])
+    ShardWorker(index, ctlfd)
+    TIreactor.run()
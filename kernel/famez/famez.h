@@ -39,9 +39,17 @@ struct ivshmem_msi_x_table_pba {	// BAR 1: Not mapped, not used.  YET.
 // slots are for client IDs 1 through nClients.
 
 struct famez_globals {			// BAR 2: Start of IVSHMEM
-	uint64_t slotsize, buf_offset, nClients, nEvents, server_id;
+	uint64_t slotsize, buf_offset, nClients, nEvents, server_id,
+		 layout, ring_cells, ring_cellsize, nSlots,
+		 active_map, generation,	// generation 0: map unused
+		 stats_offset,			// Python peers only
+		 pending_offset;		// !0: shared doorbells, unsupported
 };
 
+#define FAMEZ_LAYOUT_LEGACY	0	// One message per mailslot
+#define FAMEZ_LAYOUT_RING	1	// Not supported by this driver (yet)
+#define FAMEZ_LAYOUT_ISOLATED	2	// Not supported by this driver (yet)
+
 // Use only uint64_t and keep the buf[] on a 32-byte alignment for this:
 // od -Ad -w32 -c -tx8 /dev/shm/famez_mailbox
 struct __attribute__ ((packed)) famez_mailslot {
@@ -52,10 +60,29 @@ struct __attribute__ ((packed)) famez_mailslot {
 		 last_responder,	// off 80: To assist stale stompage
 		 peer_SID,		// off 88: Calculated in MSI-X...
 		 peer_CID,		// off 96: ...from last_responder
-		 pad[3];		// off 104
+		 seqlock,		// off 104: odd while owner writes
+		 posted,		// off 112: isolated layout only
+		 draining;		// off 120: ring layout moderation
 	char buf[];			// off 128 == globals->buf_offset
 };
 
+// Lockless readers (the Python server, REST monitor) retry when seqlock
+// is odd or changes across their reads, so bracket every owner write of
+// nodename, cclass, buflen and buf.  Receivers clearing buflen don't.
+// buflen publishes a message, so write buf before it.
+
+static inline void famez_slot_write_begin(struct famez_mailslot *slot)
+{
+	WRITE_ONCE(slot->seqlock, slot->seqlock | 1);
+	smp_wmb();
+}
+
+static inline void famez_slot_write_end(struct famez_mailslot *slot)
+{
+	smp_wmb();
+	WRITE_ONCE(slot->seqlock, slot->seqlock + 1);
+}
+
 // The primary configuration/context data.
 struct famez_adapter {
 	struct list_head lister;
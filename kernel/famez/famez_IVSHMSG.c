@@ -77,11 +77,15 @@ int famez_create_outgoing(int CID, int SID, char *buf, size_t buflen,
 		return -ERESTARTSYS;
 	}
 	// Keep nodename and buf pointer; update buflen and buf contents.
-	// buflen is the handshake out to the world that I'm busy.
-	adapter->my_slot->buflen = buflen;
-	adapter->my_slot->buf[buflen] = '\0';	// ASCII strings paranoia
+	// buflen is the handshake out to the world that I'm busy, so it
+	// goes last: a reader that sees it sees the whole buf.
+	famez_slot_write_begin(adapter->my_slot);
 	adapter->my_slot->last_responder = peer_id;
 	memcpy(adapter->my_slot->buf, buf, buflen);
+	adapter->my_slot->buf[buflen] = '\0';	// ASCII strings paranoia
+	smp_wmb();
+	WRITE_ONCE(adapter->my_slot->buflen, buflen);
+	famez_slot_write_end(adapter->my_slot);
 
 	// Choose the correct vector set from all sent to me via the peer.
 	// Trigger the vector corresponding to me with the vector.
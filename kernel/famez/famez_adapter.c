@@ -125,6 +125,7 @@ void famez_adapter_destroy(struct famez_adapter *adapter)
 struct famez_adapter *famez_adapter_create(struct pci_dev *pdev)
 {
 	struct famez_adapter *adapter = NULL;
+	uint64_t seqlock;
 	int ret;
 
 	if (!(adapter = kzalloc(sizeof(*adapter), GFP_KERNEL))) {
@@ -158,6 +159,15 @@ struct famez_adapter *famez_adapter_create(struct pci_dev *pdev)
 	// globals is handcrafted in Python, make sure it's all kosher.
 	// If these fail, go back and add tests to Python, not here.
 	ret = -EINVAL;
+	if (adapter->globals->layout != FAMEZ_LAYOUT_LEGACY) {
+		pr_err(FZ "mailbox layout %llu is not supported\n",
+			adapter->globals->layout);
+		goto err_kfree;
+	}
+	if (adapter->globals->pending_offset) {
+		pr_err(FZ "shared doorbells are not supported\n");
+		goto err_kfree;
+	}
 	if (offsetof(struct famez_mailslot, buf) != adapter->globals->buf_offset) {
 		pr_err(FZ "MSG_OFFSET global != C offset in here\n");
 		goto err_kfree;
@@ -179,7 +189,10 @@ struct famez_adapter *famez_adapter_create(struct pci_dev *pdev)
 		pr_err("Server-defined peer ID %llu is wrong\n", adapter->my_slot->peer_id);
 		goto err_kfree;
 	}
+	famez_slot_write_begin(adapter->my_slot);
+	seqlock = adapter->my_slot->seqlock;
 	memset(adapter->my_slot, 0, adapter->globals->slotsize);
+	adapter->my_slot->seqlock = seqlock;	// memset zapped it
 	adapter->my_slot->peer_id = adapter->my_id;
 
 	// Leave room for the NUL in strings.
@@ -188,6 +201,7 @@ struct famez_adapter *famez_adapter_create(struct pci_dev *pdev)
 		 "%s.%02x", utsname()->nodename, adapter->pdev->devfn >> 3);
 	strncpy(adapter->my_slot->cclass, DEFAULT_CCLASS,
 		sizeof(adapter->my_slot->cclass) - 1);
+	famez_slot_write_end(adapter->my_slot);
 	strncpy(adapter->core->Base_C_Class_str, DEFAULT_CCLASS,
 		sizeof(adapter->core->Base_C_Class_str) - 1);
 